@@ -1,33 +1,81 @@
 #!/usr/bin/env python3
 
-import gi
-gi.require_version('Notify', '0.7')
-from gi.repository import Notify, GLib
 import configparser
 import argparse
 import os, sys, logging, logging.handlers
 from html import escape as html_escape
 import resource, signal
 from pwd import getpwnam
-from threading import Thread
+from threading import Thread, Event, Lock, Timer
+from concurrent.futures import ThreadPoolExecutor
+import queue
 import notiflib
-import email
+import asyncio
+import email.message
+import hashlib
+import http.server
+import json
+import socketserver
+import subprocess
 import time
+import weakref
 
 '''
 Please secure the config file with chmod 600 as this program runs
 non interactive so we need to read plaintext password
 '''
 CONFIG_FILE     = "%s/.notif.cfg" % (os.environ["HOME"])
+STATE_DIR       = "%s/imapnotif" % (os.environ.get("XDG_STATE_HOME",
+                    "%s/.local/state" % (os.environ["HOME"])))
 DEVLOG          = "/dev/log"
 DEVNULL         = "/dev/null"
 DEFAULT_MAILBOX = "INBOX"
 INTERVAL        = 10
 IDLE_TIMEOUT    = 15        # when using imap idle, value in minute
+COLD_INTERVAL   = 60        # seconds between STATUS checks of cold folders
 DEFAULT_UID     = 1000
 VERBOSE         = True
 MAILBOXES       = []        # holding account isntances
 SYS_EXIT        = False
+ASYNC_LOOP      = None      # event loop running mailboxes in async mode
+SESSIONS        = []        # account connection pools
+FOLDER_EVENTS   = {}        # (account, folder) -> Event set by NOTIFY
+DEBOUNCE        = 2         # seconds to gather a burst of new messages
+RATE            = 6         # notifications per minute per account
+BURST           = 3         # notifications shown at once before RATE applies
+SUMMARY_LINES   = 5         # messages listed in a burst notification
+DISPATCH_QUEUE  = 256       # notifications waiting for the main loop
+DISPATCH_BATCH  = 16        # notifications shown per main loop iteration
+ACTION_WORKERS  = 2         # threads running notification actions
+STATS_INTERVAL  = 300       # seconds between dispatch statistics in log
+BACKOFF_BASE    = 2         # seconds before first reconnect attempt
+BACKOFF_MAX     = 300       # longest wait between reconnect attempts
+BACKOFF_STABLE  = 60        # seconds a connection must last to reset backoff
+STARTUP_WORKERS = 4         # mailboxes connecting at the same time on startup
+SHUTDOWN_TIMEOUT = 3        # seconds to close mailboxes before dropping them
+STARTUP         = None      # thread pool opening mailboxes on startup
+STARTUP_TIME    = None      # monotonic time the daemon started
+# mailbox bookkeeping holds the mailboxes weakly rather than their id(),
+# a freed id comes back for a mailbox created by a later reload
+FIRST_NOTIF     = weakref.WeakSet() # mailboxes which already notified
+RUNNING         = {}        # account name -> config, session and mailboxes
+STOPPED         = weakref.WeakSet() # mailboxes removed by a config reload
+# mailbox -> time idle last led to a poll
+CYCLES          = weakref.WeakKeyDictionary()
+RELOAD_LOCK     = Lock()
+# settings needing a new login when changed, others apply per mailbox
+ACCOUNT_KEYS    = ("server", "username", "password", "ssl", "port",
+                   "timeout", "connections", "notify", "compress",
+                   "capture", "cold", "cold_interval")
+MAILBOX_KEYS    = ("interval", "fetch_chunk", "response_cap")
+SHARD           = None      # (index, count) when running as a worker process
+SHARD_OUT       = None      # pipe to the supervisor, in a worker
+SHARD_LOCK      = Lock()
+WORKERS         = []        # worker processes, in the supervisor
+METRICS         = notiflib.METRICS
+METRICS_FILE    = "metrics.prom" # SIGUSR2 dump, in STATE_DIR
+Notify          = None      # gi modules, imported by load_gi()
+GLib            = None
 
 class Notif:
     def __init__(self, **kwargs):
@@ -38,52 +86,418 @@ class Notif:
         self._func = kwargs.get('callback')
 
         self._notif = Notify.Notification.new(self._summ, self._body)
-        self._notif.add_action("click", "Mark read", self._callback, self._data)
+        self._notif.add_action("click", "Mark read", self._callback, None)
 
     def _callback(self, notif, act, data):
-        try:
-            self._func(data)
-        except: pass
+        # runs on the main loop, IMAP work is done by the action pool
+        DISPATCHER.action(self._func, self._data)
+
+    def update(self, **kwargs):
+        # replace content of a notification which may still be on screen
+        self._data = kwargs.get("data", self._data)
+        self._summ = kwargs.get('summary', self._summ)
+        self._body = kwargs.get('body', self._body)
+        self._func = kwargs.get('callback', self._func)
+        self._notif.update(self._summ, self._body, self._icon)
 
     def show(self):
         self._notif.show()
 
-def close_imap(signum, blah=None):
+class Dispatcher:
+    """
+    Hand notifications from worker threads to the GLib main loop
+
+    Workers push records to a bounded queue and never block; when the
+    queue is full the record is dropped and counted. One idle source on
+    the main loop shows queued records in small batches. Notification
+    actions go the other way, to a small thread pool, so the main loop
+    never waits on IMAP.
+    """
+
+    def __init__(self, maxsize=DISPATCH_QUEUE, workers=ACTION_WORKERS):
+        self._queue      = queue.Queue(maxsize)
+        self._lock       = Lock()
+        self._scheduled  = False
+        self._pool       = ThreadPoolExecutor(workers)
+        self.dropped     = 0
+        self.dispatched  = 0
+        self.failed      = 0
+        self.latency_max = 0.0
+        self._latency    = 0.0
+
+    def push(self, func, *args):
+        # called from any thread, returns False if record was dropped
+        try:
+            self._queue.put_nowait((time.monotonic(), func, args))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+        with self._lock:
+            if self._scheduled:
+                return True
+            self._scheduled = True
+        GLib.idle_add(self._drain)
+        return True
+
+    def action(self, func, *args):
+        def run():
+            try:
+                func(*args)
+            except Exception as e:
+                if VERBOSE:
+                    log.info("notification action failed: {}".format(e))
+        self._pool.submit(run)
+
+    def stats(self):
+        with self._lock:
+            avg = 0.0
+            if self.dispatched > 0:
+                avg = self._latency / self.dispatched
+            return {
+                'depth':       self._queue.qsize(),
+                'dropped':     self.dropped,
+                'dispatched':  self.dispatched,
+                'failed':      self.failed,
+                'latency_avg': avg,
+                'latency_max': self.latency_max,
+            }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+    def _drain(self):
+        # GLib idle callback, returns True to be called again
+        for _ in range(DISPATCH_BATCH):
+            try:
+                stamp, func, args = self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            latency = time.monotonic() - stamp
+            try:
+                func(*args)
+            except Exception as e:
+                self.failed += 1
+                if VERBOSE:
+                    log.info("cannot show notification: {}".format(e))
+            with self._lock:
+                self.dispatched += 1
+                self._latency += latency
+                self.latency_max = max(self.latency_max, latency)
+
+        with self._lock:
+            if self._queue.empty():
+                self._scheduled = False
+                return False
+        return True
+
+DISPATCHER = Dispatcher()
+
+def log_dispatch_stats():
     if VERBOSE:
-        log.info("Receiving signal number %d, exiting..." % (signum))
+        st = DISPATCHER.stats()
+        log.info("dispatch: depth {} dispatched {} dropped {} failed {} "
+            "latency avg {:.3f}s max {:.3f}s".format(
+                st['depth'], st['dispatched'], st['dropped'], st['failed'],
+                st['latency_avg'], st['latency_max']))
+    return True
 
-    global SYS_EXIT
-    SYS_EXIT = True
+METRICS.describe("exists_to_show_seconds", "histogram",
+    "EXISTS seen in IDLE to notification shown")
+METRICS.describe("reconnects_total", "counter",
+    "connections opened again by a mailbox loop")
 
-    if GLib.MainLoop().is_running():
-        GLib.MainLoop().quit()
+def collect_metrics():
+    # values kept by the dispatcher and sessions, for METRICS.render()
+    st = DISPATCHER.stats()
+    rows = [
+        ("dispatch_queue_depth", "gauge",
+            "notifications waiting for the main loop", {}, st['depth']),
+        ("dispatched_total", "counter",
+            "notifications handed to the main loop", {}, st['dispatched']),
+        ("dispatch_dropped_total", "counter",
+            "notifications dropped on a full queue", {}, st['dropped']),
+    ]
+    for session in list(SESSIONS):
+        labels = {"account": session.name}
+        rows.append(("connections", "gauge",
+            "connections open per account", labels, session.connections()))
+        rows.append(("logins_per_hour", "gauge",
+            "LOGIN sent during the last hour", labels,
+            session.logins_per_hour()))
+        if session.compression() is not None:
+            t = session.traffic
+            rows.append(("wire_bytes_total", "counter",
+                "bytes on wire of compressed connections", labels,
+                t['wire_in'] + t['wire_out']))
+    return rows
+
+METRICS.collect(collect_metrics)
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    # Prometheus scrape endpoint, any path
+    def do_GET(self):
+        body = METRICS.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class MetricsDump(socketserver.StreamRequestHandler):
+    # Unix socket, metrics are written to every client, e.g.
+    # socat - UNIX-CONNECT:path
+    def handle(self):
+        self.wfile.write(METRICS.render().encode("utf-8"))
+
+def shard_address(addr, index):
+    # worker index serves on the next ports, or next to the socket path
+    if "/" in addr:
+        return "{}.{}".format(addr, index)
+    host, _, port = addr.rpartition(":")
+    return "{}:{}".format(host, int(port) + 1 + index)
+
+def serve_metrics(addr):
+    # addr is a port or host:port for HTTP, or a path for a Unix socket
+    try:
+        if "/" in addr:
+            try:
+                os.unlink(addr)
+            except FileNotFoundError: pass
+            server = socketserver.ThreadingUnixStreamServer(addr, MetricsDump)
+            os.chmod(addr, 0o600)
+        else:
+            host, _, port = addr.rpartition(":")
+            server = http.server.ThreadingHTTPServer(
+                (host or "127.0.0.1", int(port)), MetricsHandler)
+    except (OSError, ValueError) as e:
+        log.info("cannot serve metrics on {}: {}".format(addr, e))
+        return None
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def dump_metrics(signum):
+    # SIGUSR2: write metrics to STATE_DIR, workers write their own file
+    name = METRICS_FILE
+    if SHARD is not None:
+        name = "{}.{}".format(METRICS_FILE, SHARD[0])
+    for worker in WORKERS:
+        worker.signal(signal.SIGUSR2)
+
+    path = os.path.join(STATE_DIR, name)
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            f.write(METRICS.render())
+        os.replace(path + ".tmp", path)
+        if VERBOSE:
+            log.info("metrics written to {}".format(path))
+    except OSError as e:
+        if VERBOSE:
+            log.info("cannot write metrics: {}".format(e))
+    return True
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self._rate   = rate / 60.0
+        self._burst  = max(1, burst)
+        self._tokens = float(self._burst)
+        self._stamp  = time.monotonic()
+
+    def take(self):
+        # returns 0 if a token was taken or seconds until one is available
+        now = time.monotonic()
+        self._tokens = min(self._burst,
+            self._tokens + (now - self._stamp) * self._rate)
+        self._stamp = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        if self._rate <= 0:
+            return 60
+        return (1 - self._tokens) / self._rate
 
-    for m in MAILBOXES:
+class Coalescer:
+    """
+    Stage between mailbox workers and Notif
+
+    New messages of a folder are held for a debounce window and shown
+    as one notification, or as a summary when several arrived. Each
+    account draws from a token bucket; while it is empty messages keep
+    piling up and are folded into the next summary. Summaries of a folder
+    reuse the notification already on screen.
+    """
+
+    def __init__(self):
+        self._lock     = Lock()
+        self._pending  = {}     # (account, folder) -> [(num, mbox, msg, callback)]
+        self._since    = {}     # (account, folder) -> [monotonic EXISTS time]
+        self._timers   = {}
+        self._buckets  = {}
+        self._settings = {}
+        self._shown    = {}     # (account, folder) -> Notif of last summary
+
+    def configure(self, account, debounce=DEBOUNCE, rate=RATE, burst=BURST):
+        with self._lock:
+            self._settings[account] = (debounce, rate, burst)
+            self._buckets[account] = TokenBucket(rate, burst)
+
+    def submit(self, num, mbox, msg, callback, since=None):
+        # since is when the server reported the message, if it did
+        account = mbox._account.name
+        key = (account, mbox.name)
+        with self._lock:
+            if account not in self._settings:
+                self._settings[account] = (DEBOUNCE, RATE, BURST)
+                self._buckets[account] = TokenBucket(RATE, BURST)
+            self._pending.setdefault(key, []).append((num, mbox, msg, callback))
+            if since is not None:
+                self._since.setdefault(key, []).append(since)
+            if key not in self._timers:
+                self._schedule(key, self._settings[account][0])
+
+    def _schedule(self, key, delay):
+        t = Timer(delay, self._flush, (key,))
+        t.daemon = True
+        self._timers[key] = t
+        t.start()
+
+    def _flush(self, key):
+        with self._lock:
+            del self._timers[key]
+            records = self._pending.get(key)
+            if not records:
+                return
+            wait = self._buckets[key[0]].take()
+            if wait > 0:
+                self._schedule(key, wait)
+                return
+            del self._pending[key]
+            since = self._since.pop(key, [])
+
+        if not DISPATCHER.push(self._show, key, records, since):
+            if VERBOSE:
+                log.info("{} - {}: dispatch queue full, {} dropped".format(
+                    key[0], key[1], len(records)))
+
+    def _show(self, key, records, since):
+        # main loop only
+        if len(records) == 1:
+            show_message(*records[0])
+        else:
+            with self._lock:
+                summary = self._shown.get(key)
+            summary = show_summary(records, summary)
+            with self._lock:
+                self._shown[key] = summary
+
+        now = time.monotonic()
+        for stamp in since:
+            METRICS.observe("exists_to_show_seconds", now - stamp,
+                account=key[0], folder=key[1])
+
+COALESCER = Coalescer()
+SCHEDULER = notiflib.Scheduler()
+
+def close_mailboxes(timeout=SHUTDOWN_TIMEOUT, mailboxes=None, sessions=None):
+    # close mailboxes and sessions in parallel, all of them by default;
+    # mailboxes still open after timeout seconds have their socket shut
+    # down
+    deadline = time.monotonic() + timeout
+    closing = []
+    if mailboxes is None:
+        mailboxes = list(MAILBOXES)
+    if sessions is None:
+        sessions = list(SESSIONS)
+
+    def run(func, done):
+        try: func()
+        except: pass
+        done.set()
+
+    for m in mailboxes:
+        if m.status & notiflib.IMAP_Mailbox.CLOSED > 0:
+            continue
         if VERBOSE:
             log.info("{} - {}: closing thread.".format(
                 m._account.name,
                 m.name))
-        if m.status & notiflib.IMAP_Mailbox.CLOSED > 0:
+        done = Event()
+        try:
+            if ASYNC_LOOP is not None:
+                fut = asyncio.run_coroutine_threadsafe(m.close(), ASYNC_LOOP)
+                fut.add_done_callback(lambda f, done=done: done.set())
+            else:
+                Thread(target=run, args=(m.close, done), daemon=True).start()
+        except:
             continue
+        closing.append((m, done))
+
+    for s in sessions:
+        Thread(target=run, args=(s.close, Event()), daemon=True).start()
+
+    forced = 0
+    for m, done in closing:
+        if done.wait(max(0, deadline - time.monotonic())):
+            continue
+        forced += 1
+        if VERBOSE:
+            log.info("{} - {}: close timed out, dropping connection".format(
+                m._account.name,
+                m.name))
         try:
-            Thread(target=m.close).start()
+            if ASYNC_LOOP is not None:
+                ASYNC_LOOP.call_soon_threadsafe(m.abort)
+            else:
+                m.abort()
         except: pass
+    return forced
 
-    time.sleep(5)
+def close_imap(signum, blah=None):
+    if VERBOSE:
+        log.info("Receiving signal number %d, exiting..." % (signum))
+
+    global SYS_EXIT
+    SYS_EXIT = True
+
+    if GLib is not None and GLib.MainLoop().is_running():
+        GLib.MainLoop().quit()
+
+    SCHEDULER.stop()
+    for event in FOLDER_EVENTS.values():
+        event.set()
+
+    if STARTUP is not None:
+        STARTUP.shutdown(wait=False, cancel_futures=True)
+
+    started = time.monotonic()
+    stop_workers(SHUTDOWN_TIMEOUT)
+    forced = close_mailboxes(SHUTDOWN_TIMEOUT)
+    DISPATCHER.shutdown()
+
+    if VERBOSE:
+        log.info("closed {} mailboxes in {:.0f}ms, {} dropped".format(
+            len(MAILBOXES),
+            (time.monotonic() - started) * 1000,
+            forced))
     sys.exit(0)
 
 def build_config():
+    # raises OSError or configparser.Error when the file can't be read
     l = []
 
     if args.config:
             cfg_file = args.config
     else:   cfg_file = CONFIG_FILE
     cfg = configparser.ConfigParser()
-    try:
-        cfg.read(cfg_file)
-    except:
-        os.stderr.write("Unable to read config file, exiting..\n")
-        sys.exit(1)
+    with open(cfg_file) as f:
+        cfg.read_file(f)
 
     for i in cfg.sections():
         d = {}
@@ -106,6 +520,56 @@ def build_config():
         else:
             d["interval"] = INTERVAL
 
+        if "connections" in d:
+            try:
+                    d["connections"] = int(d["connections"])
+            except: d["connections"] = notiflib.DEFAULT_CONNECTIONS
+        else:
+            d["connections"] = notiflib.DEFAULT_CONNECTIONS
+
+        if "notify" in d:
+            try:
+                    d["notify"] = int(d["notify"]) == 1
+            except: d["notify"] = True
+        else:
+            d["notify"] = True
+
+        for opt, default, conv in (
+                ("debounce", DEBOUNCE, float),
+                ("rate", RATE, float),
+                ("burst", BURST, int)):
+            try:
+                    d[opt] = conv(d.get(opt, default))
+            except: d[opt] = default
+
+        if "cold_interval" in d:
+            try:
+                    d["cold_interval"] = float(d["cold_interval"])
+            except: d["cold_interval"] = COLD_INTERVAL
+        else:
+            d["cold_interval"] = COLD_INTERVAL
+
+        if "fetch_chunk" in d:
+            try:
+                    d["fetch_chunk"] = int(d["fetch_chunk"])
+            except: d["fetch_chunk"] = notiflib.DEFAULT_FETCH_CHUNK
+        else:
+            d["fetch_chunk"] = notiflib.DEFAULT_FETCH_CHUNK
+
+        if "response_cap" in d:
+            try:
+                    d["response_cap"] = int(d["response_cap"])
+            except: d["response_cap"] = notiflib.DEFAULT_RESPONSE_CAP
+        else:
+            d["response_cap"] = notiflib.DEFAULT_RESPONSE_CAP
+
+        if "timeout" in d:
+            try:
+                    d["timeout"] = float(d["timeout"])
+            except: d["timeout"] = notiflib.DEFAULT_CONNECT_TIMEOUT
+        else:
+            d["timeout"] = notiflib.DEFAULT_CONNECT_TIMEOUT
+
         if not "server" in d or d["server"] == "":
             sys.stderr.write("%s will not be checked: " % d["name"])
             sys.stderr.write("server not defined in config file\n")
@@ -169,29 +633,91 @@ def show_notif(num, mbox):
         return
 
     msg = mbox.fetch(num, notiflib.IMAP_Mailbox.FETCH_HEADER)
-    if not isinstance(msg, email.message.Message):
+    notify(num, mbox, msg, mbox.mark_read)
+
+def notify(num, mbox, msg, callback, since=None):
+    if not isinstance(msg, (notiflib.Headers, email.message.Message)):
         return
 
-    email_from = msg["from"].split('<')[0].replace("\"", "")
-    notif_body = html_escape("{}\n\n{}".format(
-        email_from,
-        msg["subject"].replace("\"", "")))
-    notif_summ = html_escape("{}: {}".format(
+    if VERBOSE and STARTUP_TIME is not None and mbox not in FIRST_NOTIF:
+        FIRST_NOTIF.add(mbox)
+        log.info("{} - {}: first notification {:.1f}s after start".format(
+            mbox._account.name,
+            mbox.name,
+            time.monotonic() - STARTUP_TIME))
+
+    if SHARD is not None:
+        send_record(num, mbox, msg, since)
+        return
+
+    COALESCER.submit(num, mbox, msg, callback, since)
+
+def notif_summary(mbox):
+    return html_escape("{}: {}".format(
         mbox._account.name,
         mbox.name.replace("\"", "")))
+
+def show_message(num, mbox, msg, callback):
+    email_from = notiflib.sender_name(str(msg["from"] or ""))
+    notif_body = html_escape("{}\n\n{}".format(
+        email_from,
+        str(msg["subject"] or "").replace("\"", "")))
     notif = Notif(
         body     = notif_body,
-        summary  = notif_summ,
+        summary  = notif_summary(mbox),
         data     = num,
-        callback = mbox.mark_read
+        callback = callback
     ).show()
 
-def idle(mbox):
+def show_summary(records, notif=None):
+    # one notification for a burst, Mark read applies to all of them
+    mbox = records[0][1]
+    lines = []
+    for num, _, msg, _ in records[:SUMMARY_LINES]:
+        lines.append("{}: {}".format(
+            notiflib.sender_name(str(msg["from"] or "")),
+            str(msg["subject"] or "").replace("\"", "")))
+    if len(records) > SUMMARY_LINES:
+        lines.append("...")
+
+    nums = [r[0] for r in records]
+    callbacks = [r[3] for r in records]
+    def mark_read(data):
+        for n, cb in zip(nums, callbacks):
+            cb(n)
+
+    summary = "{} new messages in {}/{}".format(
+        len(records),
+        mbox._account.name,
+        mbox.name.replace("\"", ""))
+    body = html_escape("\n".join(lines))
+    if notif is None:
+        notif = Notif(
+            body     = body,
+            summary  = html_escape(summary),
+            data     = nums,
+            callback = mark_read)
+    else:
+        notif.update(body=body, summary=html_escape(summary), data=nums,
+            callback=mark_read)
+    notif.show()
+    return notif
+
+def idle(mbox, until=None):
+    # idle until the deadline of scheduler key until, if any
     while mbox.status & mbox.IDLE_FAILED == 0:
+        timeout = IDLE_TIMEOUT
+        if until is not None:
+            remaining = SCHEDULER.remaining(until)
+            if remaining is None or remaining <= 0:
+                return
+            timeout = min(timeout, remaining / 60.0)
+
         try:
-            data = mbox.idle()
+            data = mbox.idle(timeout)
         except:
             break
+        seen = time.monotonic()
 
         if data is None:
             if VERBOSE:
@@ -200,74 +726,819 @@ def idle(mbox):
                     mbox.name))
             continue
 
+        if data.startswith('* status'):
+            status = notiflib.parse_status(data)
+            if status is not None:
+                key = (mbox._account.name, folder_key(status[0]))
+                if key in FOLDER_EVENTS:
+                    FOLDER_EVENTS[key].set()
+            continue
+
+        if mbox.status & mbox.RESYNC > 0:
+            if VERBOSE:
+                log.info("{} - {}: response store overflow, resyncing..".format(
+                    mbox._account.name,
+                    mbox.name))
+            mbox.status &= ~mbox.RESYNC
+            poll(mbox, None)
+            CYCLES[mbox] = time.monotonic()
+            continue
+
         if 'exists' in data:
             if VERBOSE:
                 log.info("{} - {}: new message".format(
                     mbox._account.name,
                     mbox.name))
 
-            num = data.split()[1]
-            show_notif(num, mbox)
+            # EXISTS carries a sequence number, ask for new UIDs instead
+            poll(mbox, None, seen)
+            CYCLES[mbox] = time.monotonic()
 
     if VERBOSE:
         log.info("{} - {}: idle failed".format(
             mbox._account.name,
             mbox.name))
 
-def poll(mbox, interval):
+def poll(mbox, interval, since=None):
     nums = mbox.poll()
-    if nums is not None:
-        for num in nums:
-            show_notif(num.decode('utf-8'), mbox)
+    if nums is not None and len(nums) > 0:
+        for num, msg in mbox.fetch_many(nums):
+            notify(num, mbox, msg, mbox.mark_read, since)
 
-def loop(mbox, interval=INTERVAL):
-    while 1:
-        if SYS_EXIT:
+def folder_key(name):
+    return name.strip().strip('"').lower()
+
+def notify_loop(mbox, event, interval=INTERVAL):
+    # folder watched through the NOTIFY connection of a sibling mailbox,
+    # it only borrows a connection from the account session when the
+    # server reports a change, or every interval minutes as a fallback
+    while running(mbox):
+        event.wait(interval * 60)
+        event.clear()
+        if not running(mbox):
             break
 
         if VERBOSE:
-            log.info("{} - {}: initiating connection".format(
+            log.info("{} - {}: change notified, polling server..".format(
                 mbox._account.name,
                 mbox.name))
+        try:
+            with mbox.borrow():
+                poll(mbox, interval)
+        except:
+            if VERBOSE:
+                log.info("{} - {}: network error, waiting..".format(
+                    mbox._account.name,
+                    mbox.name))
+
+def log_session(mbox):
+    session = mbox._session
+    log.info("{}: {} connections, {} logins in the last hour".format(
+        mbox._account.name,
+        session.connections(),
+        session.logins_per_hour()))
+
+    ratio = session.compression()
+    if ratio is not None:
+        t = session.traffic
+        log.info("{}: {} KiB on wire for {} KiB of IMAP, ratio {:.2f}".format(
+            mbox._account.name,
+            (t['wire_in'] + t['wire_out']) // 1024,
+            (t['data_in'] + t['data_out']) // 1024,
+            ratio))
+
+    tls = session.tls
+    resumed = tls.resumed()
+    if resumed is not None:
+        log.info("{}: {} handshakes, {:.0%} resumed, full {:.1f} ms, "
+            "resumed {:.1f} ms, connect p90 {} ms".format(
+            mbox._account.name,
+            tls.handshake_full.count + tls.handshake_resumed.count,
+            resumed,
+            (tls.handshake_full.mean() or 0) * 1000,
+            (tls.handshake_resumed.mean() or 0) * 1000,
+            tls.connect_latency.percentile(90) * 1000))
+
+def running(mbox):
+    return not SYS_EXIT and mbox not in STOPPED
+
+def poll_key(mbox):
+    return (mbox, 'poll')
+
+def reconnect_key(mbox):
+    return (mbox, 'reconnect')
+
+def retry(mbox, backoff, opened, what):
+    # wait before reconnecting. A connection that lasted BACKOFF_STABLE
+    # seconds or got through an idle and poll cycle starts over from the
+    # shortest delay, one that fails right after login keeps growing it
+    if opened is not None and (time.monotonic() - opened >= BACKOFF_STABLE
+            or CYCLES.get(mbox, 0) > opened):
+        backoff.reset()
+    delay = backoff.next()
+    if VERBOSE:
+        log.info("{} - {}: {}, reconnecting in {:.1f}s..".format(
+            mbox._account.name,
+            mbox.name,
+            what,
+            delay))
+    SCHEDULER.wait(reconnect_key(mbox), delay)
+    mbox.status |= notiflib.IMAP_Mailbox.CLOSED
 
+def loop(mbox, interval=INTERVAL):
+    # poll deadlines and reconnect delays come from SCHEDULER, idle
+    # runs until the next poll is due
+    backoff = notiflib.Backoff(BACKOFF_BASE, BACKOFF_MAX)
+    opened = None
+    while running(mbox):
         if mbox.status & notiflib.IMAP_Mailbox.CLOSED > 0:
+            if VERBOSE:
+                log.info("{} - {}: initiating connection".format(
+                    mbox._account.name,
+                    mbox.name))
+            METRICS.inc("reconnects_total", account=mbox._account.name,
+                folder=mbox.name)
+            try: opened = mbox.open()
+            except: opened = False
+
+            if not opened:
+                if not running(mbox):
+                    break
+                delay = backoff.next()
+                if VERBOSE:
+                    log.info("{} - {}: network error, retrying in {:.1f}s..".format(
+                        mbox._account.name,
+                        mbox.name,
+                        delay))
+                SCHEDULER.wait(reconnect_key(mbox), delay)
+                continue
+
+            opened = time.monotonic()
+            SCHEDULER.cancel(poll_key(mbox))
+            if VERBOSE:
+                log_session(mbox)
+
+        remaining = SCHEDULER.remaining(poll_key(mbox))
+        if remaining is None or remaining <= 0:
+            if VERBOSE:
+                log.info("{} - {}: polling server..".format(
+                    mbox._account.name,
+                    mbox.name))
+            try: poll(mbox, interval)
+            except:
+                mbox.status |= notiflib.IMAP_Mailbox.CLOSED
+                if running(mbox):
+                    retry(mbox, backoff, opened, "poll failed")
+                continue
+            SCHEDULER.schedule(poll_key(mbox), interval * 60)
+
+        if 'IDLE' in mbox._imap.capabilities:
+            if VERBOSE:
+                log.info("{} - {}: trying imap idle..".format(
+                    mbox._account.name,
+                    mbox.name))
+            try: idle(mbox, poll_key(mbox))
+            except: pass
+
+            if mbox.status & (mbox.IDLE_FAILED | mbox.CLOSED) > 0:
+                if not running(mbox):
+                    break
+                retry(mbox, backoff, opened, "idle failed")
+            else:
+                # a whole idle cycle went through, the server is fine
+                backoff.reset()
+        else:
+            SCHEDULER.wait(poll_key(mbox))
+            backoff.reset()
+
+    if VERBOSE:
+        log.info("{} - {}: thread exited..".format(
+            mbox._account.name,
+            mbox.name))
+
+def cold_loop(session, mailboxes, account):
+    # cold folders share one STATUS check, a folder is only selected and
+    # polled, on a borrowed connection, when its UIDNEXT moved
+    by_name = dict((m.name, m) for m in mailboxes)
+    known = dict((m.name, m._state.load().uidnext) for m in mailboxes)
+    poller = notiflib.StatusPoller(session, list(by_name), known=known)
+    backoff = notiflib.Backoff(BACKOFF_BASE, BACKOFF_MAX)
+    first = mailboxes[0]
+    while running(first):
+        try:
+            changed = poller.check()
+            backoff.reset()
+            delay = account["cold_interval"]
+        except:
+            changed = []
+            delay = backoff.next()
+            if VERBOSE:
+                log.info("{}: status of {} cold folders failed, retrying "
+                    "in {:.1f}s..".format(account["name"], len(mailboxes),
+                    delay))
+
+        for name in changed:
+            mbox = by_name[name]
+            if not running(mbox):
+                continue
+            if VERBOSE:
+                log.info("{} - {}: {} unseen, polling server..".format(
+                    mbox._account.name,
+                    mbox.name,
+                    poller.status[name].get("unseen")))
             try:
-                if not mbox.open():
-                    time.sleep(60 - time.localtime().tm_sec)
-                    continue
+                with mbox.borrow():
+                    poll(mbox, account["interval"])
             except:
+                poller.forget(name)
                 if VERBOSE:
                     log.info("{} - {}: network error, waiting..".format(
                         mbox._account.name,
                         mbox.name))
-                time.sleep(60 - time.localtime().tm_sec)
+
+        SCHEDULER.wait(poll_key(first), delay)
+
+    if VERBOSE:
+        log.info("{}: cold folders thread exited..".format(account["name"]))
+
+def open_mailbox(mbox, interval):
+    # first connection and poll of a mailbox on startup
+    if not running(mbox):
+        return
+    try:
+        if mbox.open():
+            poll(mbox, interval)
+            SCHEDULER.schedule(poll_key(mbox), interval * 60)
+    except: pass
+
+    if VERBOSE:
+        log.info("{} - {}: {} {:.1f}s after start".format(
+            mbox._account.name,
+            mbox.name,
+            "failed to connect" if mbox.status & mbox.CLOSED > 0 else "ready",
+            time.monotonic() - STARTUP_TIME))
+
+def start_mailbox(mbox, interval):
+    if not running(mbox):
+        return
+    open_mailbox(mbox, interval)
+    Thread(target=loop, args=(mbox, interval), daemon=True).start()
+
+def start_account(mailboxes, watch, interval, startup):
+    # the first folder opens first, it decides whether NOTIFY watches
+    # the others; the rest are opened by the startup pool
+    first = mailboxes[0]
+    open_mailbox(first, interval)
+
+    watching = watch is not None and first.notify_active
+    for mbox in mailboxes[1:]:
+        if watching:
+            event = Event()
+            event.set()
+            FOLDER_EVENTS[(mbox._account.name, folder_key(mbox.name))] = event
+            Thread(target=notify_loop, args=(mbox, event, interval),
+                daemon=True).start()
+        else:
+            mbox.notify = []
+            startup.submit(start_mailbox, mbox, interval)
+
+    Thread(target=loop, args=(first, interval), daemon=True).start()
+
+def make_account(account):
+    a = notiflib.Account()
+    a.server   = account["server"]
+    a.username = account["username"]
+    a.password = account["password"]
+    a.name     = account["name"]
+    a.timeout  = account["timeout"]
+
+    if 'ssl' in account and int(account['ssl']) == 1:
+        a.ssl  = True
+
+    if 'compress' in account and int(account['compress']) == 1:
+        a.compress = True
+
+    if 'port' in account:
+        a.port = int(account['port'])
+
+    if account.get('capture'):
+        a.capture = os.path.expanduser(account['capture'])
+
+    COALESCER.configure(a.name, account["debounce"], account["rate"],
+        account["burst"])
+    return a
+
+def folder_names(account):
+    return account.get("mailboxes", DEFAULT_MAILBOX).split(",")
+
+def cold_names(account):
+    return [m for m in (account.get("cold") or "").split(",") if m.strip()]
+
+def new_mailbox(account, a, session, name, watch):
+    return notiflib.IMAP_Mailbox(a, name=name, session=session,
+        notify=watch, response_cap=account["response_cap"],
+        fetch_chunk=account["fetch_chunk"], state_dir=STATE_DIR)
+
+def add_account(account):
+    # start every mailbox of a config section, in threaded mode
+    a = make_account(account)
+    session = notiflib.Session(a,
+        max_connections=account["connections"])
+    SESSIONS.append(session)
+
+    # with NOTIFY the first folder watches all others over its own
+    # connection, they only connect when something changed
+    names = folder_names(account)
+    watch = None
+    if account["notify"] and len(names) > 1:
+        watch = names
+
+    mailboxes = [new_mailbox(account, a, session, m, watch) for m in names]
+    cold = [new_mailbox(account, a, session, m, None)
+        for m in cold_names(account)]
+    MAILBOXES.extend(mailboxes + cold)
+    RUNNING[a.name] = {
+        "config":    account,
+        "account":   a,
+        "session":   session,
+        "watch":     watch,
+        "mailboxes": mailboxes,
+        "cold":      cold,
+    }
+    # every mailbox starts serving as soon as it is connected, a slow
+    # server only holds up its own account
+    STARTUP.submit(start_account, mailboxes, watch, account["interval"],
+        STARTUP)
+    if len(cold) > 0:
+        Thread(target=cold_loop, args=(session, cold, account),
+            daemon=True).start()
+
+def stop_mailboxes(mailboxes):
+    for mbox in mailboxes:
+        STOPPED.add(mbox)
+        CYCLES.pop(mbox, None)
+        FIRST_NOTIF.discard(mbox)
+        # release loop() and notify_loop() from their waits
+        SCHEDULER.schedule(poll_key(mbox), 0)
+        SCHEDULER.schedule(reconnect_key(mbox), 0)
+        event = FOLDER_EVENTS.pop(
+            (mbox._account.name, folder_key(mbox.name)), None)
+        if event is not None:
+            event.set()
+        try:
+            MAILBOXES.remove(mbox)
+        except ValueError: pass
+    close_mailboxes(SHUTDOWN_TIMEOUT, mailboxes, [])
+
+def remove_account(name):
+    entry = RUNNING.pop(name)
+    stop_mailboxes(entry["mailboxes"] + entry["cold"])
+    try:
+        SESSIONS.remove(entry["session"])
+    except ValueError: pass
+    close_mailboxes(SHUTDOWN_TIMEOUT, [], [entry["session"]])
+
+def reconfigure_account(entry, account):
+    # same server and login: keep connections, restart only mailboxes
+    # which were removed, added or have new settings
+    old = entry["config"]
+    a = entry["account"]
+    COALESCER.configure(a.name, account["debounce"], account["rate"],
+        account["burst"])
+
+    names = folder_names(account)
+    changed = any(old.get(k) != account.get(k) for k in MAILBOX_KEYS)
+    keep = []
+    stop = []
+    for mbox in entry["mailboxes"]:
+        if mbox.name in names and not changed:
+            keep.append(mbox)
+        else:
+            stop.append(mbox)
+    stop_mailboxes(stop)
+
+    kept = [m.name for m in keep]
+    started = [new_mailbox(account, a, entry["session"], m, None)
+        for m in names if m not in kept]
+    MAILBOXES.extend(started)
+    for mbox in started:
+        STARTUP.submit(start_mailbox, mbox, account["interval"])
+
+    entry["mailboxes"] = keep + started
+    entry["config"] = account
+    if VERBOSE:
+        log.info("{}: {} mailboxes kept, {} stopped, {} started".format(
+            a.name, len(keep), len(stop), len(started)))
+
+def reload_config():
+    # diff notif.cfg against running accounts, untouched mailboxes stay
+    # connected and idling
+    with RELOAD_LOCK:
+        try:
+            accounts = shard_accounts(build_config())
+        except (configparser.Error, OSError) as e:
+            log.info("Unable to read config file, keeping current "
+                "configuration: {}".format(e))
+            return
+        if len(accounts) == 0:
+            log.info("No accounts defined, keeping current configuration")
+            return
+
+        new = dict((d["name"], d) for d in accounts)
+        for name in list(RUNNING):
+            if name not in new:
+                if VERBOSE:
+                    log.info("{}: removed from config, stopping".format(name))
+                remove_account(name)
+
+        for name, account in new.items():
+            entry = RUNNING.get(name)
+            if entry is None:
+                if VERBOSE:
+                    log.info("{}: added to config, starting".format(name))
+                add_account(account)
+                continue
+
+            old = entry["config"]
+            if old == account:
                 continue
 
+            # NOTIFY ties folders of an account to one connection
+            restart = any(old.get(k) != account.get(k) for k in ACCOUNT_KEYS)
+            if entry["watch"] is not None:
+                restart = restart or folder_names(old) != folder_names(account) \
+                    or any(old.get(k) != account.get(k) for k in MAILBOX_KEYS)
+            if restart:
+                if VERBOSE:
+                    log.info("{}: account settings changed, restarting".format(
+                        name))
+                remove_account(name)
+                add_account(account)
+            else:
+                reconfigure_account(entry, account)
+
+def reload_imap(signum):
+    if VERBOSE:
+        log.info("Receiving signal number %d, reloading config..." % (signum))
+    if ASYNC_LOOP is not None:
+        log.info("Config reload is not supported in async mode")
+        return True
+    if len(WORKERS) > 0:
+        Thread(target=reload_workers, daemon=True).start()
+        return True
+    Thread(target=reload_config, daemon=True).start()
+    return True
+
+def shard_accounts(accounts):
+    # accounts served by this process, the hash keeps an account on the
+    # same worker across restarts and reloads
+    if SHARD is None:
+        return accounts
+    index, count = SHARD
+    return [d for d in accounts if int(hashlib.sha1(
+        d["name"].encode('utf-8')).hexdigest(), 16) % count == index]
+
+def send_record(num, mbox, msg, since=None):
+    # worker side: hand new message to the supervisor, one JSON line each
+    def header(name):
+        return " ".join(str(msg[name] or "").split())
+
+    rec = {
+        "account": mbox._account.name,
+        "folder":  mbox.name,
+        "num":     num,
+        "from":    header("from"),
+        "subject": header("subject"),
+    }
+    if since is not None:
+        # clocks differ between processes, send an age instead
+        rec["age"] = time.monotonic() - since
+    line = json.dumps(rec) + "\n"
+    with SHARD_LOCK:
+        try:
+            SHARD_OUT.write(line)
+            SHARD_OUT.flush()
+        except Exception: pass
+
+def worker_commands():
+    # worker side: mark_read requests from the supervisor, the worker
+    # exits when the supervisor goes away
+    for line in sys.stdin:
+        try:
+            cmd = json.loads(line)
+        except ValueError:
+            continue
+        if cmd.get("op") != "seen":
+            continue
+        entry = RUNNING.get(cmd.get("account"))
+        if entry is None:
+            continue
+        # cold folders are parked, mark_read borrows a connection
+        for mbox in entry["mailboxes"] + entry["cold"]:
+            if mbox.name == cmd.get("folder"):
+                mbox.mark_read(cmd.get("num"))
+    os.kill(os.getpid(), signal.SIGTERM)
+
+class RemoteMailbox:
+    # supervisor side stand-in for a mailbox living in a worker, enough
+    # for Coalescer and show_message
+    def __init__(self, worker, account, name):
+        self._worker  = worker
+        self._account = notiflib.Account(name=account)
+        self.name     = name
+
+    def mark_read(self, num):
+        self._worker.send({
+            "op":      "seen",
+            "account": self._account.name,
+            "folder":  self.name,
+            "num":     num,
+        })
+
+class Worker:
+    """
+    Supervisor side of a worker process serving one shard of accounts
+
+    The worker runs notif.py with --shard and writes a JSON line per new
+    message on its stdout, mark_read requests go back on its stdin. A
+    worker that dies is started again with the same shard.
+    """
+
+    def __init__(self, index, count, argv):
+        self.index    = index
+        self.count    = count
+        self.restarts = 0
+        self._argv    = argv
+        self._proc    = None
+        self._lock    = Lock()
+        self._mboxes  = {}
+
+    def start(self):
+        Thread(target=self._run, daemon=True).start()
 
-        tm_min = time.localtime().tm_min
-        if tm_min % interval == 0:
+    def send(self, cmd):
+        with self._lock:
+            try:
+                self._proc.stdin.write(json.dumps(cmd) + "\n")
+                self._proc.stdin.flush()
+            except Exception: pass
+
+    def signal(self, signum):
+        try:
+            self._proc.send_signal(signum)
+        except Exception: pass
+
+    def stop(self, timeout):
+        # wait for a worker told to exit, returns False if it had to be
+        # killed
+        if self._proc is None:
+            return True
+        try:
+            self._proc.wait(timeout)
+            return True
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            return False
+
+    def _spawn(self):
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__),
+            "--shard", "{}/{}".format(self.index, self.count)] + self._argv,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True, bufsize=1)
+
+    def _run(self):
+        backoff = notiflib.Backoff(BACKOFF_BASE, BACKOFF_MAX)
+        while not SYS_EXIT:
+            started = time.monotonic()
+            with self._lock:
+                self._proc = self._spawn()
+            for line in self._proc.stdout:
+                try:
+                    self._record(json.loads(line))
+                except Exception: pass
+            code = self._proc.wait()
+            if SYS_EXIT:
+                break
+
+            if time.monotonic() - started > BACKOFF_MAX:
+                backoff.reset()
+            delay = backoff.next()
+            self.restarts += 1
             if VERBOSE:
-                log.info("{} - {}: polling server..".format(
+                log.info("worker {}/{} exited with {}, restarting in "
+                    "{:.1f}s..".format(self.index, self.count, code, delay))
+            time.sleep(delay)
+
+    def _record(self, rec):
+        key = (rec["account"], rec["folder"])
+        mbox = self._mboxes.get(key)
+        if mbox is None:
+            mbox = self._mboxes[key] = RemoteMailbox(self, *key)
+        msg = notiflib.Headers({"from": rec["from"],
+            "subject": rec["subject"]})
+        since = None
+        if "age" in rec:
+            since = time.monotonic() - rec["age"]
+        notify(rec["num"], mbox, msg, mbox.mark_read, since)
+
+def start_workers(accounts, count, argv):
+    for account in accounts:
+        COALESCER.configure(account["name"], account["debounce"],
+            account["rate"], account["burst"])
+    for i in range(count):
+        worker = Worker(i, count, argv)
+        WORKERS.append(worker)
+        worker.start()
+
+def stop_workers(timeout):
+    # workers close their own mailboxes on SIGTERM
+    for worker in WORKERS:
+        worker.signal(signal.SIGTERM)
+    deadline = time.monotonic() + timeout
+    for worker in WORKERS:
+        worker.stop(max(0, deadline - time.monotonic()))
+
+def reload_workers():
+    # supervisor: new rate settings apply here, workers diff their shard
+    try:
+        accounts = build_config()
+    except (configparser.Error, OSError) as e:
+        log.info("Unable to read config file: {}".format(e))
+        accounts = []
+    for account in accounts:
+        COALESCER.configure(account["name"], account["debounce"],
+            account["rate"], account["burst"])
+    for worker in WORKERS:
+        worker.signal(signal.SIGHUP)
+
+def run_worker(accounts):
+    # worker process: serve one shard of accounts without GLib, new
+    # messages go to the supervisor through stdout
+    global SHARD_OUT
+    SHARD_OUT = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    devnull = os.open(DEVNULL, os.O_RDWR)
+    os.dup2(devnull, sys.stdout.fileno())
+
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_imap(signum))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: dump_metrics(signum))
+    if args.metrics:
+        serve_metrics(shard_address(args.metrics, SHARD[0]))
+    SCHEDULER.start()
+    for account in accounts:
+        add_account(account)
+    Thread(target=worker_commands, daemon=True).start()
+    while True:
+        signal.pause()
+
+async def aidle(mbox, until=None):
+    # idle until monotonic deadline until, if any
+    while mbox.status & mbox.IDLE_FAILED == 0:
+        timeout = IDLE_TIMEOUT
+        if until is not None:
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                return
+            timeout = min(timeout, remaining / 60.0)
+
+        try:
+            data = await mbox.idle(timeout)
+        except:
+            break
+        seen = time.monotonic()
+
+        if data is None:
+            if VERBOSE:
+                log.info("{} - {}: idle ended, retrying..".format(
                     mbox._account.name,
                     mbox.name))
-            poll(mbox, interval)
+            continue
 
-        if 'IDLE' in mbox._imap.capabilities:
+        if mbox.status & mbox.RESYNC > 0:
+            mbox.status &= ~mbox.RESYNC
+            await apoll(mbox, None)
+            continue
+
+        if 'exists' in data:
             if VERBOSE:
-                log.info("{} - {}: trying imap idle..".format(
+                log.info("{} - {}: new message".format(
                     mbox._account.name,
                     mbox.name))
-            try: idle(mbox)
+
+            # EXISTS carries a sequence number, ask for new UIDs instead
+            await apoll(mbox, None, seen)
+
+    if VERBOSE:
+        log.info("{} - {}: idle failed".format(
+            mbox._account.name,
+            mbox.name))
+
+async def apoll(mbox, interval, since=None):
+    nums = await mbox.poll()
+    if nums is None or len(nums) == 0:
+        return
+
+    def mark_read(n):
+        asyncio.run_coroutine_threadsafe(mbox.mark_read(n), ASYNC_LOOP)
+
+    async for num, msg in mbox.fetch_many(nums):
+        notify(num, mbox, msg, mark_read, since)
+
+async def aloop(mbox, interval=INTERVAL):
+    # same as loop() for AsyncIMAPMailbox, every mailbox runs as a task
+    # on the shared event loop so deadlines are plain sleeps
+    backoff = notiflib.Backoff(BACKOFF_BASE, BACKOFF_MAX)
+    next_poll = 0
+    while not SYS_EXIT:
+        if mbox.status & notiflib.AsyncIMAPMailbox.CLOSED > 0:
+            if VERBOSE:
+                log.info("{} - {}: initiating connection".format(
+                    mbox._account.name,
+                    mbox.name))
+            try: opened = await mbox.open()
+            except: opened = False
+
+            if not opened:
+                delay = backoff.next()
+                if VERBOSE:
+                    log.info("{} - {}: network error, retrying in {:.1f}s..".format(
+                        mbox._account.name,
+                        mbox.name,
+                        delay))
+                await asyncio.sleep(delay)
+                continue
+
+            backoff.reset()
+            next_poll = 0
+
+        if time.monotonic() >= next_poll:
+            try: await apoll(mbox, interval)
             except:
+                mbox.status |= notiflib.AsyncIMAPMailbox.CLOSED
                 continue
-            time.sleep(1)
+            next_poll = time.monotonic() + interval * 60
+
+        if 'IDLE' in mbox.capabilities:
+            try: await aidle(mbox, next_poll)
+            except: pass
+
+            if mbox.status & (mbox.IDLE_FAILED | mbox.CLOSED) > 0:
+                await asyncio.sleep(backoff.next())
+                mbox.status |= notiflib.AsyncIMAPMailbox.CLOSED
         else:
-            time.sleep(60 - time.localtime().tm_sec)
+            await asyncio.sleep(max(0, next_poll - time.monotonic()))
+
+async def astart(mbox, interval, startup):
+    # first connection limited by startup semaphore, aloop takes over
+    async with startup:
+        try: await mbox.open()
+        except: pass
 
     if VERBOSE:
-        log.info("{} - {}: thread exited..".format(
+        log.info("{} - {}: {} {:.1f}s after start".format(
             mbox._account.name,
-            mbox.name))
+            mbox.name,
+            "failed to connect" if mbox.status & mbox.CLOSED > 0 else "ready",
+            time.monotonic() - STARTUP_TIME))
+    await aloop(mbox, interval)
+
+def run_async(mailboxes, workers=STARTUP_WORKERS):
+    # run every (mailbox, interval) on one event loop, meant to be the
+    # target of a thread next to the GLib main loop
+    global ASYNC_LOOP
+    ASYNC_LOOP = asyncio.new_event_loop()
+    asyncio.set_event_loop(ASYNC_LOOP)
+    startup = asyncio.Semaphore(workers)
+    ASYNC_LOOP.run_until_complete(asyncio.gather(
+        *[astart(m, i, startup) for m, i in mailboxes]))
+
+def load_gi():
+    # GObject introspection takes a while to load, only import it once
+    # options are parsed and we know we are going to run
+    global Notify, GLib
+    import gi
+    gi.require_version('Notify', '0.7')
+    from gi.repository import Notify, GLib
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="IMAP Desktop Notification")
+    parser.add_argument("-c", "--config", help="configuration file")
+    parser.add_argument("-u", "--user", help="Run daemon as user")
+    parser.add_argument("-a", "--async", dest="use_async", action="store_true",
+        help="Run all mailboxes on one asyncio event loop instead of threads")
+    parser.add_argument("-t", "--shutdown-timeout", type=float,
+        default=SHUTDOWN_TIMEOUT,
+        help="seconds to close connections on exit, default %d"
+            % SHUTDOWN_TIMEOUT)
+    parser.add_argument("-w", "--workers", type=int, default=0,
+        help="shard accounts across this many worker processes")
+    parser.add_argument("--shard", help=argparse.SUPPRESS)
+    parser.add_argument("-m", "--metrics",
+        help="serve metrics over HTTP on [host:]port, or on a Unix socket "
+            "when given a path; workers use the next ports or path.N")
+    parser.add_argument("-j", "--jobs", type=int, default=STARTUP_WORKERS,
+        help="mailboxes connecting at the same time on startup, default %d"
+            % STARTUP_WORKERS)
+    return parser.parse_args()
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
@@ -275,58 +1546,78 @@ handler = logging.handlers.SysLogHandler(address = DEVLOG)
 handler.setFormatter(logging.Formatter('%(module)s: %(message)s'))
 log.addHandler(handler)
 
-parser = argparse.ArgumentParser(description="IMAP Desktop Notification")
-parser.add_argument("-c", "--config", help="configuration file")
-parser.add_argument("-u", "--user", help="Run daemon as user")
-args = parser.parse_args()
+uid = DEFAULT_UID
 
-if args.user:
+if __name__ == '__main__':
+    STARTUP_TIME = time.monotonic()
+    args = parse_args()
+    # daemonize() changes to /, workers and reloads need the same file
+    if args.config:
+        args.config = os.path.abspath(args.config)
+    SHUTDOWN_TIMEOUT = args.shutdown_timeout
+    if args.user:
         try:    uid = getpwnam(args.user).pw_uid
         except: pass
-else:   uid = DEFAULT_UID
 
-signal.signal(signal.SIGTERM, close_imap)
-signal.signal(signal.SIGINT, close_imap)
+    if args.shard:
+        SHARD = tuple(int(n) for n in args.shard.split("/"))
 
-if __name__ == '__main__':
-    accounts = build_config()
+    try:
+        accounts = build_config()
+    except (configparser.Error, OSError) as e:
+        sys.stderr.write("Unable to read config file, exiting: %s\n" % e)
+        sys.exit(1)
     if len(accounts) == 0:
         sys.stderr.write("No accounts defined, exiting..\n")
         sys.exit(1)
 
+    signal.signal(signal.SIGTERM, close_imap)
+    signal.signal(signal.SIGINT, close_imap)
+    STARTUP = ThreadPoolExecutor(max_workers=max(1, args.jobs))
+
+    if SHARD is not None:
+        run_worker(shard_accounts(accounts))
+
     daemonize()
+    load_gi()
     Notify.init("imapnotif")
 
-    for account in accounts:
-        a = notiflib.Account()
-        a.server   = account["server"]
-        a.username = account["username"]
-        a.password = account["password"]
-        a.name     = account["name"]
-
-        if 'ssl' in account and int(account['ssl']) == 1:
-            a.ssl  = True
+    async_mailboxes = []
+    SCHEDULER.start()
+    if args.metrics:
+        serve_metrics(args.metrics)
 
-        i = INTERVAL
-        if 'interval' in account:
-            i = account['interval']
+    if args.workers > 0:
+        # this process only shows notifications
+        argv = ["-c", args.config or CONFIG_FILE, "-j", str(args.jobs),
+            "-t", str(SHUTDOWN_TIMEOUT)]
+        if args.metrics:
+            argv += ["-m", args.metrics]
+        start_workers(accounts, args.workers, argv)
+        accounts = []
 
-        if not 'mailboxes' in account:
-            account['mailboxes'] = DEFAULT_MAILBOX
+    for account in accounts:
+        if not args.use_async:
+            add_account(account)
+            continue
 
-        for m in account["mailboxes"].split(","):
-            mbox = notiflib.IMAP_Mailbox(a, name=m)
+        # cold folders idle like the others, they are cheap in async mode
+        a = make_account(account)
+        for m in folder_names(account) + cold_names(account):
+            mbox = notiflib.AsyncIMAPMailbox(a, name=m,
+                response_cap=account["response_cap"],
+                fetch_chunk=account["fetch_chunk"], state_dir=STATE_DIR)
             MAILBOXES.append(mbox)
+            async_mailboxes.append((mbox, account["interval"]))
 
-            try:
-                if mbox.open():
-                    poll(mbox, i)
-            except: pass
-
-    for M in MAILBOXES:
-        Thread(target=loop, args=(M,)).start()
+    if args.use_async:
+        Thread(target=run_async,
+            args=(async_mailboxes, max(1, args.jobs)), daemon=True).start()
 
+    GLib.timeout_add_seconds(STATS_INTERVAL, log_dispatch_stats)
     GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGINT, close_imap, signal.SIGINT)
     GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, close_imap, signal.SIGTERM)
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGHUP, reload_imap, signal.SIGHUP)
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGUSR2, dump_metrics, signal.SIGUSR2)
     try: GLib.MainLoop().run()
     except: pass
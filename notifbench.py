@@ -0,0 +1,1785 @@
+#!/usr/bin/env python3
+
+'''
+Micro benchmarks for notiflib.
+
+Run all benchmarks with `notifbench.py` or pick some with
+`notifbench.py lock ...`. `notifbench.py check` only runs the
+deterministic checks of Scheduler, Backoff, idle wakeups and mark_read
+during IDLE, and exits with an error when one fails.
+
+The e2e_* benchmarks run notif.py itself, with stub Notify and GLib,
+against FakeIMAPServer with injected latency, bandwidth and faults.
+Save results with --json and check a later run against them with
+--compare, e.g.
+
+    notifbench.py e2e_latency e2e_burst --json before.json
+    notifbench.py e2e_latency e2e_burst --compare before.json
+
+The replay benchmark feeds captures recorded with the capture account
+option back through IMAP_Mailbox, e.g.
+
+    notifbench.py replay --capture ~/imap-captures/Work-*.imap.jsonl --speed 10
+'''
+
+import argparse
+import asyncio
+import base64
+import email
+import email.policy
+import json
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+import notiflib
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    k = int(round((len(values) - 1) * p / 100.0))
+    return values[k]
+
+RESULTS = []    # every report, written by --json
+
+def report(name, **kwargs):
+    fields = " ".join("{}={}".format(k, v) for k, v in kwargs.items())
+    print("{:<12} {}".format(name, fields))
+    sys.stdout.flush()
+    RESULTS.append(dict([('bench', name)] +
+        [(k, _number(v)) for k, v in kwargs.items()]))
+
+def _number(value):
+    # fields are formatted for the terminal, keep numbers as numbers
+    if not isinstance(value, str):
+        return value
+    for conv in (int, float):
+        try:
+            return conv(value)
+        except ValueError:
+            pass
+    return value
+
+class FakeIMAPServer:
+    """
+    Minimal scriptable IMAP server for benchmarks
+
+    Serves a single folder holding `messages` unread messages to any
+    number of clients. Every command is answered after `rtt` seconds,
+    replies are sent at most `bandwidth` bytes per second when set.
+    deliver() adds messages and reports them to idling clients.
+
+    faults maps a kind of fault to the share of commands it hits:
+    'drop' closes the connection, 'fail' answers NO and 'stall' holds
+    the reply for `stall` more seconds.
+    """
+    HEADER = (b'From: "Bench Sender" <bench@example.com>\r\n'
+        b'Date: Mon, 1 Jan 2024 10:00:00 +0000\r\n'
+        b'Subject: benchmark message\r\n\r\n')
+
+    def __init__(self, **kwargs):
+        self.host     = kwargs.get('host', '127.0.0.1')
+        self.port     = kwargs.get('port', 0)
+        self.rtt      = kwargs.get('rtt', 0.0)
+        self.messages = kwargs.get('messages', 0)
+        self.caps     = kwargs.get('caps', 'IMAP4rev1 IDLE')
+        self.headers  = kwargs.get('headers') or [self.HEADER]
+        self.ssl      = kwargs.get('ssl')
+        self.bandwidth = kwargs.get('bandwidth', 0)
+        self.faults   = kwargs.get('faults') or {}
+        self.stall    = kwargs.get('stall', 1.0)
+        self.injected = dict.fromkeys(('drop', 'fail', 'stall'), 0)
+        self.clients  = 0
+        self._server  = None
+        self._loop    = None
+        self._idlers  = {}    # writer -> messages the client knows of
+        self._rand    = random.Random(kwargs.get('seed', 1))
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._client,
+            self.host, self.port, limit=1 << 20, backlog=1024, ssl=self.ssl)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    def start_thread(self):
+        # run the server on its own event loop in a daemon thread
+        started = threading.Event()
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start())
+            started.set()
+            loop.run_forever()
+
+        Thread(target=run, daemon=True).start()
+        started.wait()
+        return self.port
+
+    def deliver(self, count=1):
+        """
+        Add count unread messages and send EXISTS to idling clients, safe
+        to call from any thread.
+
+        Returns:
+            list: UIDs of the new messages
+        """
+        first = self.messages + 1
+        self.messages += count
+        self._loop.call_soon_threadsafe(self._announce, self.messages)
+        return [str(uid) for uid in range(first, self.messages + 1)]
+
+    def _announce(self, exists):
+        for writer in list(self._idlers):
+            writer.write(b'* %d EXISTS\r\n' % exists)
+            self._idlers[writer] = exists
+            asyncio.ensure_future(writer.drain())
+
+    def _fault(self):
+        # kind of fault injected in the next command, if any
+        r = self._rand.random()
+        for kind in ('drop', 'fail', 'stall'):
+            rate = self.faults.get(kind, 0)
+            if r < rate:
+                self.injected[kind] += 1
+                return kind
+            r -= rate
+        return None
+
+    async def _client(self, reader, writer):
+        self.clients += 1
+        if self.bandwidth > 0:
+            writer = _Shaper(writer, self.bandwidth)
+        writer.write(b'* OK IMAP4rev1 bench server ready\r\n')
+        known = [self.messages]   # EXISTS last sent to this client
+        try:
+            await writer.drain()
+            while True:
+                # commands already buffered were pipelined behind the
+                # previous one and share its round trip
+                pipelined = _buffered(reader) > 0
+                line = await reader.readline()
+                if len(line) == 0:
+                    break
+                words = line.decode('utf-8', 'replace').split()
+                if len(words) < 2:
+                    continue
+                if self.rtt > 0 and not pipelined:
+                    await asyncio.sleep(self.rtt)
+                fault = self._fault() if self.faults else None
+                if fault == 'drop':
+                    break
+                if fault == 'fail':
+                    writer.write(b'%s NO [UNAVAILABLE] injected failure\r\n'
+                        % words[0].encode())
+                    await writer.drain()
+                    continue
+                if fault == 'stall':
+                    await asyncio.sleep(self.stall)
+                if words[1].upper() == 'COMPRESS' and \
+                        'COMPRESS=DEFLATE' in self.caps:
+                    writer.write(b'%s OK DEFLATE active\r\n'
+                        % words[0].encode())
+                    await writer.drain()
+                    reader = writer = _DeflateStream(reader, writer)
+                    continue
+                if not await self._command(words, reader, writer, known):
+                    break
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def _command(self, words, reader, writer, known):
+        # like a real server, messages delivered while the client was
+        # busy are reported along with its next command
+        tag, cmd = words[0], words[1].upper()
+        uid = cmd == 'UID'
+        if cmd == 'UID' and len(words) > 2:
+            cmd = words[2].upper()
+            words = words[:1] + words[2:]
+
+        if cmd == 'CAPABILITY':
+            writer.write(b'* CAPABILITY %s\r\n' % self.caps.encode())
+        elif cmd == 'LOGIN':
+            writer.write(b'%s OK [CAPABILITY %s] logged in\r\n'
+                % (tag.encode(), self.caps.encode()))
+            return True
+        elif cmd == 'SELECT' or cmd == 'EXAMINE':
+            known[0] = self.messages
+            writer.write(b'* %d EXISTS\r\n* 0 RECENT\r\n'
+                b'* OK [UIDVALIDITY 1] UIDs valid\r\n'
+                b'* OK [UIDNEXT %d] Predicted next UID\r\n'
+                % (self.messages, self.messages + 1))
+            if 'CONDSTORE' in self.caps:
+                # every message gets its own modseq, 10 * UID
+                writer.write(b'* OK [HIGHESTMODSEQ %d] Highest\r\n'
+                    % (self.messages * 10))
+            if 'QRESYNC' in [w.upper().strip('(') for w in words]:
+                since = int(words[-1].strip(')'))
+                for num in range(since // 10 + 1, self.messages + 1):
+                    writer.write(b'* %d FETCH (UID %d FLAGS () MODSEQ (%d))\r\n'
+                        % (num, num, num * 10))
+        elif cmd == 'LIST' and 'RETURN' in words:
+            # LIST-STATUS, patterns are taken as plain folder names
+            patterns = ' '.join(words[3:words.index('RETURN')]).strip('()')
+            for name in patterns.split():
+                writer.write(b'* LIST () "/" %s\r\n' % name.encode())
+                writer.write(b'* STATUS %s (UIDNEXT %d UNSEEN %d)\r\n'
+                    % (name.encode(), self.messages + 1, self.messages))
+        elif cmd == 'ENABLE':
+            writer.write(b'* ENABLED %s\r\n' % ' '.join(words[2:]).encode())
+        elif cmd == 'SEARCH':
+            nums = range(1, self.messages + 1)
+            upper = [w.upper() for w in words]
+            if 'UID' in upper[2:]:
+                nums = [n for n in self._seqset(words[upper.index('UID', 2) + 1])
+                    if n <= self.messages] or nums[-1:]
+            if upper[2] == 'RETURN' and 'ESEARCH' in self.caps:
+                # every message is unseen, MIN MAX COUNT ALL whatever asked
+                found = notiflib.SequenceSet.from_nums(nums)
+                writer.write(b'* ESEARCH (TAG "%s")%s' % (tag.encode(),
+                    b' UID' if uid else b''))
+                if found:
+                    writer.write(b' MIN %d MAX %d COUNT %d ALL %s' % (
+                        found.min(), found.max(), len(found),
+                        str(found).encode()))
+                writer.write(b'\r\n')
+            else:
+                writer.write(b'* SEARCH %s\r\n' % b' '.join(
+                    b'%d' % i for i in nums))
+        elif cmd == 'FETCH':
+            for num in self._seqset(words[2]):
+                header = self.headers[(num - 1) % len(self.headers)]
+                writer.write(b'* %d FETCH (UID %d BODY[HEADER.FIELDS '
+                    b'(FROM DATE SUBJECT)] {%d}\r\n%s)\r\n'
+                    % (num, num, len(header), header))
+        elif cmd == 'STORE':
+            # +FLAGS.SILENT gets no untagged FETCH back (RFC 3501)
+            if not words[3].upper().endswith('.SILENT'):
+                for num in self._seqset(words[2]):
+                    writer.write(b'* %d FETCH (FLAGS (\\Seen))\r\n' % num)
+        elif cmd == 'STATUS':
+            writer.write(b'* STATUS %s (MESSAGES %d UIDNEXT %d UNSEEN %d)\r\n'
+                % (words[2].encode(), self.messages, self.messages + 1,
+                self.messages))
+        elif cmd == 'IDLE':
+            writer.write(b'+ idling\r\n')
+            if known[0] < self.messages:
+                known[0] = self.messages
+                writer.write(b'* %d EXISTS\r\n' % known[0])
+            await writer.drain()
+            self._idlers[writer] = known[0]
+            try:
+                line = await reader.readline()
+            finally:
+                known[0] = self._idlers.pop(writer, known[0])
+            if len(line) == 0:
+                return False
+        elif cmd == 'LOGOUT':
+            writer.write(b'* BYE logging out\r\n%s OK LOGOUT completed\r\n'
+                % tag.encode())
+            return False
+
+        if known[0] < self.messages:
+            known[0] = self.messages
+            writer.write(b'* %d EXISTS\r\n' % known[0])
+        writer.write(b'%s OK %s completed\r\n' % (tag.encode(), cmd.encode()))
+        return True
+
+    def _seqset(self, spec):
+        nums = []
+        for part in spec.split(','):
+            lo, _, hi = part.partition(':')
+            if hi == '*':
+                hi = str(max(self.messages, int(lo)))
+            nums.extend(range(int(lo), int(hi or lo) + 1))
+        return nums
+
+def _buffered(reader):
+    # bytes received but not read yet, StreamReader has no public way
+    buf = getattr(reader, '_buf', None)
+    if buf is None:
+        buf = getattr(reader, '_buffer', b'')
+    return len(buf)
+
+class _DeflateStream:
+    # server side of COMPRESS=DEFLATE over asyncio streams, stands in
+    # for both reader and writer
+    def __init__(self, reader, writer):
+        self._reader  = reader
+        self._writer  = writer
+        self._inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+            zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._buf     = b''
+
+    async def readline(self):
+        while b'\n' not in self._buf:
+            data = await self._reader.read(4096)
+            if len(data) == 0:
+                line, self._buf = self._buf, b''
+                return line
+            self._buf += self._inflate.decompress(data)
+        line, _, self._buf = self._buf.partition(b'\n')
+        return line + b'\n'
+
+    def write(self, data):
+        self._writer.write(self._deflate.compress(data) +
+            self._deflate.flush(zlib.Z_SYNC_FLUSH))
+
+    async def drain(self):
+        await self._writer.drain()
+
+    def close(self):
+        self._writer.close()
+
+class _Shaper:
+    # holds replies so a client gets at most rate bytes per second, for
+    # both raw and deflate streams
+    def __init__(self, writer, rate):
+        self._writer = writer
+        self._rate   = float(rate)
+        self._buf    = []
+        self._free   = 0.0    # monotonic time the link is idle again
+
+    def write(self, data):
+        self._buf.append(data)
+        start = max(time.monotonic(), self._free)
+        self._free = start + len(data) / self._rate
+
+    async def drain(self):
+        wait = self._free - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        data, self._buf = b''.join(self._buf), []
+        if len(data) > 0:
+            self._writer.write(data)
+        await self._writer.drain()
+
+    def close(self):
+        self._writer.close()
+
+def cpu_seconds(start, end):
+    # user and system time between two os.times(), summed per field so
+    # an idle process gives 0 and not a rounding error like -0.00
+    return max(0.0, (end.user - start.user) + (end.system - start.system))
+
+def rss_kib():
+    with open('/proc/self/status') as f:
+        for ln in f:
+            if ln.startswith('VmRSS:'):
+                return int(ln.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bench_lock(args):
+    # N threads hammering the write lock of the same mailbox, each one
+    # holding it for a very short critical section
+    mbox = notiflib.IMAP_Mailbox(notiflib.Account(), name='INBOX')
+
+    for nthreads in (1, 4, 16):
+        latencies = []
+        counts = [0] * nthreads
+        stop = threading.Event()
+        start = threading.Barrier(nthreads + 1)
+
+        def worker(idx):
+            lat = []
+            start.wait()
+            while not stop.is_set():
+                t0 = time.perf_counter()
+                mbox._wlock_fifo()
+                lat.append(time.perf_counter() - t0)
+                counts[idx] += 1
+                mbox._wlock_fifo(1)
+            latencies.extend(lat)
+
+        threads = [Thread(target=worker, args=(i,)) for i in range(nthreads)]
+        for t in threads:
+            t.start()
+        start.wait()
+        time.sleep(args.duration)
+        stop.set()
+        for t in threads:
+            t.join()
+
+        # Jain's fairness index, 1.0 means every thread got the same share
+        total = sum(counts)
+        fairness = total ** 2 / (nthreads * sum(c ** 2 for c in counts))
+        report("lock",
+            threads  = nthreads,
+            acquires = total,
+            p50_us   = "%.1f" % (percentile(latencies, 50) * 1e6),
+            p99_us   = "%.1f" % (percentile(latencies, 99) * 1e6),
+            max_us   = "%.1f" % (max(latencies) * 1e6),
+            fairness = "%.3f" % fairness)
+
+def synthetic_stream(size):
+    # mix of untagged updates and header FETCH literals, roughly what a
+    # busy folder sends after a bulk fetch
+    header = (b'From: "Some Sender" <sender@example.com>\r\n'
+        b'Date: Mon, 1 Jan 2024 10:00:00 +0000\r\n'
+        b'Subject: =?UTF-8?B?w6lsw6hndmUgcsOpdW5pb24=?= weekly report\r\n\r\n')
+    chunks = []
+    total = 0
+    n = 0
+    while total < size:
+        n += 1
+        chunk = b''.join([
+            b'* %d FETCH (UID %d BODY[HEADER.FIELDS (FROM DATE SUBJECT)] {%d}\r\n'
+                % (n, n, len(header)),
+            header,
+            b')\r\n',
+            b'* %d FETCH (FLAGS (\\Seen))\r\n' % n,
+            b'* %d EXISTS\r\n' % n,
+        ])
+        chunks.append(chunk)
+        total += len(chunk)
+    return b''.join(chunks), n * 3
+
+def bench_parser(args):
+    # feed a synthetic stream in socket sized reads
+    data, expected = synthetic_stream(args.size * 1024 * 1024)
+    view = memoryview(data)
+
+    for readsize in (512, 4096, 65536):
+        best = None
+        for _ in range(3):
+            parser = notiflib.ResponseParser()
+            count = 0
+            t0 = time.perf_counter()
+            for i in range(0, len(data), readsize):
+                count += len(parser.feed(view[i:i + readsize]))
+            elapsed = time.perf_counter() - t0
+            if best is None or elapsed < best:
+                best = elapsed
+
+        assert count == expected
+        report("parser",
+            read      = readsize,
+            mbytes    = "%.1f" % (len(data) / 1048576),
+            responses = count,
+            mb_s      = "%.1f" % (len(data) / 1048576 / best),
+            resp_s    = "%.0f" % (count / best))
+
+def bench_store(args):
+    # replay untagged updates a long idle session accumulates and check
+    # memory and lookup cost don't grow with the number of responses
+    mbox = notiflib.IMAP_Mailbox(notiflib.Account(), name='INBOX')
+    store = mbox._resp
+    total = args.responses
+    kinds = (
+        '* %d expunge',
+        '* %d fetch (flags (\\seen))',
+        '* ok [highestmodseq %d]',
+        '* %d exists',
+        '* %d recent',
+    )
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    step = total // 5
+    t0 = time.perf_counter()
+    for i in range(1, total + 1):
+        store.add('*', kinds[i % len(kinds)] % i)
+        if i % 7 == 0:
+            store.pop('*', 'exists')
+        if i % step == 0:
+            t1 = time.perf_counter()
+            for _ in range(1000):
+                store.pop('*', 'recent')
+            lookup = (time.perf_counter() - t1) / 1000
+            report("store",
+                responses = i,
+                stored    = len(store),
+                evicted   = store.evicted,
+                kib       = "%.1f" % ((tracemalloc.get_traced_memory()[0] - base) / 1024),
+                lookup_us = "%.2f" % (lookup * 1e6))
+    elapsed = time.perf_counter() - t0
+    tracemalloc.stop()
+
+    report("store",
+        add_s  = "%.0f" % (total / elapsed),
+        resync = mbox.status & mbox.RESYNC > 0)
+
+def _encode(text, charset, how):
+    raw = text.encode(charset)
+    if how == 'B':
+        data = base64.b64encode(raw).decode('ascii')
+    else:
+        # only the characters RFC 2047 allows in a phrase stay as is
+        data = ''.join(chr(c) if chr(c).isalnum() and c < 127 or
+            chr(c) in '!*+-/' else
+            '_' if c == 32 else '=%02X' % c for c in raw)
+    return '=?{}?{}?{}?='.format(charset.upper(), how, data)
+
+def header_corpus(count, seed=1):
+    # header blocks shaped like a real inbox: a few hundred senders with
+    # a long tail, a third of them with encoded display names, subjects
+    # in several charsets, some folded across lines
+    rnd = random.Random(seed)
+    names = [
+        ('Alice Martin', 'ascii', None),
+        ('Élodie Dupont', 'utf-8', 'B'),
+        ('Jürgen Müller', 'iso-8859-1', 'Q'),
+        ('山田 太郎', 'utf-8', 'B'),
+        ('GitHub', 'ascii', None),
+        ('Zoë 🎉 Team', 'utf-8', 'Q'),
+        ('Müller, Jürgen', 'utf-8', 'Q'),
+        ('Doe, John', 'utf-8', 'B'),
+        ('O\'Brien, "Pat"', 'ascii', None),
+    ]
+    subjects = [
+        ('Re: quarterly report', 'ascii', None),
+        ('Réunion de lundi', 'iso-8859-1', 'Q'),
+        ('Ihre Bestellung wurde versandt', 'ascii', None),
+        ('会議のお知らせ', 'utf-8', 'B'),
+        ('[project/repo] Fix race in watcher initialization (#1234) '
+            'and make the retry loop bounded', 'ascii', None),
+        ('Überweisung bestätigt – Ihr Konto', 'utf-8', 'B'),
+    ]
+
+    senders = []
+    for i in range(300):
+        name, charset, how = names[i % len(names)]
+        name = '{} {}'.format(name, i)
+        if how is not None:
+            name = _encode(name, charset, how)
+        else:
+            name = '"{}"'.format(name.replace('\\', '\\\\')
+                .replace('"', '\\"'))
+        senders.append('{} <user{}@example{}.com>'.format(name, i, i % 7))
+    weights = [1.0 / (k + 1) for k in range(len(senders))]
+
+    corpus = []
+    for i in range(count):
+        sender = rnd.choices(senders, weights)[0]
+        text, charset, how = subjects[rnd.randrange(len(subjects))]
+        if how is not None:
+            subject = _encode(text, charset, how)
+        elif len(text) > 60:
+            subject = text[:60] + '\r\n ' + text[60:]
+        else:
+            subject = text
+        corpus.append((
+            'From: {}\r\n'
+            'Date: Mon, {} Jan 2024 10:{:02d}:00 +0100\r\n'
+            'Subject: {}\r\n\r\n').format(sender, i % 28 + 1, i % 60,
+                subject).encode('utf-8'))
+    return corpus
+
+def bench_headers(args):
+    # parse_headers against the email package on header FETCH literals
+    corpus = header_corpus(args.messages * 100)
+
+    def compat32(data):
+        msg = email.message_from_bytes(data)
+        return (msg['from'].split('<')[0].replace('"', ''), msg['subject'],
+            msg['date'])
+
+    def default(data):
+        msg = email.message_from_bytes(data, policy=email.policy.default)
+        addr = msg['from'].addresses[0]
+        return (addr.display_name or addr.addr_spec, str(msg['subject']),
+            str(msg['date']))
+
+    def headers(data):
+        h = notiflib.parse_headers(data)
+        return (h.sender, h['subject'], h['date'])
+
+    results = {}
+    for name, func in (('compat32', compat32), ('default', default),
+            ('headers', headers)):
+        notiflib.sender_name.cache_clear()
+        best = None
+        for _ in range(3):
+            t0 = time.perf_counter()
+            out = [func(data) for data in corpus]
+            elapsed = time.perf_counter() - t0
+            if best is None or elapsed < best:
+                best = elapsed
+        results[name] = out
+        extra = {}
+        if name == 'headers':
+            info = notiflib.sender_name.cache_info()
+            extra['cache_hit'] = "%.2f" % (info.hits /
+                max(1, info.hits + info.misses))
+        report("headers",
+            parser  = name,
+            msgs    = len(corpus),
+            us_msg  = "%.2f" % (best * 1e6 / len(corpus)),
+            **extra)
+
+    # email.policy.default decodes like parse_headers, compare with it
+    mismatch = sum(1 for a, b in zip(results['headers'], results['default'])
+        if a[0] != b[0] or a[1] != b[1])
+    undecoded = sum(1 for r in results['compat32'] if '=?' in r[0] + r[1])
+    report("headers",
+        mismatches = mismatch,
+        undecoded_compat32 = undecoded)
+
+def bench_compress(args):
+    # bytes on wire for the startup poll, a header fetch of every new
+    # message and a few IDLE rounds, with and without COMPRESS=DEFLATE
+    server = FakeIMAPServer(messages=args.messages,
+        caps='IMAP4rev1 IDLE COMPRESS=DEFLATE',
+        headers=header_corpus(min(args.messages, 1000)))
+    port = server.start_thread()
+
+    for compress in (False, True):
+        acc = notiflib.Account(server='127.0.0.1', port=port,
+            user='bench', password='bench', compress=compress)
+        session = notiflib.Session(acc)
+        mbox = notiflib.IMAP_Mailbox(acc, name='INBOX', session=session)
+        t0 = time.perf_counter()
+        mbox.open()
+        count = sum(1 for _ in mbox.fetch_many(mbox.poll()))
+        for _ in range(10):
+            mbox._send_idle()
+            mbox._send_done()
+        elapsed = time.perf_counter() - t0
+        mbox.close()
+
+        t = session.traffic
+        fields = dict(compress=compress, messages=count,
+            ms="%.1f" % (elapsed * 1000))
+        if compress:
+            fields.update(
+                wire_kib = "%.1f" % ((t['wire_in'] + t['wire_out']) / 1024),
+                data_kib = "%.1f" % ((t['data_in'] + t['data_out']) / 1024),
+                ratio    = "%.3f" % session.compression())
+        report("compress", **fields)
+
+def bench_fetch(args):
+    # header download of a burst of new messages against a server with
+    # injected round trip time, for several batch sizes
+    server = FakeIMAPServer(messages=args.messages, rtt=args.rtt / 1000.0)
+    port = server.start_thread()
+    acc = notiflib.Account(server='127.0.0.1', port=port,
+        user='bench', password='bench')
+
+    for batch in (1, 10, 50, 100, 500):
+        if batch > args.messages and batch != 1:
+            break
+        mbox = notiflib.IMAP_Mailbox(acc, name='INBOX', fetch_chunk=batch)
+        mbox.open()
+        uids = mbox.poll()
+
+        t0 = time.perf_counter()
+        count = sum(1 for _ in mbox.fetch_many(uids))
+        elapsed = time.perf_counter() - t0
+        mbox.close()
+
+        assert count == len(uids)
+        report("fetch",
+            batch    = batch,
+            rtt_ms   = args.rtt,
+            messages = count,
+            seconds  = "%.3f" % elapsed,
+            msg_s    = "%.0f" % (count / elapsed))
+
+def bench_search(args):
+    # poll() of a folder where every message is unread, plain SEARCH
+    # listing each UID vs ESEARCH ranges. Server in its own process so
+    # only the client's time and allocations are measured
+    for caps in ('IMAP4rev1 IDLE', 'IMAP4rev1 IDLE ESEARCH'):
+        ready = multiprocessing.Queue()
+        server = multiprocessing.Process(target=serve, args=(0, ready),
+            kwargs=dict(messages=args.messages * 100, caps=caps), daemon=True)
+        server.start()
+        port = ready.get()
+        try:
+            acc = notiflib.Account(server='127.0.0.1', port=port,
+                user='bench', password='bench', name='search')
+            mbox = notiflib.IMAP_Mailbox(acc, name='INBOX')
+            mbox.open()
+            received = mbox._metrics.get('received_bytes_total',
+                account='search')
+
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            uids = mbox.poll()
+            elapsed = time.perf_counter() - t0
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            received = mbox._metrics.get('received_bytes_total',
+                account='search') - received
+            report("search",
+                esearch  = 'ESEARCH' in caps,
+                messages = len(uids),
+                ranges   = len(uids.ranges),
+                kib_read = "%.1f" % (received / 1024),
+                kib_peak = "%.1f" % (peak / 1024),
+                ms       = "%.1f" % (elapsed * 1000))
+            mbox.close()
+        finally:
+            server.terminate()
+
+def bench_cold(args):
+    # one check of many cold folders: a STATUS round trip per folder,
+    # pipelined STATUS and a single LIST-STATUS
+    folders = ['"Folder%d"' % i for i in range(args.folders)]
+    for mode in ('sequential', 'pipelined', 'list-status'):
+        caps = 'IMAP4rev1 IDLE'
+        if mode == 'list-status':
+            caps += ' LIST-EXTENDED LIST-STATUS'
+        server = FakeIMAPServer(messages=10, rtt=args.rtt / 1000.0, caps=caps)
+        port = server.start_thread()
+        acc = notiflib.Account(server='127.0.0.1', port=port,
+            user='bench', password='bench', name='cold-' + mode)
+        session = notiflib.Session(acc)
+        poller = notiflib.StatusPoller(session, folders)
+        session.release(session.connect())    # login outside the timing
+
+        metrics = session.metrics
+        before = [metrics.get(n, account=acc.name) or 0
+            for n in ('received_bytes_total', 'sent_bytes_total')]
+        t0 = time.perf_counter()
+        if mode == 'sequential':
+            imap = session.connect()
+            for f in folders:
+                imap.status(f, '(UIDNEXT UNSEEN)')
+            session.release(imap)
+            changed = folders
+        else:
+            changed = poller.check()
+        elapsed = time.perf_counter() - t0
+        after = [metrics.get(n, account=acc.name) or 0
+            for n in ('received_bytes_total', 'sent_bytes_total')]
+        session.close()
+
+        report("cold",
+            mode     = mode,
+            folders  = len(folders),
+            changed  = len(changed),
+            rtt_ms   = args.rtt,
+            check_ms = "%.1f" % (elapsed * 1000),
+            kib      = "%.1f" % ((sum(after) - sum(before)) / 1024))
+
+def serve(port, ready, **kwargs):
+    # server process for benchmarks measuring the client process only
+    server = FakeIMAPServer(port=port, **kwargs)
+    loop = asyncio.new_event_loop()
+    ready.put(loop.run_until_complete(server.start()))
+    loop.run_forever()
+
+def idle_worker(args):
+    # open args.mailboxes idling mailboxes, then measure RSS and CPU
+    # time while they wait for new mail
+    acc = notiflib.Account(server='127.0.0.1', port=args.port,
+        user='bench', password='bench')
+    stop = threading.Event()
+
+    if args.worker == 'thread':
+        def idle(mbox):
+            while not stop.is_set():
+                try: mbox.idle()
+                except Exception: break
+
+        mailboxes = []
+        for i in range(args.mailboxes):
+            mbox = notiflib.IMAP_Mailbox(acc, name='INBOX')
+            mbox.open()
+            mailboxes.append(mbox)
+        for mbox in mailboxes:
+            Thread(target=idle, args=(mbox,), daemon=True).start()
+        time.sleep(1)
+        cpu = os.times()
+        time.sleep(args.duration)
+
+    else:
+        async def run():
+            sem = asyncio.Semaphore(50)
+
+            async def idle(mbox):
+                async with sem:
+                    await mbox.open()
+                while True:
+                    await mbox.idle()
+
+            for i in range(args.mailboxes):
+                mbox = notiflib.AsyncIMAPMailbox(acc, name='INBOX')
+                asyncio.ensure_future(idle(mbox))
+            while sum(1 for t in asyncio.all_tasks()) < args.mailboxes:
+                await asyncio.sleep(0.1)
+            await asyncio.sleep(1 + args.mailboxes / 200)
+            cpu = os.times()
+            await asyncio.sleep(args.duration)
+            return cpu
+
+        cpu = asyncio.new_event_loop().run_until_complete(run())
+
+    end = os.times()
+    print(json.dumps({
+        'rss_kib': rss_kib(),
+        'cpu_s':   cpu_seconds(cpu, end),
+        'threads': threading.active_count(),
+    }))
+    sys.stdout.flush()
+    os._exit(0)
+
+def bench_idle(args):
+    # RSS and CPU of a process holding idle mailboxes, one thread per
+    # mailbox vs all of them on one asyncio loop
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(0, ready), daemon=True)
+    server.start()
+    port = ready.get()
+
+    try:
+        for mode in ('thread', 'async'):
+            out = subprocess.check_output([sys.executable,
+                os.path.abspath(__file__), '--worker', mode,
+                '--port', str(port), '-m', str(args.mailboxes),
+                '-d', str(args.duration)])
+            res = json.loads(out)
+            report("idle",
+                mode      = mode,
+                mailboxes = args.mailboxes,
+                threads   = res['threads'],
+                rss_mib   = "%.1f" % (res['rss_kib'] / 1024),
+                cpu_pct   = "%.2f" % (100 * res['cpu_s'] / args.duration))
+    finally:
+        server.terminate()
+
+def check_scheduler():
+    # deadline order, moved and cancelled keys and waits, on a fake clock
+    now = [0.0]
+    sched = notiflib.Scheduler(clock=lambda: now[0])
+    fired = []
+    sched.schedule('c', 30, fired.append, 'c')
+    sched.schedule('a', 10, fired.append, 'a')
+    sched.schedule('b', 20, fired.append, 'b')
+    sched.schedule('d', 5, fired.append, 'd')
+    sched.cancel('d')
+    sched.schedule('c', 15)    # moved, its callback is kept
+
+    sched.run_due()
+    assert fired == [], fired
+    assert sched.remaining('a') == 10, sched.remaining('a')
+    now[0] = 10
+    assert sched.run_due() == 15
+    assert fired == ['a'], fired
+    now[0] = 25
+    sched.run_due()
+    assert fired == ['a', 'c', 'b'], fired
+    now[0] = 100
+    sched.run_due()
+    assert fired == ['a', 'c', 'b'], "cancelled or moved key fired twice"
+    assert sched.remaining('c') is None
+
+    # wait() returns when the fake clock passes its deadline, not before
+    waiter = Thread(target=sched.wait, args=('w', 50), daemon=True)
+    waiter.start()
+    while sched.remaining('w') is None:
+        time.sleep(0.001)
+    now[0] = 149
+    sched.run_due()
+    waiter.join(0.2)
+    assert waiter.is_alive(), "wait() returned before its deadline"
+    now[0] = 150
+    sched.run_due()
+    waiter.join(2)
+    assert not waiter.is_alive(), "wait() not released at its deadline"
+
+    # stop() releases every waiter
+    waiter = Thread(target=sched.wait, args=('x', 1000), daemon=True)
+    waiter.start()
+    while sched.remaining('x') is None:
+        time.sleep(0.001)
+    sched.stop()
+    waiter.join(2)
+    assert not waiter.is_alive(), "stop() left a waiter blocked"
+
+def check_backoff():
+    # doubling up to the cap, then reset, with jitter pinned at both ends
+    backoff = notiflib.Backoff(2, 60, rand=lambda: 1.0)
+    delays = [backoff.next() for _ in range(7)]
+    assert delays == [2, 4, 8, 16, 32, 60, 60], delays
+    backoff.reset()
+    assert backoff.next() == 2
+    backoff = notiflib.Backoff(2, 60, rand=lambda: 0.0)
+    delays = [backoff.next() for _ in range(3)]
+    assert delays == [1, 2, 4], delays
+
+def check_wakeup():
+    # a quiet IDLE doesn't wake up at all; new mail and close() do
+    server = FakeIMAPServer(messages=1)
+    port = server.start_thread()
+    acc = notiflib.Account(server='127.0.0.1', port=port,
+        user='bench', password='bench')
+    mbox = notiflib.IMAP_Mailbox(acc, name='INBOX')
+    mbox.open()
+    results = queue.Queue()
+
+    def idle():
+        while True:
+            try:
+                results.put(mbox.idle(60))
+            except Exception as e:
+                results.put(e)
+                return
+
+    Thread(target=idle, daemon=True).start()
+    while mbox.status & mbox.IDLE == 0:
+        time.sleep(0.01)
+    wakeups = mbox.wakeups
+    time.sleep(1)
+    assert mbox.wakeups == wakeups, \
+        "%d wakeups while idle" % (mbox.wakeups - wakeups)
+
+    server.deliver()
+    data = results.get(timeout=2)
+    assert data is not None and 'exists' in data, data
+    assert mbox.wakeups > wakeups, "EXISTS read without a wakeup"
+
+    mbox.close()
+    assert isinstance(results.get(timeout=2), Exception)
+
+def check_mark_read_idle():
+    # mark_read sends DONE from its timer thread, the idle thread must
+    # notice it isn't idling anymore and not sit out its deadline
+    server = FakeIMAPServer(messages=1)
+    port = server.start_thread()
+    acc = notiflib.Account(server='127.0.0.1', port=port,
+        user='bench', password='bench')
+    mbox = notiflib.IMAP_Mailbox(acc, name='INBOX', store_window=0.05)
+    mbox.open()
+    results = queue.Queue()
+
+    def idle():
+        while True:
+            try:
+                data = mbox.idle(0.5)
+            except Exception as e:
+                results.put(e)
+                return
+            if data is not None:
+                results.put(data)
+
+    Thread(target=idle, daemon=True).start()
+    while mbox.status & mbox.IDLE == 0:
+        time.sleep(0.01)
+    mbox.mark_read(1)
+    time.sleep(0.5)
+
+    server.deliver()
+    try:
+        data = results.get(timeout=3)
+    except queue.Empty:
+        data = None
+    mbox.close()
+    assert data is not None and 'exists' in data, \
+        "new mail after mark_read not seen while idle: %r" % (data,)
+    assert mbox.stores_acked == 1, mbox.stores_acked
+
+CHECKS = (check_scheduler, check_backoff, check_wakeup, check_mark_read_idle)
+
+def bench_check(args):
+    # deterministic checks, a failure raises AssertionError
+    for check in CHECKS:
+        t0 = time.perf_counter()
+        check()
+        report("check", check=check.__name__[6:], ok=True,
+            ms="%.1f" % ((time.perf_counter() - t0) * 1000))
+
+def bench_wakeup(args):
+    # how often an idle mailbox thread wakes up while the server is
+    # silent, and how fast close() gets it out of its wait
+    server = FakeIMAPServer()
+    port = server.start_thread()
+    acc = notiflib.Account(server='127.0.0.1', port=port,
+        user='bench', password='bench')
+    mbox = notiflib.IMAP_Mailbox(acc, name='INBOX')
+    mbox.open()
+
+    done = threading.Event()
+    def idle():
+        try:
+            while mbox.status & mbox.CLOSED == 0:
+                mbox.idle(60)
+        except Exception: pass
+        done.set()
+
+    Thread(target=idle, daemon=True).start()
+    time.sleep(0.2)
+    wakeups = mbox.wakeups
+    time.sleep(args.duration)
+    wakeups = mbox.wakeups - wakeups
+
+    t0 = time.perf_counter()
+    mbox.close()
+    done.wait(10)
+    report("wakeup",
+        seconds    = args.duration,
+        wakeups    = wakeups,
+        per_hour   = "%.0f" % (wakeups * 3600 / args.duration),
+        close_ms   = "%.1f" % ((time.perf_counter() - t0) * 1000),
+        exited     = done.is_set())
+
+def server_tls_context(tmpdir):
+    # self signed certificate for the fake server, client contexts
+    # don't verify it, same as imaplib's defaults
+    cert = os.path.join(tmpdir, 'cert.pem')
+    key = os.path.join(tmpdir, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+        '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+        '-keyout', key, '-out', cert], check=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ctx.load_cert_chain(cert, key)
+    return ctx
+
+def bench_tls(args):
+    # reconnect cost over implicit TLS, with every handshake in full and
+    # with the session cached by the server's TLSContext
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            server_ctx = server_tls_context(tmpdir)
+        except (OSError, subprocess.CalledProcessError):
+            report("tls", skipped="openssl not available")
+            return
+    server = FakeIMAPServer(ssl=server_ctx, rtt=args.rtt / 1000.0)
+    port = server.start_thread()
+    acc = notiflib.Account(server='127.0.0.1', port=port, ssl=True,
+        user='bench', password='bench')
+    rounds = 50
+
+    for resume in (False, True):
+        # fresh context, so each mode starts with empty histograms
+        with notiflib._tls_lock:
+            notiflib._tls_contexts.clear()
+        times = []
+        for _ in range(rounds):
+            session = notiflib.Session(acc)
+            if not resume:
+                session.tls.session = None
+            mbox = notiflib.IMAP_Mailbox(acc, name='INBOX', session=session)
+            t0 = time.perf_counter()
+            mbox.open()
+            times.append(time.perf_counter() - t0)
+            mbox.close()
+            session.close()
+
+        tls = session.tls
+        report("tls",
+            resume      = resume,
+            rtt_ms      = args.rtt,
+            full        = tls.handshake_full.count,
+            resumed     = tls.handshake_resumed.count,
+            full_ms     = "%.2f" % ((tls.handshake_full.mean() or 0) * 1000),
+            resumed_ms  = "%.2f" % ((tls.handshake_resumed.mean() or 0) * 1000),
+            open_p50_ms = "%.1f" % (percentile(times, 50) * 1000),
+            open_p90_ms = "%.1f" % (percentile(times, 90) * 1000))
+
+class StubNotification:
+    # libnotify stand-in for the e2e benchmarks
+    def __init__(self, summary, body):
+        self.summary = summary
+        self.body    = body
+
+    @classmethod
+    def new(cls, summary, body):
+        return cls(summary, body)
+
+    def add_action(self, *args):
+        pass
+
+    def update(self, summary, body, icon=None):
+        self.summary = summary
+        self.body    = body
+
+    def show(self):
+        return True
+
+class StubNotify:
+    Notification = StubNotification
+
+    @staticmethod
+    def init(name):
+        return True
+
+class StubGLib:
+    """
+    GLib stand-in for the e2e benchmarks
+
+    idle_add() callbacks run on the thread calling run(), in order,
+    again and again while they return True like on a GLib main loop.
+    """
+    PRIORITY_HIGH = 0
+    _queue = queue.Queue()
+
+    class MainLoop:
+        def is_running(self):
+            return False
+
+        def quit(self):
+            pass
+
+    @classmethod
+    def idle_add(cls, func, *args):
+        cls._queue.put((func, args))
+        return 1
+
+    @staticmethod
+    def timeout_add_seconds(interval, func, *args):
+        return 1
+
+    @classmethod
+    def run(cls):
+        while True:
+            func, args = cls._queue.get()
+            while func(*args):
+                pass
+
+class ShowLog:
+    # wraps the show functions of notif.py, records when each message
+    # reached the screen
+    def __init__(self, notif):
+        self.shown = {}     # (account, uid) -> monotonic time
+        self._cond = threading.Condition()
+        show_message, show_summary = notif.show_message, notif.show_summary
+
+        def message(num, mbox, msg, callback):
+            self._mark([(mbox._account.name, num)])
+            return show_message(num, mbox, msg, callback)
+
+        def summary(records, notification=None):
+            self._mark([(r[1]._account.name, r[0]) for r in records])
+            return show_summary(records, notification)
+
+        notif.show_message, notif.show_summary = message, summary
+
+    def _mark(self, keys):
+        now = time.monotonic()
+        with self._cond:
+            for key in keys:
+                self.shown.setdefault(key, now)
+            self._cond.notify_all()
+
+    def wait(self, keys, timeout):
+        # returns False if some of keys were not shown in time
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while any(k not in self.shown for k in keys):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+def start_notif(port, accounts, tmpdir, **options):
+    # run the threaded mode of notif.py against the fake server on
+    # port, one single folder account per section, with stub Notify
+    # and GLib. Returns the notif module
+    import notif
+
+    path = os.path.join(tmpdir, 'notif.cfg')
+    with open(path, 'w') as f:
+        for i in range(accounts):
+            f.write('[bench%d]\nserver = 127.0.0.1\nport = %d\n'
+                'username = bench\npassword = bench\ndebounce = 0\n'
+                'rate = 1000000\nburst = 1000000\n' % (i, port))
+            for k, v in options.items():
+                f.write('%s = %s\n' % (k, v))
+
+    notif.Notify, notif.GLib = StubNotify, StubGLib
+    notif.VERBOSE = False
+    notif.STATE_DIR = tmpdir
+    notif.STARTUP_TIME = time.monotonic()
+    notif.STARTUP = ThreadPoolExecutor(notif.STARTUP_WORKERS)
+    notif.args = argparse.Namespace(config=path)
+    notif.SCHEDULER.start()
+    Thread(target=StubGLib.run, daemon=True).start()
+    for account in notif.build_config():
+        notif.add_account(account)
+    return notif
+
+def wait_idle(notif, count, timeout=600):
+    # until count mailboxes are in IDLE
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        idle = sum(1 for m in list(notif.MAILBOXES)
+            if m.status & m.IDLE > 0)
+        if idle >= count:
+            return True
+        time.sleep(0.05)
+    return False
+
+def parse_faults(spec):
+    # drop=0.01,fail=0.01 -> {'drop': 0.01, 'fail': 0.01}
+    faults = {}
+    for item in (spec or '').split(','):
+        if '=' in item:
+            kind, _, rate = item.partition('=')
+            faults[kind.strip()] = float(rate)
+    return faults
+
+def e2e_server(args):
+    server = FakeIMAPServer(messages=0, rtt=args.rtt / 1000.0,
+        bandwidth=args.bandwidth * 1024, faults=parse_faults(args.faults))
+    return server, server.start_thread()
+
+def e2e_latency_worker(args):
+    # one idling mailbox, messages delivered one at a time; latency is
+    # from the server's EXISTS to the notification being shown
+    server, port = e2e_server(args)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        notif = start_notif(port, 1, tmpdir)
+        shown = ShowLog(notif)
+        wait_idle(notif, 1)
+
+        sent = {}
+        for _ in range(args.deliveries):
+            t0 = time.monotonic()
+            uid = server.deliver()[0]
+            sent[('bench0', uid)] = t0
+            shown.wait([('bench0', uid)], 2)
+            time.sleep(args.gap / 1000.0)
+        # late ones still count, a reconnect polls the whole folder
+        shown.wait(list(sent), 10)
+
+        latencies = [shown.shown[k] - t for k, t in sent.items()
+            if k in shown.shown]
+        reconnects = notif.METRICS.get('reconnects_total',
+            account='bench0', folder='INBOX') or 0
+        worker_result({
+            'deliveries': len(sent),
+            'missed':     len(sent) - len(latencies),
+            'p50_ms':     percentile(latencies, 50) * 1000,
+            'p90_ms':     percentile(latencies, 90) * 1000,
+            'p99_ms':     percentile(latencies, 99) * 1000,
+            'max_ms':     max(latencies or [0]) * 1000,
+            'reconnects': reconnects,
+            'faults':     sum(server.injected.values()),
+        })
+
+def e2e_burst_worker(args):
+    # bursts of new messages on one idling mailbox, from EXISTS to the
+    # last of them shown
+    server, port = e2e_server(args)
+    rows = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        notif = start_notif(port, 1, tmpdir)
+        shown = ShowLog(notif)
+        wait_idle(notif, 1)
+
+        for size in (10, 100, 1000):
+            if size > args.messages and size != 10:
+                break
+            wait_idle(notif, 1)
+            t0 = time.monotonic()
+            keys = [('bench0', uid) for uid in server.deliver(size)]
+            shown.wait(keys, 60)
+            done = [shown.shown[k] for k in keys if k in shown.shown]
+            elapsed = max(done or [t0]) - t0
+            rows.append({
+                'burst':   size,
+                'shown':   len(done),
+                'seconds': elapsed,
+                'msg_s':   len(done) / elapsed if elapsed > 0 else 0,
+            })
+    worker_result(rows)
+
+def e2e_idle_worker(args):
+    # args.mailboxes idling accounts served by notif.py, CPU and RSS
+    # of this process while nothing happens, per mailbox
+    with tempfile.TemporaryDirectory() as tmpdir:
+        import notif
+        base = rss_kib() # after notif.py and its imports are loaded
+        notif = start_notif(args.port, args.mailboxes, tmpdir)
+        t0 = time.monotonic()
+        ready = wait_idle(notif, args.mailboxes)
+        startup = time.monotonic() - t0
+        time.sleep(1)
+
+        cpu = os.times()
+        time.sleep(args.duration)
+        end = os.times()
+        used = cpu_seconds(cpu, end)
+        worker_result({
+            'ready':      ready,
+            'startup_s':  startup,
+            'rss_kib':    rss_kib() - base,
+            'cpu_s':      used,
+            'threads':    threading.active_count(),
+        })
+
+def worker_result(res):
+    print(json.dumps(res))
+    sys.stdout.flush()
+    os._exit(0)
+
+def run_worker(mode, args, *extra):
+    # benchmark in a fresh interpreter, notif.py state is global
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+        '--worker', mode, '-d', str(args.duration), '--rtt', str(args.rtt),
+        '--bandwidth', str(args.bandwidth), '--faults', args.faults or '',
+        '--deliveries', str(args.deliveries), '--gap', str(args.gap),
+        '--messages', str(args.messages)] + list(extra))
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+def bench_e2e_latency(args):
+    res = run_worker('e2e-latency', args)
+    report("e2e_latency",
+        rtt_ms     = args.rtt,
+        kib_s      = args.bandwidth,
+        faults     = args.faults or "none",
+        deliveries = res['deliveries'],
+        missed     = res['missed'],
+        p50_ms     = "%.1f" % res['p50_ms'],
+        p90_ms     = "%.1f" % res['p90_ms'],
+        p99_ms     = "%.1f" % res['p99_ms'],
+        max_ms     = "%.1f" % res['max_ms'],
+        reconnects = res['reconnects'],
+        injected   = res['faults'])
+
+def bench_e2e_burst(args):
+    for row in run_worker('e2e-burst', args):
+        report("e2e_burst",
+            rtt_ms  = args.rtt,
+            kib_s   = args.bandwidth,
+            burst   = row['burst'],
+            shown   = row['shown'],
+            seconds = "%.3f" % row['seconds'],
+            msg_s   = "%.0f" % row['msg_s'])
+
+def bench_e2e_idle(args):
+    # server in its own process so only the daemon side is measured
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(0, ready), daemon=True)
+    server.start()
+    port = ready.get()
+    try:
+        for count in (int(n) for n in args.scales.split(',')):
+            res = run_worker('e2e-idle', args, '--port', str(port),
+                '-m', str(count))
+            report("e2e_idle",
+                mailboxes   = count,
+                ready       = res['ready'],
+                startup_s   = "%.2f" % res['startup_s'],
+                threads     = res['threads'],
+                rss_mib     = "%.1f" % (res['rss_kib'] / 1024),
+                kib_mbox    = "%.1f" % (res['rss_kib'] / count),
+                cpu_pct     = "%.3f" % (100 * res['cpu_s'] / args.duration),
+                cpu_ms_mbox_h = "%.2f" % (res['cpu_s'] * 1000 * 3600 /
+                    args.duration / count))
+    finally:
+        server.terminate()
+
+class ReplayServer:
+    """
+    IMAP server answering from a notiflib.Capture recording
+
+    Each command is matched with the next recorded command of the same
+    verb, looking at most LOOKAHEAD commands ahead, and gets the bytes
+    the real server sent after it. Recorded tags are replaced by the
+    client's own and the delays between reads are replayed divided by
+    speed, 0 sends everything at once. Unmatched commands get a plain
+    OK. STARTTLS and COMPRESS=DEFLATE are hidden from capabilities, the
+    replay is always in clear text.
+    """
+    LOOKAHEAD = 8
+    CLOSING   = (b'DONE', b'NOOP', b'CLOSE', b'UNSELECT', b'LOGOUT')
+    HIDDEN    = (b' STARTTLS', b' COMPRESS=DEFLATE')
+
+    def __init__(self, path, **kwargs):
+        self.host      = kwargs.get('host', '127.0.0.1')
+        self.port      = kwargs.get('port', 0)
+        self.speed     = kwargs.get('speed', 1.0)
+        self.header, events = notiflib.load_capture(path)
+        self.greeting, self.exchanges = self._split(events)
+        self.duration  = events[-1][0] if len(events) > 0 else 0.0
+        self.folder    = None    # first folder selected in the capture
+        for _, direction, data in events:
+            words = data.split()
+            if direction == '>' and len(words) > 2 and \
+                    words[1].upper() in (b'SELECT', b'EXAMINE'):
+                self.folder = words[2].strip(b'"').decode('utf-8', 'replace')
+                break
+        self.matched   = 0
+        self.unmatched = 0
+        self.skipped   = 0
+        self.pushed    = None    # monotonic time of the last IDLE push
+        self._cursor   = 0
+        self._tags     = {}      # recorded tag -> client tag
+        self._loop     = None
+
+    def finished(self):
+        # every recorded command up to the closing ones was replayed
+        return all(verb in self.CLOSING
+            for verb, _, _, _ in self.exchanges[self._cursor:])
+
+    def start_thread(self):
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            server = self._loop.run_until_complete(asyncio.start_server(
+                self._client, self.host, self.port, limit=1 << 20))
+            self.port = server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+
+        Thread(target=run, daemon=True).start()
+        started.wait()
+        return self.port
+
+    @staticmethod
+    def _split(events):
+        # greeting, then [(verb, tag, time, [(delay, line_start, bytes)])]
+        # with one entry per client command, DONE included
+        greeting, exchanges = [], []
+        reads, t_cmd, literal, buf = greeting, 0.0, 0, b''
+        for t, direction, data in events:
+            if direction == '>':
+                words = data.split(None, 3)
+                if len(words) == 1 and words[0].upper() == b'DONE':
+                    exchanges.append((b'DONE', None, t, []))
+                elif len(words) >= 2 and not data.startswith(b'+'):
+                    verb = words[1].upper()
+                    if verb == b'UID' and len(words) > 2:
+                        verb += b' ' + words[2].upper()
+                    exchanges.append((verb, words[0], t, []))
+                else:
+                    continue    # literal data of the previous command
+                reads, t_cmd = exchanges[-1][3], t
+                continue
+
+            # server lines, literals are kept apart so they are never
+            # mistaken for a tagged line
+            buf += data
+            while len(buf) > 0:
+                if literal > 0:
+                    chunk, buf = buf[:literal], buf[literal:]
+                    literal -= len(chunk)
+                    reads.append((t - t_cmd, False, chunk))
+                    continue
+                end = buf.find(b'\r\n')
+                if end == -1:
+                    break
+                line, buf = buf[:end + 2], buf[end + 2:]
+                reads.append((t - t_cmd, True, line))
+                if line.endswith(b'}\r\n'):
+                    size = line[line.rfind(b'{') + 1:-3]
+                    if size.isdigit():
+                        literal = int(size)
+        return greeting, exchanges
+
+    def _match(self, verb, tag):
+        # next recorded exchange of this verb, None if there is none close
+        for i in range(self._cursor, min(self._cursor + self.LOOKAHEAD,
+                len(self.exchanges))):
+            if self.exchanges[i][0] == verb:
+                self.skipped += i - self._cursor
+                self._cursor = i + 1
+                self.matched += 1
+                if self.exchanges[i][1] is not None:
+                    self._tags[self.exchanges[i][1]] = tag
+                return self.exchanges[i][3]
+        self.unmatched += 1
+        return None
+
+    def _rewrite(self, line_start, data):
+        if not line_start:
+            return data
+        tag, sep, rest = data.partition(b' ')
+        if tag in self._tags:
+            data = self._tags[tag] + sep + rest
+        if b'CAPABILITY' in data:
+            for cap in self.HIDDEN:
+                data = data.replace(cap, b'')
+        return data
+
+    async def _send(self, writer, reads, push=False):
+        start = time.monotonic()
+        for delay, line_start, data in reads:
+            if self.speed > 0:
+                wait = start + delay / self.speed - time.monotonic()
+                if wait > 0:
+                    await writer.drain()
+                    await asyncio.sleep(wait)
+            if push and line_start and data.startswith(b'* '):
+                self.pushed = time.monotonic()
+            writer.write(self._rewrite(line_start, data))
+        await writer.drain()
+
+    async def _command(self, reader, writer):
+        # one client command with its literals, None on disconnect
+        line = await reader.readline()
+        while line.endswith(b'}\r\n'):
+            size = line[line.rfind(b'{') + 1:-3]
+            if not size.rstrip(b'+').isdigit():
+                break
+            if not size.endswith(b'+'):
+                writer.write(b'+ go ahead\r\n')
+                await writer.drain()
+            line += await reader.readexactly(int(size.rstrip(b'+')))
+            line += await reader.readline()
+        return line or None
+
+    async def _client(self, reader, writer):
+        try:
+            await self._send(writer, self.greeting)
+            while True:
+                line = await self._command(reader, writer)
+                if line is None:
+                    break
+                words = line.split(None, 3)
+                if len(words) < 2:
+                    continue
+                tag, verb = words[0], words[1].upper()
+                if verb == b'UID' and len(words) > 2:
+                    verb += b' ' + words[2].upper()
+
+                reads = self._match(verb, tag)
+                if verb == b'IDLE':
+                    if reads is None:
+                        reads = [(0.0, True, b'+ idling\r\n')]
+                    push = asyncio.ensure_future(
+                        self._send(writer, reads, push=True))
+                    done = await reader.readline()
+                    push.cancel()
+                    if len(done) == 0:
+                        break
+                    reads = self._match(b'DONE', None)
+                    if reads is None:
+                        reads = [(0.0, True, tag + b' OK IDLE done\r\n')]
+                elif verb == b'COMPRESS' or verb == b'STARTTLS':
+                    reads = [(0.0, True, tag + b' NO not in replay\r\n')]
+                elif reads is None:
+                    reads = [(0.0, True, tag + b' OK ' + verb + b' replay\r\n')]
+                    if verb.endswith(b'SEARCH'):
+                        reads.insert(0, (0.0, True, b'* SEARCH\r\n'))
+                await self._send(writer, reads)
+                if verb == b'LOGOUT':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+def record_capture(args, tmpdir):
+    # capture of one mailbox against FakeIMAPServer, used by the replay
+    # benchmark when no --capture is given
+    server = FakeIMAPServer(messages=args.messages, rtt=args.rtt / 1000.0)
+    port = server.start_thread()
+    acc = notiflib.Account(server='127.0.0.1', port=port,
+        user='bench', password='bench', capture=tmpdir)
+    mbox = notiflib.IMAP_Mailbox(acc, name='INBOX')
+    mbox.open()
+    sum(1 for _ in mbox.fetch_many(mbox.poll()))
+    for i in range(20):
+        timer = threading.Timer(0.05, server.deliver, (1 + i % 3,))
+        timer.start()
+        if mbox.idle() is not None:
+            sum(1 for _ in mbox.fetch_many(mbox.poll()))
+    mbox.close()
+    mbox._session.close()
+    return [os.path.join(tmpdir, name) for name in sorted(os.listdir(tmpdir))]
+
+def replay_capture(path, speed):
+    # drive a mailbox the way notif.py does, open, poll and fetch, then
+    # idle and fetch again whenever the server speaks
+    server = ReplayServer(path, speed=speed)
+    port = server.start_thread()
+    acc = notiflib.Account(server='127.0.0.1', port=port,
+        user='replay', password='replay')
+    # refreshes are replayed by the client's own timeout
+    idle_timeout = notiflib.DEFAULT_IDLE_TIMEOUT / speed if speed > 0 \
+        else 0.1 / 60
+    deadline = time.monotonic() + server.duration / (speed or 1) + 60
+    wakes = []
+
+    t0 = time.perf_counter()
+    cpu = time.thread_time()
+    mbox = notiflib.IMAP_Mailbox(acc, name=server.folder)
+    mbox.open()
+    messages = sum(1 for _ in mbox.fetch_many(mbox.poll() or []))
+    while not server.finished() and time.monotonic() < deadline:
+        server.pushed = None
+        if mbox.idle(idle_timeout) is None:
+            continue
+        if server.pushed is not None:
+            wakes.append(time.monotonic() - server.pushed)
+        messages += sum(1 for _ in mbox.fetch_many(mbox.poll() or []))
+    mbox.close()
+    cpu = time.thread_time() - cpu
+    elapsed = time.perf_counter() - t0
+    mbox._session.close()
+
+    report("replay",
+        capture     = os.path.basename(path),
+        speed       = speed,
+        commands    = server.matched,
+        unmatched   = server.unmatched,
+        skipped     = server.skipped,
+        messages    = messages,
+        recorded_s  = "%.2f" % server.duration,
+        wall_s      = "%.2f" % elapsed,
+        cpu_ms      = "%.1f" % (cpu * 1000),
+        wakes       = len(wakes),
+        wake_p50_ms = "%.2f" % (percentile(wakes, 50) * 1000),
+        wake_p99_ms = "%.2f" % (percentile(wakes, 99) * 1000))
+
+def bench_replay(args):
+    # recorded traffic fed back through _read_response, idle and fetch,
+    # to check parser and locking changes against real traces
+    if args.capture:
+        for path in args.capture:
+            replay_capture(path, args.speed)
+        return
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for path in record_capture(args, tmpdir):
+            replay_capture(path, args.speed)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always',
+            '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_json(path, args):
+    doc = {
+        'commit':   git_commit(),
+        'time':     time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python':   sys.version.split()[0],
+        'platform': sys.platform,
+        'cpus':     os.cpu_count(),
+        'args':     {k: v for k, v in vars(args).items()
+            if k not in ('json', 'compare', 'worker', 'port')},
+        'results':  RESULTS,
+    }
+    with open(path, 'w') as f:
+        json.dump(doc, f, indent=1)
+        f.write('\n')
+
+def compare(path):
+    # numeric fields of this run against a previous --json file, the
+    # n-th report of a benchmark is matched with its n-th report there
+    with open(path) as f:
+        old = json.load(f)
+    previous = {}
+    for res in old.get('results', []):
+        previous.setdefault(res['bench'], []).append(res)
+
+    seen = {}
+    for res in RESULTS:
+        n = seen.get(res['bench'], 0)
+        seen[res['bench']] = n + 1
+        rows = previous.get(res['bench'], [])
+        if n >= len(rows):
+            continue
+        for k, v in res.items():
+            o = rows[n].get(k)
+            if isinstance(v, bool) or not isinstance(v, (int, float)) or \
+                    isinstance(o, bool) or not isinstance(o, (int, float)):
+                continue
+            if o == v:
+                continue
+            change = "%+.1f%%" % (100.0 * (v - o) / o) if o != 0 else "new"
+            print("{:<12} #{} {}: {} -> {} ({})".format(res['bench'], n,
+                k, o, v, change))
+    print("compared with {} of {}".format(old.get('commit'), old.get('time')))
+
+WORKERS = {
+    'thread':      idle_worker,
+    'async':       idle_worker,
+    'e2e-latency': e2e_latency_worker,
+    'e2e-burst':   e2e_burst_worker,
+    'e2e-idle':    e2e_idle_worker,
+}
+
+BENCHMARKS = {
+    'lock':   bench_lock,
+    'parser': bench_parser,
+    'store':  bench_store,
+    'idle':   bench_idle,
+    'fetch':  bench_fetch,
+    'search': bench_search,
+    'cold':   bench_cold,
+    'wakeup': bench_wakeup,
+    'check':  bench_check,
+    'headers': bench_headers,
+    'compress': bench_compress,
+    'tls':    bench_tls,
+    'e2e_latency': bench_e2e_latency,
+    'e2e_burst':   bench_e2e_burst,
+    'e2e_idle':    bench_e2e_idle,
+    'replay':      bench_replay,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="notiflib benchmarks")
+    parser.add_argument("bench", nargs="*", help="benchmarks to run")
+    parser.add_argument("-d", "--duration", type=float, default=2.0,
+        help="seconds per benchmark run")
+    parser.add_argument("-s", "--size", type=int, default=8,
+        help="size of synthetic streams in MiB")
+    parser.add_argument("-n", "--responses", type=int, default=1000000,
+        help="untagged responses replayed in store benchmark")
+    parser.add_argument("-m", "--mailboxes", type=int, default=500,
+        help="idle mailboxes in idle benchmark")
+    parser.add_argument("--messages", type=int, default=300,
+        help="new messages in fetch benchmark, largest e2e_burst")
+    parser.add_argument("--rtt", type=float, default=20,
+        help="injected round trip time in milliseconds")
+    parser.add_argument("--bandwidth", type=float, default=0,
+        help="server bandwidth in KiB/s for e2e benchmarks, 0 is unlimited")
+    parser.add_argument("--faults",
+        help="faults injected by the e2e server, e.g. drop=0.01,fail=0.01,"
+            "stall=0.01 as share of commands")
+    parser.add_argument("--folders", type=int, default=200,
+        help="cold folders checked in cold benchmark")
+    parser.add_argument("--deliveries", type=int, default=100,
+        help="messages delivered one by one in e2e_latency")
+    parser.add_argument("--gap", type=float, default=20,
+        help="milliseconds between deliveries in e2e_latency")
+    parser.add_argument("--scales", default="1,100,1000",
+        help="mailbox counts in e2e_idle")
+    parser.add_argument("--capture", action="append",
+        help="capture file written by a capture = directory account "
+            "option, replayed by the replay benchmark, may be repeated")
+    parser.add_argument("--speed", type=float, default=1.0,
+        help="replay speed, 2 replays twice as fast, 0 without delays")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare",
+        help="compare results with a file written by --json")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        WORKERS[args.worker](args)
+
+    names = args.bench or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.stderr.write("unknown benchmark: %s\n" % name)
+            sys.exit(1)
+        BENCHMARKS[name](args)
+
+    if args.json:
+        write_json(args.json, args)
+    if args.compare:
+        compare(args.compare)
@@ -1,443 +1,3382 @@
 #!/usr/bin/env python3
 
 import imaplib, email
+import email.errors, email.header, email.utils
+import asyncio
+import bisect
+import functools
+import heapq
+import io
+import json
+import os
+import random
+import re
 import select
 import socket
+import ssl
+import tempfile
+import threading
 import time
-from io import StringIO
+import zlib
+from urllib.parse import quote as urlquote
+from collections import deque, OrderedDict
 
 DEFAULT_IDLE_TIMEOUT = 10 # idle timeout in minutes
 DEFAULT_FOLDER       = 'INBOX'
-
-class IMAP_Mailbox:
+DEFAULT_LOCK_TIMEOUT = 30 # seconds to wait for mailbox lock
+DEFAULT_RESPONSE_CAP = 256 # stored responses kept per tag
+DEFAULT_RESPONSE_TAGS = 64 # distinct tags kept in response store
+DEFAULT_CMD_TIMEOUT  = 10 # seconds to wait for a command to complete
+DEFAULT_CONNECTIONS  = 10 # connections per account, most servers allow 10-20
+DEFAULT_FETCH_CHUNK  = 100 # messages per FETCH command in fetch_many
+DEFAULT_STORE_WINDOW = 0.5 # seconds to merge mark_read calls in one STORE
+DEFAULT_CONNECT_TIMEOUT = 15 # seconds to connect and for each socket operation
+DEFAULT_NAME_CACHE   = 1024 # decoded sender names kept by sender_name
+# upper bounds in seconds of connect and handshake latency buckets
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                           2.5, 5.0, 10.0)
+HEADER_FIELDS        = ('from', 'date', 'subject')
+
+# imaplib refuses commands it doesn't know about
+imaplib.Commands.setdefault('NOTIFY', ('AUTH', 'SELECTED'))
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+class FifoLock:
     """
-    Mailbox class
+    First come first served lock.
 
-    Instantiate with Mailbox(Account(), [name=folder_name])
+    Waiters are queued in arrival order and ownership is handed directly
+    to the head of the queue on release, so a waiter wakes up as soon as
+    the lock is released and no thread can barge in front of it.
 
-    Params:
-        Account is instance of Account class
+    on_wait, if given, is called without arguments each time a thread
+    starts waiting, so a long holder can be asked to let go.
     """
-    E_NETWORK    = 0x001
-    E_LOGIN      = 0x002
-    E_SELECT     = 0x004
-    CLOSED       = 0x008
-    FETCH_HEADER = 0x010
-    IDLE         = 0x020
-    IDLE_FAILED  = 0x040
-
 
-    def __init__(self, acc, **kwargs):
-        self._imap        = None
-        self.status       = 0
-        self._read_lock   = 0
-        self._wlock       = 0
-        self._account     = acc
-        self._idle_tag    = None
-        self.name         = kwargs.get('name')
-        self._resp = {}
+    def __init__(self, on_wait=None):
+        self._mutex   = threading.Lock()
+        self._waiters = deque()
+        self._locked  = False
+        self._on_wait = on_wait
 
-    def open(self):
+    def acquire(self, timeout=None):
         """
-        Initiate connection to server, login, and select folder.
+        Acquire the lock, blocking in FIFO order.
 
-        Returns:
-            bool: True if successful, False if cannot select folder
+        Params:
+            timeout (float, optional): seconds to wait, None waits forever
 
+        Returns:
+            bool: True if lock acquired or False if timeout reached
         """
-        self._read_lock &= 0
-        self.status &= 0
-        self.status |= self.CLOSED
-        self._resp = {}
+        with self._mutex:
+            if not self._locked and len(self._waiters) == 0:
+                self._locked = True
+                return True
+            waiter = threading.Lock()
+            waiter.acquire()
+            self._waiters.append(waiter)
+
+        if self._on_wait is not None:
+            self._on_wait()
+        if timeout is None:
+            timeout = -1
+        if waiter.acquire(timeout=timeout):
+            return True
 
-        mbox = self.name
-        if self.name is None:
-            mbox = DEFAULT_FOLDER
+        with self._mutex:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                # lock was handed to us right after the timeout expired
+                return True
+        return False
 
-        try:
-            if self._account.ssl:
-                self._imap = imaplib.IMAP4_SSL(self._account.server)
+    def release(self):
+        """
+        Release the lock and hand it to the oldest waiter, if any.
+        """
+        with self._mutex:
+            if not self._locked:
+                raise RuntimeError('release unlocked lock')
+            if len(self._waiters) > 0:
+                # ownership is transferred, lock stays held
+                self._waiters.popleft().release()
             else:
-                self._imap = imaplib.IMAP4(self._account.server)
-        except:
-            self.status |= self.E_NETWORK
-            raise
+                self._locked = False
 
-        if not isinstance(self._imap, imaplib.IMAP4_SSL):
-            if 'STARTTLS' in self._imap.capabilities:
-                self._imap.starttls()
+    def locked(self):
+        return self._locked
 
-        try: self._imap.login(
-                self._account.username,
-                self._account.password
-            )
-        except:
-            self.status |= self.E_LOGIN
-            raise
+    def waiting(self):
+        return len(self._waiters)
 
-        retval = self._imap.select(mbox)
-        if retval[0] == 'NO':
-           self.status |= self.E_SELECT
-           self._imap.logout()
-           return False
+    def __enter__(self):
+        self.acquire()
+        return self
 
-        self._tag = self._imap._new_tag()
-        self.status &= ~self.CLOSED
-        return True
+    def __exit__(self, *exc):
+        self.release()
 
-    def fetch(self, num, flag = 0):
-        """
-        Download message from server.
+class Backoff:
+    """
+    Exponential backoff with jitter
 
-        Params:
-            num (str): message index to be downloaded
-            flag (int, optional): set with Mailbox.FETCH_HEADER to download header only
+    Delays double from base up to cap and each one is randomized between
+    half and all of its value, so mailboxes failing at the same time
+    don't retry at the same time.
+    """
 
+    def __init__(self, base=1.0, cap=300.0, rand=random.random):
+        self.base     = base
+        self.cap      = cap
+        self.attempts = 0
+        self._rand    = rand
+
+    def next(self):
+        """
         Returns:
-            Instance of email.message.Message if succeed or None otherwise
+            float: seconds to wait before next attempt
         """
+        delay = min(self.cap, self.base * (2 ** self.attempts))
+        if delay < self.cap:
+            self.attempts += 1
+        return delay / 2 + self._rand() * delay / 2
 
-        self._wlock_fifo()
-        if self.status & self.IDLE > 0:
-            if not self._send_done():
-                self._wlock_fifo(1)
-                raise ValueError('Mailbox is idle, cannot fetch')
+    def reset(self):
+        self.attempts = 0
 
-        msg_parts = '(BODY.PEEK[HEADER.FIELDS (FROM DATE SUBJECT)])'
-        if flag & self.FETCH_HEADER == 0:
-            msg_parts = '(RFC822)'
+class Scheduler:
+    """
+    Central timer for mailbox deadlines
 
-        try:
-            t, data = self._imap.fetch(num, msg_parts)
-            if not t == 'OK':
-                self._wlock_fifo(1)
-                return None
+    Instantiate with Scheduler([clock=time.monotonic])
 
-            msg = email.message_from_bytes(data[0][1])
-            self._wlock_fifo(1)
-            return msg
-        except:
-            self._wlock_fifo(1)
-            raise
+    Deadlines are kept by key in a heap, scheduling a key again moves
+    its deadline. A single thread started with start() fires due jobs;
+    callbacks must be quick, typically waking a worker. With a fake
+    clock, don't start the thread and call run_due() after moving the
+    clock instead.
+    """
 
-    def poll(self):
+    def __init__(self, clock=time.monotonic):
+        self._clock   = clock
+        self._cond    = threading.Condition()
+        self._heap    = []
+        self._jobs    = {}    # key -> [deadline, seq, [(callback, args)]]
+        self._seq     = 0
+        self._thread  = None
+        self._running = False
+        self._stopped = False
+
+    def schedule(self, key, delay, callback=None, *args):
         """
-        Search unread emails from folder
+        Set deadline of key to delay seconds from now. Callbacks already
+        waiting on key are kept and fired at the new deadline.
+        """
+        with self._cond:
+            self._schedule(key, self._clock() + delay, callback, args)
+
+    def cancel(self, key):
+        with self._cond:
+            self._jobs.pop(key, None)
 
+    def remaining(self, key):
+        """
         Returns:
-            returns list [] containing message numbers or None if error
+            float: seconds until deadline of key, or None if key is not
+            scheduled or already fired
         """
-        try:
-            t, data = self._imap.search(None, 'UNSEEN')
-            if not t == 'OK':
+        with self._cond:
+            job = self._jobs.get(key)
+            if job is None:
                 return None
+            return job[0] - self._clock()
 
-            return data[0].split()
-        except:
-            raise
-
-    def idle(self, timeout=None):
+    def wait(self, key, delay=None):
         """
-        Sending IDLE command to server and waiting for response.
+        Block until deadline of key. If delay is given the deadline is
+        first moved to delay seconds from now. Returns immediately if
+        key isn't scheduled or scheduler is stopped.
+        """
+        event = threading.Event()
+        with self._cond:
+            if self._stopped:
+                return
+            job = self._jobs.get(key)
+            if delay is not None:
+                deadline = self._clock() + delay
+            elif job is not None:
+                deadline = job[0]
+            else:
+                return
+            self._schedule(key, deadline, event.set, ())
+        event.wait()
 
-        Params:
-            timeout (int, optional): idle timeout in minutes, default is
-            DEFAULT_IDLE_TIMEOUT
+    def run_due(self, now=None):
+        """
+        Fire callbacks of every key whose deadline is reached.
 
         Returns:
-            decoded bytes string read from socket or None if timeout reached.
-
-        Raises:
-            IOError: Socket error
-            EOFError: Socket closed by remote host
+            float: next deadline or None if nothing is scheduled
         """
-
-
-        if self.status & self.IDLE == 0:
-            self._wlock_fifo()
+        fire = []
+        with self._cond:
+            if now is None:
+                now = self._clock()
+            while len(self._heap) > 0 and self._heap[0][0] <= now:
+                deadline, seq, key = heapq.heappop(self._heap)
+                job = self._jobs.get(key)
+                if job is None or job[1] != seq:
+                    continue # moved or cancelled
+                del self._jobs[key]
+                fire.extend(job[2])
+            nxt = self._heap[0][0] if len(self._heap) > 0 else None
+
+        for callback, args in fire:
             try:
-                if not self._send_idle():
-                    self.status |= self.IDLE_FAILED
-                    self._wlock_fifo(1)
-                    return None
-            except:
-                self.status |= self.IDLE_FAILED
-                self._wlock_fifo(1)
-                return None
+                callback(*args)
+            except Exception: pass
+        return nxt
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # stop timer thread and release everything waiting on it
+        with self._cond:
+            self._running = False
+            self._stopped = True
+            jobs, self._jobs = self._jobs, {}
+            self._heap = []
+            self._cond.notify()
+        for job in jobs.values():
+            for callback, args in job[2]:
+                try:
+                    callback(*args)
+                except Exception: pass
+
+    def _schedule(self, key, deadline, callback, args):
+        callbacks = []
+        job = self._jobs.get(key)
+        if job is not None:
+            callbacks = job[2]
+        if callback is not None:
+            callbacks.append((callback, args))
+
+        self._seq += 1
+        self._jobs[key] = [deadline, self._seq, callbacks]
+        heapq.heappush(self._heap, (deadline, self._seq, key))
+        self._cond.notify()
+
+    def _run(self):
+        while True:
+            self.run_due()
+            with self._cond:
+                if not self._running:
+                    return
+                timeout = None
+                if len(self._heap) > 0:
+                    timeout = self._heap[0][0] - self._clock()
+                    if timeout <= 0:
+                        continue
+                self._cond.wait(timeout)
 
-            self._wlock_fifo(1)
+class Histogram:
+    """
+    Fixed bucket histogram, thread safe
 
-        if timeout is None or timeout == 0:
-            timeout = DEFAULT_IDLE_TIMEOUT
+    Instantiate with Histogram([buckets])
 
-        if not isinstance(timeout, int):
-            raise ValueError('timeout value is not an integer')
+    buckets are the upper bounds of each bucket, values above the last
+    one are counted in an overflow bucket.
+    """
 
-        timer = 0
-        while timer < 60 * timeout:
-            if self.status & self.CLOSED > 0:
-                raise IOError('Socket error')
-            if self.status & self.IDLE == 0:
-                return None
-            try:
-                data = self._read_response(timeout=1)
-            except TimeoutError:
-                timer += 1
-                continue
-            except Exception:
-                self.status |= self.CLOSED
-                raise
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count  = 0
+        self.sum    = 0.0
+        self._lock  = threading.Lock()
 
-            return data
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.sum += value
 
-        self._wlock_fifo()
-        try:
-            if self._send_done():
-                self.status &= ~self.IDLE
-            else:
-                self.status |= self.IDLE_FAILED
-            self._wlock_fifo(1)
+    def cumulative(self):
+        """
+        Returns:
+            list: (upper bound, count of values <= bound) tuples, the last
+            bound is float('inf')
+        """
+        with self._lock:
+            counts = list(self.counts)
+        total, out = 0, []
+        for bound, n in zip(self.bounds + (float('inf'),), counts):
+            total += n
+            out.append((bound, total))
+        return out
+
+    def percentile(self, p):
+        """
+        Returns:
+            float: upper bound of the bucket holding the p-th percentile,
+            or None if nothing was observed
+        """
+        buckets = self.cumulative()
+        total = buckets[-1][1]
+        if total == 0:
             return None
-        except:
-            self._wlock_fifo(1)
-            raise
-
-    def _read_response(self, what=None, **kwargs):
-        # read bytes on socket and search what from response
-        # Returns decoded bytes string containing what. If what is None then
-        # any untagged response is returned
-        # TimeoutError exception raised when socket operation timeout
-        # BufferError exception raised when socket closed
-
-        tag = kwargs.get('tag', '*').lower()
-        timeout = kwargs.get('timeout', 10)
-
-        self._rlock_fifo()
+        rank = total * p / 100.0
+        for bound, n in buckets:
+            if n >= rank:
+                return bound
+        return buckets[-1][0]
 
-        match = None
-        if tag in self._resp:
-            i = 0
-            for s in self._resp[tag]:
-                if what is None:
-                    match = self._resp[tag].pop(i)
-                    break
-                if s.find(what.lower()) != -1:
-                    match = self._resp[tag].pop(i)
-                    break
+    def mean(self):
+        """
+        Returns:
+            float: average of observed values, or None if none
+        """
+        with self._lock:
+            if self.count == 0:
+                return None
+            return self.sum / self.count
 
-                i += 1
+class Metrics:
+    """
+    Named counters and histograms with labels, thread safe
 
-            if len(self._resp[tag]) == 0:
-                del self._resp[tag]
+    Instantiate with Metrics([prefix='imapnotif'])
 
-        if match is not None:
-            self._rlock_fifo(1)
-            return match
+    Series are created on first use. Collectors added with collect()
+    are called by render() for values kept elsewhere, e.g. TLS
+    handshake histograms. render() gives everything in Prometheus text
+    exposition format.
+    """
 
+    def __init__(self, prefix='imapnotif'):
+        self.prefix      = prefix
+        self._lock       = threading.Lock()
+        self._kinds      = OrderedDict()  # name -> (type, help)
+        self._series     = {}  # name -> OrderedDict(labels -> value)
+        self._collectors = []
+
+    def describe(self, name, kind, text):
+        # kind is 'counter', 'gauge' or 'histogram'
+        with self._lock:
+            self._kinds[name] = (kind, text)
+            self._series.setdefault(name, OrderedDict())
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(name, OrderedDict())
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(name, OrderedDict())
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = Histogram()
+        hist.observe(value)
+
+    def get(self, name, **labels):
+        """
+        Returns:
+            number or Histogram: current value of a series, None if it
+            was never recorded
+        """
+        with self._lock:
+            return self._series.get(name, {}).get(
+                tuple(sorted(labels.items())))
 
-        buf = StringIO()
-        timer = 0
-        while timer < timeout:
-            sock = select.select([self._imap.sock], [], [], 1)
-            if len(sock[0]) == 0:
-                for ln in buf.getvalue().splitlines():
-                    if len(ln) == 0:
-                        continue
+    def collect(self, func):
+        """
+        Add a collector called on every render(). It returns a list of
+        (name, type, help, labels dict, number or Histogram) tuples.
+        """
+        with self._lock:
+            self._collectors.append(func)
 
-                    data = ln.lower()
-                    resp_tag = data.split()[0]
-                    if tag == resp_tag:
-                        if what is None:
-                            self._rlock_fifo(1)
-                            buf.close()
-                            return data
-                        if data.find(what.lower()) != -1:
-                            self._rlock_fifo(1)
-                            buf.close()
-                            return data
-
-                    if not resp_tag in self._resp:
-                        self._resp[resp_tag] = []
-                    self._resp[resp_tag].append(data)
-
-                timer += 1
-                continue
+    def render(self):
+        """
+        Returns:
+            str: every series in Prometheus text exposition format
+        """
+        with self._lock:
+            kinds = OrderedDict(self._kinds)
+            series = OrderedDict((name, list(s.items()))
+                for name, s in self._series.items())
+            collectors = list(self._collectors)
 
+        for func in collectors:
             try:
-                resp = self._imap.sock.recv(4096)
-                written = buf.write(resp.decode('utf-8'))
-                if written == 0:
-                    raise BufferError("socket closed")
-
-            except:
-                buf.close()
-                raise
-
-        self._rlock_fifo(1)
-        buf.close()
-        raise TimeoutError("socket timeout")
+                rows = func()
+            except Exception:
+                continue
+            for name, kind, text, labels, value in rows:
+                kinds.setdefault(name, (kind, text))
+                series.setdefault(name, []).append(
+                    (tuple(sorted(labels.items())), value))
+
+        out = []
+        for name, rows in series.items():
+            if len(rows) == 0:
+                continue
+            full = '{}_{}'.format(self.prefix, name)
+            kind, text = kinds.get(name, (None, None))
+            if kind is None:
+                kind = 'histogram' if isinstance(rows[0][1], Histogram) \
+                    else 'counter'
+            if text:
+                out.append('# HELP {} {}'.format(full, text))
+            out.append('# TYPE {} {}'.format(full, kind))
+            for labels, value in rows:
+                if isinstance(value, Histogram):
+                    self._render_histogram(out, full, labels, value)
+                else:
+                    out.append('{}{} {}'.format(full,
+                        _labels(labels), _number(value)))
+        return '\n'.join(out) + '\n'
+
+    def _render_histogram(self, out, full, labels, hist):
+        for bound, count in hist.cumulative():
+            le = '+Inf' if bound == float('inf') else _number(bound)
+            out.append('{}_bucket{} {}'.format(full,
+                _labels(labels + (('le', le),)), count))
+        out.append('{}_sum{} {}'.format(full, _labels(labels),
+            _number(hist.sum)))
+        out.append('{}_count{} {}'.format(full, _labels(labels), hist.count))
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+        .replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels) + '}'
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+METRICS = Metrics()
+METRICS.describe('command_seconds', 'histogram',
+    'IMAP command round trip, by verb')
+METRICS.describe('received_bytes_total', 'counter',
+    'IMAP bytes read from the server')
+METRICS.describe('sent_bytes_total', 'counter',
+    'IMAP bytes sent to the server')
+METRICS.describe('idle_refresh_total', 'counter',
+    'IDLE ended by the client after its timeout and restarted')
+METRICS.describe('idle_failures_total', 'counter',
+    'IDLE rejected by the server or broken')
+
+class DeflateSocket:
+    """
+    Socket wrapper for IMAP COMPRESS=DEFLATE (RFC 4978)
 
-    def _send_idle(self):
-        # -- imaplib doesn't support idle command --
-        # send command idle to server
-        # returns True if idle confirmed by remote server and False when failed
-        # Exception raised when socket operation error
+    Instantiate with DeflateSocket(sock, [traffic])
 
-        if self.status & self.IDLE > 0:
-            return True
+    Raw deflate in both directions, every send is sync flushed so the
+    server sees whole commands. Anything else is passed to the wrapped
+    socket, so select() and shutdown() work unchanged. pending() also
+    counts inflated bytes not read yet, select() can't see those.
+    traffic, a dict with wire_in, wire_out, data_in and data_out keys,
+    is updated in place.
+    """
 
-        tag = self._imap._new_tag().decode('utf-8')
-        try:
-            self._imap.sock.send(bytes('{} IDLE\r\n'.format(tag), 'utf-8'))
-            self._read_response('idling', tag='+')
-            self.status |= self.IDLE
-            self._idle_tag = tag
-            return True
-        except TimeoutError:
-            self.status |= self.CLOSED
-            return False
-        except:
-            self.status |= self.CLOSED
-            raise
+    def __init__(self, sock, traffic=None):
+        self._sock    = sock
+        self._inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+            zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._buf     = b''
+        self._lock    = threading.Lock()
+        self.traffic  = traffic if traffic is not None else {
+            'wire_in': 0, 'wire_out': 0, 'data_in': 0, 'data_out': 0}
+
+    def sendall(self, data):
+        with self._lock:
+            wire = self._deflate.compress(data) + \
+                self._deflate.flush(zlib.Z_SYNC_FLUSH)
+            self._sock.sendall(wire)
+        self.traffic['data_out'] += len(data)
+        self.traffic['wire_out'] += len(wire)
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def recv(self, size):
+        while len(self._buf) == 0:
+            wire = self._sock.recv(max(size, 4096))
+            if len(wire) == 0:
+                return b''
+            self.traffic['wire_in'] += len(wire)
+            self._buf = self._inflate.decompress(wire)
+            self.traffic['data_in'] += len(self._buf)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def pending(self):
+        pending = getattr(self._sock, 'pending', None)
+        return len(self._buf) + (pending() if pending is not None else 0)
+
+    def makefile(self, mode='rb'):
+        # imaplib reads through this
+        return io.BufferedReader(_DeflateReader(self))
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+class _DeflateReader(io.RawIOBase):
+    def __init__(self, sock):
+        self._sock = sock
+
+    def readable(self):
+        return True
 
-    def _send_done(self):
-        # send DONE command to server.
-        # returns True if succeed or False otherwise
+    def readinto(self, b):
+        data = self._sock.recv(len(b))
+        b[:len(data)] = data
+        return len(data)
 
-        if self.status & self.IDLE == 0:
-            return True
-        try:
-            self._imap.sock.send(bytes('DONE\r\n', 'utf-8'))
-            self._read_response('idle', tag=self._idle_tag)
-            self.status &= ~self.IDLE
-            return True
-        except TimeoutError:
-            self.status |= self.CLOSED
-            return False
-        except:
-            self.status |= self.CLOSED
-            raise
+class Capture:
+    """
+    Recording of the IMAP byte stream of one connection
 
-    def _send_noop(self):
-        # send NOOP command to server.
-        # We need to be able to read response from socket after
-        # issuing command so we don't use imaplib's noop method
-        # returns True if succeed or False otherwise
+    Instantiate with Capture(path, [header fields])
 
-        tag = self._imap._new_tag()
+    Written as JSON lines: the header fields first, then one line per
+    read or write, {"t": seconds since start, "d": "<" for bytes read
+    or ">" for bytes written, "b": bytes as latin-1}. Arguments of LOGIN
+    are replaced by "***" so captures can be shared. Bytes are logged
+    after TLS and COMPRESS, as the parser sees them.
+    """
+    LOGIN = re.compile(rb'^(\S+ LOGIN) .*?(\{\d+\+?\})?(\r\n)?$', re.I | re.S)
+
+    def __init__(self, path, **header):
+        self.path    = path
+        self._lock   = threading.Lock()
+        self._start  = time.monotonic()
+        self._redact = False
+        self._file   = open(path, 'w', encoding='utf-8')
+        header.setdefault('capture', 1)
+        header.setdefault('started', time.time())
+        self._write(header)
+
+    def read(self, data):
+        self._event('<', data)
+
+    def write(self, data):
+        if self._redact:
+            # literal following LOGIN
+            self._redact = False
+            data = b'***' + data[len(data.rstrip(b'\r\n')):]
+        m = self.LOGIN.match(data)
+        if m is not None:
+            self._redact = m.group(2) is not None
+            data = m.group(1) + b' "***" "***"' + (m.group(3) or b'')
+        self._event('>', data)
 
-        try:
-            self._imap.sock.send(bytes('{} NOOP\r\n'.format(tag), 'utf-8'))
-            self._read_response('noop', tag=tag)
-            return True
-        except TimeoutError:
-            self.status |= self.CLOSED
-            return False
-        except:
-            self.status |= self.CLOSED
-            raise
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
 
-    def _wlock_fifo(self, unlock=0):
-        if unlock == 1:
-            self._wlock >>= 1
+    def _event(self, direction, data):
+        if len(data) == 0:
             return
+        self._write({'t': round(time.monotonic() - self._start, 6),
+            'd': direction, 'b': bytes(data).decode('latin-1')})
 
-        time.sleep(0.3)
-        self._wlock <<= 1
-        self._wlock |= 0x02
-
-        w_id = self._wlock
-        while w_id > 0x03:
-            timer = 0
-            while self._wlock & 0x01 == 0:
-                if timer >= 300:
-                    self._wlock >>= 1
-                time.sleep(0.1)
-                timer += 1
-                continue
-            w_id >>= 1
+    def _write(self, obj):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(json.dumps(obj) + '\n')
+            self._file.flush()
 
-        self._wlock &= ~0x01
+def load_capture(path):
+    """
+    Read a file written by Capture.
 
-    def _rlock_fifo(self, unlock=0):
-        if unlock == 1:
-            self._read_lock >>= 1
-            return
+    Returns:
+        (header dict, list of (seconds, direction, bytes))
+    """
+    events = []
+    with open(path, encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        for line in f:
+            ev = json.loads(line)
+            events.append((ev['t'], ev['d'], ev['b'].encode('latin-1')))
+    return header, events
+
+class ResponseParser:
+    """
+    Incremental IMAP response splitter
 
-        time.sleep(0.3)
-        self._read_lock <<= 1
-        self._read_lock |= 0X02
-
-        read_id = self._read_lock
-        while read_id > 0x03:
-            timer = 0
-            while self._read_lock & 0x01 == 0:
-                if timer >= 300:
-                    self._wlock >>= 1
-                time.sleep(0.1)
-                timer += 1
-                continue
-            read_id >>= 1
+    Bytes read from the socket are fed as they arrive and every complete
+    response line is returned as soon as its CRLF is received. Literals
+    announced with {n} are consumed by length, so they may contain CRLF
+    or straddle reads. Bytes already scanned are never scanned again.
+    """
 
-        self._read_lock &= ~0x01
+    def __init__(self):
+        self._buf     = bytearray()
+        self._start   = 0 # offset of the response being assembled
+        self._scan    = 0 # offset where the CRLF search resumes
+        self._line    = 0 # offset of the text following the last literal
+        self._literal = 0 # literal bytes still expected
 
-    def mark_read(self, num):
+    def feed(self, data):
         """
-        Add flag \Seen to selected message index
+        Append bytes read from server.
 
         Params:
-            num (int): message number
+            data (bytes): raw bytes from socket
 
         Returns:
-            bool: True if successful or False if failed
+            list of complete responses as bytes, without trailing CRLF
+        """
+        buf = self._buf
+        buf += data
+        out = []
+
+        while True:
+            if self._literal > 0:
+                avail = len(buf) - self._scan
+                if avail < self._literal:
+                    self._scan += avail
+                    self._literal -= avail
+                    break
+                self._scan += self._literal
+                self._line = self._scan
+                self._literal = 0
+
+            end = buf.find(b'\r\n', self._scan)
+            if end < 0:
+                # keep a trailing CR so a split CRLF is still found
+                self._scan = max(self._scan, len(buf) - 1)
+                break
+
+            if end > self._line and buf[end - 1] == 0x7d: # '}'
+                brace = buf.rfind(b'{', self._line, end)
+                if brace >= 0 and buf[brace + 1:end - 1].isdigit():
+                    self._literal = int(buf[brace + 1:end - 1])
+                    self._scan = end + 2
+                    continue
+
+            out.append(bytes(memoryview(buf)[self._start:end]))
+            self._start = self._scan = self._line = end + 2
+
+        if self._start > 0:
+            del buf[:self._start]
+            self._scan -= self._start
+            self._line -= self._start
+            self._start = 0
+
+        return out
+
+    def pending(self):
+        """
+        Returns:
+            int: number of buffered bytes not yet returned as a response
         """
+        return len(self._buf)
 
-        self._wlock_fifo()
-        tag = self._imap._new_tag().decode('utf-8')
-        data = bytes("{} STORE {} +FLAGS \\Seen\r\n".format(tag, num), 'utf-8')
-        try:
+class ResponseStore:
+    """
+    Bounded store for responses nobody was waiting for
+
+    Responses are kept per tag in arrival order, at most `cap` per tag
+    and `maxtags` distinct tags. Each one is also indexed by its keyword
+    (EXISTS, EXPUNGE, FETCH, RECENT, OK...) so lookups by keyword don't
+    scan the whole store. When full, the oldest response is evicted and
+    on_evict(tag, data) is called so the owner can resync.
+    """
+
+    KEYWORDS = ('exists', 'expunge', 'fetch', 'recent')
+
+    def __init__(self, cap=DEFAULT_RESPONSE_CAP, **kwargs):
+        self.cap      = cap
+        self.maxtags  = kwargs.get('maxtags', DEFAULT_RESPONSE_TAGS)
+        self.evicted  = 0
+        self._evict   = kwargs.get('on_evict')
+        self._seq     = 0
+        self._tags    = OrderedDict() # tag -> OrderedDict(seq -> (kw, data))
+        self._index   = {}            # (tag, kw) -> OrderedDict(seq -> None)
+
+    @staticmethod
+    def keyword(data):
+        """
+        Returns:
+            str: response keyword, e.g. 'exists' for '* 3 exists'
+        """
+        words = data.split(None, 3)
+        if len(words) > 2 and words[1].isdigit():
+            return words[2]
+        if len(words) > 1:
+            return words[1]
+        return ''
+
+    def add(self, tag, data):
+        kw = self.keyword(data)
+        self._seq += 1
+
+        entries = self._tags.get(tag)
+        if entries is None:
+            if len(self._tags) >= self.maxtags:
+                self._evict_tag()
+            entries = self._tags[tag] = OrderedDict()
+        entries[self._seq] = (kw, data)
+
+        index = self._index.get((tag, kw))
+        if index is None:
+            index = self._index[(tag, kw)] = OrderedDict()
+        index[self._seq] = None
+
+        if len(entries) > self.cap:
+            self._remove(tag, next(iter(entries)), evicted=True)
+
+    def pop(self, tag, what=None):
+        """
+        Remove and return oldest response for tag, optionally the oldest
+        one whose keyword is, or whose text contains, `what`.
+
+        Returns:
+            str: stored response or None if nothing matched
+        """
+        entries = self._tags.get(tag)
+        if entries is None:
+            return None
+
+        seq = None
+        if what is None:
+            seq = next(iter(entries))
+        else:
+            what = what.lower()
+            index = self._index.get((tag, what))
+            if index is not None:
+                seq = next(iter(index))
+            elif what not in self.KEYWORDS:
+                for k, v in entries.items():
+                    if v[1].find(what) != -1:
+                        seq = k
+                        break
+
+        if seq is None:
+            return None
+        return self._remove(tag, seq)
+
+    def clear(self):
+        self._tags.clear()
+        self._index.clear()
+
+    def __len__(self):
+        return sum(len(e) for e in self._tags.values())
+
+    def _remove(self, tag, seq, evicted=False):
+        entries = self._tags[tag]
+        kw, data = entries.pop(seq)
+        if len(entries) == 0:
+            del self._tags[tag]
+
+        index = self._index[(tag, kw)]
+        del index[seq]
+        if len(index) == 0:
+            del self._index[(tag, kw)]
+
+        if evicted:
+            self.evicted += 1
+            if self._evict is not None:
+                self._evict(tag, data)
+        return data
+
+    def _evict_tag(self):
+        tag, entries = next(iter(self._tags.items()))
+        for seq in list(entries):
+            self._remove(tag, seq, evicted=True)
+
+class TLSContext:
+    """
+    TLS settings shared by every connection to one server
+
+    Get one with tls_context(server, port), never instantiate directly.
+
+    Holds a single ssl.SSLContext and the last TLS session negotiated
+    with the server, so reconnects and sibling mailboxes resume it
+    instead of running a full handshake. Stands in for an SSLContext
+    where imaplib expects one. Latency of TCP connects and of full and
+    resumed handshakes is kept in histograms.
+    """
+
+    def __init__(self, server, port):
+        self.server = server
+        self.port   = port
+        # same defaults imaplib uses when given no context
+        self.context           = ssl._create_stdlib_context()
+        self.session           = None
+        self.connect_latency   = Histogram()
+        self.handshake_full    = Histogram()
+        self.handshake_resumed = Histogram()
+
+    def wrap_socket(self, sock, server_hostname=None):
+        """
+        Handshake over a connected socket, resuming the cached session
+        when there is one.
+
+        Returns:
+            ssl.SSLSocket
+
+        Raises:
+            ssl.SSLError: handshake failed
+        """
+        session = self._valid_session()
+        t0 = time.monotonic()
+        try:
+            ssock = self.context.wrap_socket(sock,
+                server_hostname=server_hostname, session=session)
+        except:
+            # server may have forgotten it, next attempt goes in full
+            self.session = None
+            raise
+        elapsed = time.monotonic() - t0
+
+        if ssock.session_reused:
+            self.handshake_resumed.observe(elapsed)
+        else:
+            self.handshake_full.observe(elapsed)
+        return ssock
+
+    def save_session(self, sock):
+        """
+        Keep session of sock for the next handshake. TLS 1.3 servers send
+        session tickets after the handshake, so call it once the server
+        has sent something, e.g. after login.
+        """
+        session = getattr(sock, 'session', None)
+        if session is not None:
+            self.session = session
+
+    def resumed(self):
+        """
+        Returns:
+            float: share of handshakes that resumed a session, or None if
+            there was no handshake yet
+        """
+        total = self.handshake_full.count + self.handshake_resumed.count
+        if total == 0:
+            return None
+        return float(self.handshake_resumed.count) / total
+
+    def _valid_session(self):
+        session = self.session
+        if session is None:
+            return None
+        if session.time + session.timeout < time.time():
+            self.session = None
+            return None
+        return session
+
+_tls_contexts = {}
+_tls_lock = threading.Lock()
+
+def tls_context(server, port):
+    """
+    Returns:
+        TLSContext: the context shared by every connection to server:port
+    """
+    key = (server, port)
+    with _tls_lock:
+        tls = _tls_contexts.get(key)
+        if tls is None:
+            tls = _tls_contexts[key] = TLSContext(server, port)
+        return tls
+
+def tls_contexts():
+    """
+    Returns:
+        list: every TLSContext created so far
+    """
+    with _tls_lock:
+        return list(_tls_contexts.values())
+
+def _collect_tls():
+    # TLSContext histograms, for Metrics.render()
+    rows = []
+    for tls in tls_contexts():
+        server = '{}:{}'.format(tls.server, tls.port)
+        rows.append(('connect_seconds', 'histogram', 'TCP connect latency',
+            {'server': server}, tls.connect_latency))
+        if tls.resumed() is None:
+            continue # plain connections
+        for resumed, hist in (('false', tls.handshake_full),
+                ('true', tls.handshake_resumed)):
+            rows.append(('tls_handshake_seconds', 'histogram',
+                'TLS handshake latency, full or resumed',
+                {'server': server, 'resumed': resumed}, hist))
+    return rows
+
+METRICS.collect(_collect_tls)
+
+class _Instrumented:
+    # counts IMAP bytes and times every command imaplib sends, UID
+    # commands by their verb; tls, metrics and account are set by the
+    # classes below before imaplib reads the greeting. Bytes are added
+    # up per connection and recorded once per command, imaplib reads
+    # line by line
+    received = 0
+    sent     = 0
+    capture  = None
+
+    def _simple_command(self, name, *args):
+        verb = name
+        if name == 'UID' and len(args) > 0:
+            verb = args[0].upper()
+        t0 = time.monotonic()
+        try:
+            return imaplib.IMAP4._simple_command(self, name, *args)
+        finally:
+            self.metrics.observe('command_seconds', time.monotonic() - t0,
+                account=self.account, verb=verb)
+            self.flush_bytes()
+
+    def flush_bytes(self):
+        received, self.received = self.received, 0
+        sent, self.sent = self.sent, 0
+        if received > 0:
+            self.metrics.inc('received_bytes_total', received,
+                account=self.account)
+        if sent > 0:
+            self.metrics.inc('sent_bytes_total', sent, account=self.account)
+
+    def send(self, data):
+        imaplib.IMAP4.send(self, data)
+        self.sent += len(data)
+        if self.capture is not None:
+            self.capture.write(data)
+
+    def read(self, size):
+        data = imaplib.IMAP4.read(self, size)
+        self.received += len(data)
+        if self.capture is not None:
+            self.capture.read(data)
+        return data
+
+    def readline(self):
+        line = imaplib.IMAP4.readline(self)
+        self.received += len(line)
+        if self.capture is not None:
+            self.capture.read(line)
+        return line
+
+    def shutdown(self):
+        try:
+            imaplib.IMAP4.shutdown(self)
+        finally:
+            if self.capture is not None:
+                self.capture.close()
+
+    def _tcp_connect(self, timeout):
+        t0 = time.monotonic()
+        sock = imaplib.IMAP4._create_socket(self, timeout)
+        self.tls.connect_latency.observe(time.monotonic() - t0)
+        return sock
+
+class _IMAP4(_Instrumented, imaplib.IMAP4):
+    # plain connection, STARTTLS is given the TLSContext in place of an
+    # SSLContext
+    def __init__(self, session, host, port, timeout=None):
+        self.tls     = session.tls
+        self.metrics = session.metrics
+        self.account = session.name
+        self.capture = session.new_capture()
+        imaplib.IMAP4.__init__(self, host, port, timeout)
+
+    def _create_socket(self, timeout):
+        return self._tcp_connect(timeout)
+
+class _IMAP4_SSL(_Instrumented, imaplib.IMAP4_SSL):
+    # implicit TLS through the shared TLSContext
+    def __init__(self, session, host, port, timeout=None):
+        self.tls     = session.tls
+        self.metrics = session.metrics
+        self.account = session.name
+        self.capture = session.new_capture()
+        imaplib.IMAP4_SSL.__init__(self, host, port, ssl_context=self.tls,
+            timeout=timeout)
+
+    def _create_socket(self, timeout):
+        return self.tls.wrap_socket(self._tcp_connect(timeout),
+            server_hostname=self.host)
+
+class Session:
+    """
+    Per account connection manager
+
+    Instantiate with Session(Account(), [max_connections=n], [metrics=m])
+
+    Authenticated connections released by a mailbox are kept and handed
+    to the next mailbox of the same account that opens, so reconnects and
+    sibling folders don't pay for another handshake and LOGIN. At most
+    max_connections are open at any time, extra callers wait for one to
+    be released. New connections resume the TLS session of the server's
+    TLSContext when they can. Commands and bytes of every connection are
+    recorded in metrics, notiflib.METRICS by default. When the account
+    has a capture directory, the byte stream of every connection is
+    written there, see Capture.
+    """
+
+    def __init__(self, acc, **kwargs):
+        self.max_connections = kwargs.get('max_connections', DEFAULT_CONNECTIONS)
+        self.capabilities    = ()
+        self._account        = acc
+        self._cond           = threading.Condition()
+        self._count          = 0
+        self._idle           = []
+        self._logins         = deque()
+        port = acc.port or (imaplib.IMAP4_SSL_PORT if acc.ssl
+            else imaplib.IMAP4_PORT)
+        self.tls             = tls_context(acc.server, port)
+        self.metrics         = kwargs.get('metrics') or METRICS
+        self.name            = str(acc.name or acc.server)
+        self._captures       = 0
+        # bytes on compressed connections, before and after DEFLATE
+        self.traffic         = {'wire_in': 0, 'wire_out': 0,
+                                'data_in': 0, 'data_out': 0}
+
+    def new_capture(self):
+        """
+        Open the capture file of a new connection.
+
+        Returns:
+            Capture instance, None when the account has no capture directory
+        """
+        if not self._account.capture:
+            return None
+        with self._cond:
+            self._captures += 1
+            n = self._captures
+        name = '%s-%s-%d.imap.jsonl' % (re.sub(r'[^\w.@-]', '_', self.name),
+            time.strftime('%Y%m%dT%H%M%S'), n)
+        os.makedirs(self._account.capture, exist_ok=True)
+        return Capture(os.path.join(self._account.capture, name),
+            account=self.name, server=self._account.server,
+            port=self.tls.port, ssl=bool(self._account.ssl))
+
+    def connect(self, timeout=None):
+        """
+        Get an authenticated connection, reusing a released one if any.
+
+        Params:
+            timeout (float, optional): seconds to wait for a free slot
+
+        Returns:
+            imaplib.IMAP4 instance, caller must give it back with release()
+
+        Raises:
+            TimeoutError: no connection available before timeout
+            imaplib.IMAP4.error: login failed
+            OSError: network error
+        """
+        while True:
+            imap = self._reserve(timeout)
+            if imap is None:
+                break
+            try:
+                imap.noop()
+                return imap
+            except Exception:
+                # server dropped it while it was waiting in the pool
+                self.release(imap, reuse=False)
+
+        try:
+            return self._login()
+        except:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, imap, reuse=True):
+        """
+        Give back a connection obtained with connect().
+
+        Params:
+            reuse (bool, optional): False if connection is broken or
+            must not be handed to another mailbox
+        """
+        if imap is None:
+            return
+
+        if reuse:
+            with self._cond:
+                self._idle.append(imap)
+                self._cond.notify()
+            return
+
+        try:
+            imap.shutdown()
+        except Exception: pass
+        with self._cond:
+            self._count -= 1
+            self._cond.notify()
+
+    def connections(self):
+        """
+        Returns:
+            int: connections currently open for this account
+        """
+        return self._count
+
+    def compression(self):
+        """
+        Returns:
+            float: bytes on wire per byte of IMAP traffic on compressed
+            connections, or None if none was compressed
+        """
+        t = self.traffic
+        data = t['data_in'] + t['data_out']
+        if data == 0:
+            return None
+        return float(t['wire_in'] + t['wire_out']) / data
+
+    def logins_per_hour(self):
+        """
+        Returns:
+            int: number of LOGIN sent during the last hour
+        """
+        with self._cond:
+            limit = time.monotonic() - 3600
+            while len(self._logins) > 0 and self._logins[0] < limit:
+                self._logins.popleft()
+            return len(self._logins)
+
+    def close(self):
+        # logout connections waiting in pool
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for imap in idle:
+            try:
+                imap.logout()
+            except Exception: pass
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+
+    def _compress(self, imap):
+        # RFC 4978, everything after the tagged OK is deflated both ways
+        try:
+            t, _ = imap._simple_command('COMPRESS', 'DEFLATE')
+        except imaplib.IMAP4.error:
+            return
+        if t != 'OK':
+            return
+        imap.sock = DeflateSocket(imap.sock, self.traffic)
+        imap.file = imap.sock.makefile('rb')
+        imap.compressed = True
+
+    def _reserve(self, timeout):
+        # returns a pooled connection, or None when caller may open a new one
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        with self._cond:
+            while True:
+                if len(self._idle) > 0:
+                    return self._idle.pop()
+                if self._count < self.max_connections:
+                    self._count += 1
+                    return None
+
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError('no connection available')
+                self._cond.wait(remaining)
+
+    def _login(self):
+        acc = self._account
+        timeout = acc.timeout or DEFAULT_CONNECT_TIMEOUT
+        if acc.ssl:
+            imap = _IMAP4_SSL(self, acc.server, self.tls.port, timeout)
+        else:
+            imap = _IMAP4(self, acc.server, self.tls.port, timeout)
+
+        try:
+            if not isinstance(imap, imaplib.IMAP4_SSL):
+                if 'STARTTLS' in imap.capabilities:
+                    imap.starttls(self.tls)
+
+            imap.login(acc.username, acc.password)
+            # tickets of TLS 1.3 servers have arrived by now
+            self.tls.save_session(imap.sock)
+
+            # servers often advertise extensions only once logged in
+            imap._get_capabilities()
+            if acc.compress and 'COMPRESS=DEFLATE' in imap.capabilities:
+                self._compress(imap)
+            imap.qresync_enabled = False
+            if 'QRESYNC' in imap.capabilities and 'ENABLE' in imap.capabilities:
+                t, data = imap._simple_command('ENABLE', 'QRESYNC')
+                enabled = imap.untagged_responses.pop('ENABLED', [])
+                imap.qresync_enabled = t == 'OK' and \
+                    any(b'QRESYNC' in d.upper() for d in enabled if d)
+        except:
+            try:
+                imap.shutdown()
+            except Exception: pass
+            raise
+
+        with self._cond:
+            self._logins.append(time.monotonic())
+        self.capabilities = imap.capabilities
+        return imap
+
+class MailboxState:
+    """
+    Persistent UID bookkeeping of a mailbox
+
+    Instantiate with MailboxState([path]). Without path state is only
+    kept in memory.
+
+    Attributes:
+        uidvalidity (int): UIDVALIDITY the UIDs below belong to
+        uidnext (int): UIDNEXT seen on last select
+        last_uid (int): highest UID already notified
+        highestmodseq (int): HIGHESTMODSEQ of last synced session, 0 if
+        server has no CONDSTORE
+    """
+    FIELDS = ('uidvalidity', 'uidnext', 'last_uid', 'highestmodseq')
+
+    def __init__(self, path=None):
+        self.path = path
+        for f in self.FIELDS:
+            setattr(self, f, 0)
+
+    @staticmethod
+    def path_for(state_dir, account, folder, kind='json'):
+        """
+        Returns:
+            str: state file of folder of account inside state_dir
+        """
+        name = '{}-{}.{}'.format(account or '', folder or DEFAULT_FOLDER, kind)
+        return os.path.join(state_dir, urlquote(name, safe=''))
+
+    def load(self):
+        if self.path is None:
+            return self
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            for k in self.FIELDS:
+                setattr(self, k, int(data.get(k, 0)))
+        except (OSError, ValueError, TypeError, AttributeError): pass
+        return self
+
+    def save(self):
+        """
+        Write state to disk atomically, a crash leaves either the old or
+        the new file.
+
+        Returns:
+            bool: True if saved or False on error
+        """
+        if self.path is None:
+            return True
+
+        return _atomic_write(self.path,
+            {k: getattr(self, k) for k in self.FIELDS})
+
+class ActionJournal:
+    """
+    Persistent list of UIDs to be marked read
+
+    Mark read clicks made while the mailbox is disconnected are kept
+    here, per UIDVALIDITY, and replayed in one STORE on reconnect.
+    """
+
+    def __init__(self, path=None):
+        self.path        = path
+        self.uidvalidity = 0
+        self.seen        = set()
+        self._lock       = threading.Lock()
+        self._loaded     = False
+
+    def load(self):
+        with self._lock:
+            if self._loaded or self.path is None:
+                return self
+            self._loaded = True
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+                self.uidvalidity = int(data.get('uidvalidity', 0))
+                self.seen = set(int(u) for u in data.get('seen', []))
+            except (OSError, ValueError, TypeError, AttributeError): pass
+        return self
+
+    def add(self, uids, uidvalidity):
+        self.load()
+        with self._lock:
+            if uidvalidity != self.uidvalidity:
+                self.seen = set()
+                self.uidvalidity = uidvalidity
+            self.seen.update(int(u) for u in uids)
+            return self._save()
+
+    def take(self, uidvalidity):
+        """
+        Returns:
+            sorted list of journaled UIDs still valid for uidvalidity. They
+            stay in the journal until done() is called.
+        """
+        self.load()
+        with self._lock:
+            if uidvalidity != self.uidvalidity:
+                if len(self.seen) > 0:
+                    self.seen = set()
+                    self._save()
+                return []
+            return sorted(self.seen)
+
+    def done(self, uids):
+        with self._lock:
+            if len(self.seen) == 0:
+                return True
+            self.seen.difference_update(int(u) for u in uids)
+            return self._save()
+
+    def __len__(self):
+        return len(self.seen)
+
+    def _save(self):
+        if self.path is None:
+            return True
+        if len(self.seen) == 0:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError: pass
+            except OSError:
+                return False
+            return True
+        return _atomic_write(self.path, {
+            'uidvalidity': self.uidvalidity,
+            'seen': sorted(self.seen),
+        })
+
+def _atomic_write(path, data):
+    # write json to path through a temporary file, a crash leaves either
+    # the old or the new file. Returns False on error
+    folder = os.path.dirname(path)
+    tmp = None
+    try:
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder,
+            prefix='.' + os.path.basename(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        return True
+    except OSError:
+        if tmp is not None:
+            try:
+                os.unlink(tmp)
+            except OSError: pass
+        return False
+
+class IMAP_Mailbox:
+    """
+    Mailbox class
+
+    Instantiate with Mailbox(Account(), [name=folder_name])
+
+    Params:
+        Account is instance of Account class
+    """
+    E_NETWORK    = 0x001
+    E_LOGIN      = 0x002
+    E_SELECT     = 0x004
+    CLOSED       = 0x008
+    FETCH_HEADER = 0x010
+    IDLE         = 0x020
+    IDLE_FAILED  = 0x040
+    RESYNC       = 0x080
+    PARKED       = 0x100
+
+
+    def __init__(self, acc, **kwargs):
+        self._imap        = None
+        self._session     = kwargs.get('session') or Session(acc)
+        self.status       = self.CLOSED
+        self._read_lock   = FifoLock(on_wait=self._on_read_wait)
+        self._wlock       = FifoLock()
+        # wakeup pipe of idle(), created on first use, see _wake_fd()
+        self._wake_r      = None
+        self._wake_w      = None
+        self._wake_lock   = threading.Lock()
+        self._waking      = False
+        self.wakeups      = 0
+        self.lock_timeout = kwargs.get('lock_timeout', DEFAULT_LOCK_TIMEOUT)
+        self._account     = acc
+        self._idle_tag    = None
+        self.name         = kwargs.get('name')
+        self.response_cap = kwargs.get('response_cap', DEFAULT_RESPONSE_CAP)
+        self._resp = ResponseStore(self.response_cap, on_evict=self._on_evict)
+        self._parser = ResponseParser()
+        self._park_lock   = threading.RLock()
+        self.notify       = kwargs.get('notify') or []
+        self.notify_active = False
+        self._skip_poll   = False
+        self._delta       = None
+        self._synced      = {}
+        self._state_dirty = False
+        self.fetch_chunk  = kwargs.get('fetch_chunk', DEFAULT_FETCH_CHUNK)
+
+        state_dir = kwargs.get('state_dir')
+        if state_dir is not None:
+            self._state = MailboxState(MailboxState.path_for(
+                state_dir, acc.name, self.name))
+            self._journal = ActionJournal(MailboxState.path_for(
+                state_dir, acc.name, self.name, 'journal'))
+        else:
+            self._state = MailboxState()
+            self._journal = ActionJournal()
+
+        self.store_window   = kwargs.get('store_window', DEFAULT_STORE_WINDOW)
+        self.stores_acked   = 0
+        self.stores_failed  = 0
+        self._store_lock    = threading.Lock()
+        self._store_pending = set()
+        self._store_timer   = None
+        self._inflight      = {}
+        self._metrics       = self._session.metrics
+
+    def open(self):
+        """
+        Initiate connection to server, login, and select folder.
+
+        Returns:
+            bool: True if successful, False if cannot select folder
+
+        """
+        self.status &= 0
+        self.status |= self.CLOSED
+        self._resp.clear()
+        self._parser = ResponseParser()
+        self._requeue_inflight()
+
+        mbox = self.name
+        if self.name is None:
+            mbox = DEFAULT_FOLDER
+
+        # connection left by a previous session is unusable
+        if self._imap is not None:
+            self._session.release(self._imap, reuse=False)
+            self._imap = None
+
+        try:
+            self._imap = self._session.connect(self.lock_timeout)
+        except imaplib.IMAP4.error:
+            self.status |= self.E_LOGIN
+            raise
+        except:
+            self.status |= self.E_NETWORK
+            raise
+
+        retval = self._select(mbox)
+        if retval[0] == 'NO':
+           self.status |= self.E_SELECT
+           self._session.release(self._imap)
+           self._imap = None
+           return False
+
+        self._load_state()
+        self._replay_journal()
+
+        self.notify_active = False
+        if len(self.notify) > 0 and 'NOTIFY' in self._imap.capabilities:
+            self.notify_active = self._notify_set()
+
+        self._tag = self._imap._new_tag()
+        self.status &= ~self.CLOSED
+        return True
+
+    def fetch(self, num, flag = 0):
+        """
+        Download message from server.
+
+        Params:
+            num (str): message UID to be downloaded
+            flag (int, optional): set with Mailbox.FETCH_HEADER to download header only
+
+        Returns:
+            Headers with FETCH_HEADER, email.message.Message otherwise, or
+            None if failed
+        """
+
+        self._wlock_fifo()
+        if self.status & self.IDLE > 0:
+            if not self._send_done():
+                self._wlock_fifo(1)
+                raise ValueError('Mailbox is idle, cannot fetch')
+
+        msg_parts = '(BODY.PEEK[HEADER.FIELDS (FROM DATE SUBJECT)])'
+        if flag & self.FETCH_HEADER == 0:
+            msg_parts = '(RFC822)'
+
+        try:
+            t, data = self._imap.uid('FETCH', num, msg_parts)
+            self._collect_stores()
+            if not t == 'OK':
+                self._wlock_fifo(1)
+                return None
+
+            msg = None
+            for part in data:
+                if isinstance(part, tuple):
+                    msg = _parse_message(part[1], flag)
+                    break
+            self._wlock_fifo(1)
+            return msg
+        except:
+            self._wlock_fifo(1)
+            raise
+
+    def fetch_many(self, nums, flag = FETCH_HEADER, chunk = None):
+        """
+        Download several messages with one UID FETCH per chunk.
+
+        Params:
+            nums (SequenceSet or list): message UIDs as returned by poll()
+            flag (int, optional): Mailbox.FETCH_HEADER to download header
+            only, default, or 0 for the whole message
+            chunk (int, optional): messages per FETCH, default fetch_chunk
+
+        Returns:
+            generator of (uid, Headers or email.message.Message) in
+            server order,
+            each chunk is fetched when the previous one is consumed
+        """
+        if chunk is None or chunk < 1:
+            chunk = self.fetch_chunk
+
+        msg_parts = '(UID BODY.PEEK[HEADER.FIELDS (FROM DATE SUBJECT)])'
+        if flag & self.FETCH_HEADER == 0:
+            msg_parts = '(UID RFC822)'
+
+        if not isinstance(nums, SequenceSet):
+            nums = SequenceSet.from_nums(nums)
+        for uids in nums.chunks(chunk):
+            self._wlock_fifo()
+            try:
+                if not self._send_done():
+                    raise ValueError('Mailbox is idle, cannot fetch')
+                t, data = self._imap.uid('FETCH', str(uids), msg_parts)
+                self._collect_stores()
+            finally:
+                self._wlock_fifo(1)
+
+            if not t == 'OK':
+                return
+
+            for i, part in enumerate(data):
+                if not isinstance(part, tuple):
+                    continue
+                uid = re.search(rb'UID (\d+)', part[0], re.I)
+                if uid is None and i + 1 < len(data) and \
+                        isinstance(data[i + 1], bytes):
+                    # UID after the literal, imaplib leaves the rest of
+                    # the response as the next element
+                    uid = re.search(rb'UID (\d+)', data[i + 1], re.I)
+                if uid is None:
+                    continue
+                yield uid.group(1).decode('utf-8'), \
+                    _parse_message(part[1], flag)
+
+    def poll(self):
+        """
+        Search unread emails that arrived since the last poll. Only UIDs
+        above the last one returned are searched, so the cost depends on
+        new mail and not on folder size. Progress is saved to the state
+        file so restarts don't report the same messages again.
+
+        Returns:
+            SequenceSet of message UIDs, empty if none, or None if error
+        """
+        self._wlock_fifo()
+        try:
+            if not self._send_done():
+                return None
+
+            if self._skip_poll:
+                # folder unchanged since last session, nothing new
+                self._skip_poll = False
+                self._commit_state()
+                return SequenceSet()
+
+            last = self._state.last_uid
+            if self._delta is not None:
+                # QRESYNC already told us what changed while offline
+                uids = SequenceSet.from_nums(u for u in self._delta if u > last)
+                self._delta = None
+            else:
+                uids = self._search_unseen(last + 1)
+                if uids is None:
+                    return None
+
+            # n:* always matches the highest UID even when it is below n
+            if last > 0:
+                uids = uids - SequenceSet([(1, last)])
+
+            if uids:
+                self._state.last_uid = uids.max()
+                self._state_dirty = True
+            self._commit_state()
+            return uids
+        finally:
+            self._wlock_fifo(1)
+
+    def _search_unseen(self, first):
+        # unseen UIDs from first on as SequenceSet, None on error. With
+        # ESEARCH (RFC 4731) the server sends ranges instead of every UID
+        imap = self._imap
+        if 'ESEARCH' not in imap.capabilities:
+            t, data = imap.uid('SEARCH', 'UID', '{}:*'.format(first), 'UNSEEN')
+            self._collect_stores()
+            if not t == 'OK':
+                return None
+            return SequenceSet.from_nums((data[0] or b'').split())
+
+        imap.untagged_responses.pop('ESEARCH', None)
+        t, _ = imap.uid('SEARCH', 'RETURN', '(MIN MAX COUNT ALL)',
+            'UID', '{}:*'.format(first), 'UNSEEN')
+        self._collect_stores()
+        found = imap.untagged_responses.pop('ESEARCH', [])
+        if not t == 'OK':
+            return None
+        # no ALL when nothing matched
+        result = parse_esearch(found[-1]) if len(found) > 0 else {}
+        return result.get('all', SequenceSet())
+
+    def _select(self, mbox):
+        # SELECT with CONDSTORE, or QRESYNC (RFC 7162) when enabled on
+        # the connection and we know where the last session stopped.
+        # Falls back to plain select if server rejects the parameters
+        imap = self._imap
+        state = self._state.load()
+        param = None
+        if getattr(imap, 'qresync_enabled', False) and \
+                state.uidvalidity > 0 and state.highestmodseq > 0:
+            param = '(QRESYNC ({} {}))'.format(
+                state.uidvalidity, state.highestmodseq)
+        elif 'CONDSTORE' in imap.capabilities or \
+                'QRESYNC' in imap.capabilities:
+            param = '(CONDSTORE)'
+
+        if param is None:
+            return imap.select(mbox)
+
+        imap.untagged_responses = {}
+        imap.is_readonly = False
+        try:
+            t, data = imap._simple_command('SELECT', mbox, param)
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error:
+            return imap.select(mbox)
+        if t != 'OK':
+            imap.state = 'AUTH'
+            return t, data
+        imap.state = 'SELECTED'
+        return t, imap.untagged_responses.get('EXISTS', [None])
+
+    def _load_state(self):
+        # check saved state against the folder just selected. New values
+        # are only committed to disk by poll(), so a crash before the
+        # first poll doesn't lose the messages in between
+        state = self._state
+        uidvalidity = self._untagged_int('UIDVALIDITY')
+        uidnext = self._untagged_int('UIDNEXT')
+        modseq = self._untagged_int('HIGHESTMODSEQ')
+
+        if uidvalidity is not None and uidvalidity != state.uidvalidity:
+            # UIDs were renumbered, everything unseen is new again
+            state.uidvalidity = uidvalidity
+            state.last_uid = 0
+            state.uidnext = 0
+            state.highestmodseq = 0
+
+        self._synced = {'uidnext': uidnext, 'highestmodseq': modseq}
+        self._delta = None
+        self._skip_poll = False
+        if state.last_uid == 0:
+            return
+
+        if modseq is not None and state.highestmodseq > 0:
+            if modseq == state.highestmodseq:
+                self._skip_poll = True
+            elif getattr(self._imap, 'qresync_enabled', False):
+                self._delta = self._qresync_delta()
+        elif uidnext is not None and uidnext == state.uidnext:
+            self._skip_poll = True
+
+    def _qresync_delta(self):
+        # unseen UIDs among the FETCH responses sent by SELECT (QRESYNC)
+        delta = []
+        for data in self._imap.untagged_responses.get('FETCH', []):
+            if isinstance(data, tuple):
+                data = data[0]
+            if not isinstance(data, bytes):
+                continue
+            uid = re.search(rb'UID (\d+)', data, re.I)
+            flags = re.search(rb'FLAGS \(([^)]*)\)', data, re.I)
+            if uid is None:
+                continue
+            if flags is not None and b'\\seen' in flags.group(1).lower():
+                continue
+            delta.append(int(uid.group(1)))
+        return sorted(delta)
+
+    def _commit_state(self):
+        # first poll after open covered everything up to the select
+        state = self._state
+        before = [getattr(state, f) for f in state.FIELDS]
+        for k, v in self._synced.items():
+            if v is not None:
+                setattr(state, k, v)
+        self._synced = {}
+        if before != [getattr(state, f) for f in state.FIELDS] or \
+                self._state_dirty:
+            self._state_dirty = not state.save()
+
+    def _untagged_int(self, name):
+        # last integer value of untagged response name, e.g. UIDNEXT
+        try:
+            return int(self._imap.untagged_responses[name][-1])
+        except (KeyError, IndexError, ValueError, TypeError):
+            return None
+
+    def idle(self, timeout=None):
+        """
+        Sending IDLE command to server and waiting for response.
+
+        Params:
+            timeout (float, optional): idle timeout in minutes, default is
+            DEFAULT_IDLE_TIMEOUT
+
+        Returns:
+            decoded bytes string read from socket or None if timeout reached.
+
+        Raises:
+            IOError: Socket error
+            EOFError: Socket closed by remote host
+        """
+
+
+        if self.status & self.IDLE == 0:
+            self._wlock_fifo()
+            try:
+                if not self._send_idle():
+                    self.status |= self.IDLE_FAILED
+                    self._count('idle_failures_total')
+                    self._wlock_fifo(1)
+                    return None
+            except:
+                self.status |= self.IDLE_FAILED
+                self._count('idle_failures_total')
+                self._wlock_fifo(1)
+                return None
+
+            self._wlock_fifo(1)
+
+        if timeout is None or timeout == 0:
+            timeout = DEFAULT_IDLE_TIMEOUT
+
+        if not isinstance(timeout, (int, float)):
+            raise ValueError('timeout value is not a number')
+
+        # block until the server speaks, the deadline passes or another
+        # thread needs the socket, see _wakeup()
+        deadline = time.monotonic() + 60 * timeout
+        while True:
+            if self.status & self.CLOSED > 0:
+                raise IOError('Socket error')
+            if self.status & self.IDLE == 0:
+                return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                data = self._read_response(timeout=remaining, wake=True)
+            except TimeoutError:
+                break
+            except InterruptedError:
+                continue
+            except Exception:
+                self.status |= self.CLOSED
+                raise
+
+            # folder changed, first poll must search again
+            self._skip_poll = False
+            self._delta = None
+            return data
+
+        self._wlock_fifo()
+        try:
+            if self._send_done():
+                self.status &= ~self.IDLE
+                self._count('idle_refresh_total')
+            else:
+                self.status |= self.IDLE_FAILED
+                self._count('idle_failures_total')
+            self._wlock_fifo(1)
+            return None
+        except:
+            self._wlock_fifo(1)
+            raise
+
+    def _read_response(self, what=None, **kwargs):
+        # read bytes on socket and search what from response
+        # Returns decoded bytes string containing what. If what is None then
+        # any untagged response is returned
+        # TimeoutError exception raised when socket operation timeout
+        # BufferError exception raised when socket closed
+
+        # InterruptedError exception raised when wake is True and another
+        # thread called _wakeup() or took the connection out of IDLE
+
+        tag = kwargs.get('tag', '*').lower()
+        timeout = kwargs.get('timeout', 10)
+        wake = kwargs.get('wake', False)
+
+        self._rlock_fifo()
+
+        match = self._resp.pop(tag, what)
+        if match is not None:
+            self._rlock_fifo(1)
+            return match
+
+        deadline = time.monotonic() + timeout
+        # poll rather than select, descriptors go past FD_SETSIZE with a
+        # few hundred mailboxes
+        poller = select.poll()
+        poller.register(self._imap.sock.fileno(), select.POLLIN)
+        wake_fd = None
+        if wake:
+            wake_fd = self._wake_fd()
+            poller.register(wake_fd, select.POLLIN)
+        self._waking = wake
+        try:
+            while match is None:
+                # another thread sent DONE, e.g. a mark_read STORE, while
+                # we waited for the lock, or close() ran before the pipe
+                # existed. Nothing will come to wait for anymore
+                if wake and (self.status & self.IDLE == 0 or
+                        self.status & self.CLOSED > 0):
+                    raise InterruptedError("not idling")
+                sock = self._imap.sock
+                # ssl sockets may hold decrypted bytes select can't see
+                pending = getattr(sock, 'pending', None)
+                if pending is None or pending() == 0:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("socket timeout")
+                    # checked after setting _waking, see _on_read_wait()
+                    if wake and self._read_lock.waiting() > 0:
+                        raise InterruptedError("reader waiting")
+                    ready = [fd for fd, _ in poller.poll(remaining * 1000)]
+                    self.wakeups += 1
+                    if wake_fd is not None and wake_fd in ready:
+                        self._drain_wakeup()
+                        raise InterruptedError("woken up")
+                    if len(ready) == 0:
+                        continue
+
+                resp = sock.recv(4096)
+                if len(resp) == 0:
+                    raise BufferError("socket closed")
+                self._imap.received += len(resp)
+                if self._imap.capture is not None:
+                    self._imap.capture.read(resp)
+
+                for ln in self._parser.feed(resp):
+                    data = ln.decode('utf-8', 'replace').lower()
+                    resp_tag = data.split(None, 1)
+                    if len(resp_tag) == 0:
+                        continue
+                    resp_tag = resp_tag[0]
+
+                    if match is None and tag == resp_tag:
+                        if what is None or data.find(what.lower()) != -1:
+                            match = data
+                            continue
+
+                    if resp_tag in self._inflight and \
+                            self._on_tagged(resp_tag, data):
+                        continue
+
+                    self._resp.add(resp_tag, data)
+        finally:
+            self._waking = False
+            self._rlock_fifo(1)
+
+        return match
+
+    def _notify_set(self):
+        # ask server to report new and expunged messages of the selected
+        # folder and of every folder in self.notify (RFC 5465)
+        others = [m for m in self.notify if m.lower() != (self.name or '').lower()]
+        spec = ['STATUS', '(SELECTED (MessageNew MessageExpunge))']
+        if len(others) > 0:
+            spec.append('(MAILBOXES ({}) (MessageNew MessageExpunge))'.format(
+                ' '.join(others)))
+        try:
+            t, _ = self._imap._simple_command('NOTIFY', 'SET', *spec)
+        except imaplib.IMAP4.error:
+            return False
+        return t == 'OK'
+
+    def _on_evict(self, tag, data):
+        # an untagged update was dropped from the response store, the
+        # folder state we know of may be stale
+        if tag == '*':
+            self.status |= self.RESYNC
+
+    def _send_idle(self):
+        # -- imaplib doesn't support idle command --
+        # send command idle to server
+        # returns True if idle confirmed by remote server and False when failed
+        # Exception raised when socket operation error
+
+        if self.status & self.IDLE > 0:
+            return True
+
+        tag = self._imap._new_tag().decode('utf-8')
+        try:
+            t0 = time.monotonic()
+            self._imap.send(bytes('{} IDLE\r\n'.format(tag), 'utf-8'))
+            self._read_response('idling', tag='+')
+            self._timed('IDLE', t0)
+            self.status |= self.IDLE
+            self._idle_tag = tag
+            return True
+        except TimeoutError:
+            self.status |= self.CLOSED
+            return False
+        except:
+            self.status |= self.CLOSED
+            raise
+
+    def _send_done(self):
+        # send DONE command to server.
+        # returns True if succeed or False otherwise
+
+        if self.status & self.IDLE == 0:
+            return True
+        try:
+            t0 = time.monotonic()
+            self._imap.send(bytes('DONE\r\n', 'utf-8'))
+            self._read_response('idle', tag=self._idle_tag)
+            self._timed('DONE', t0)
+            self.status &= ~self.IDLE
+            return True
+        except TimeoutError:
+            self.status |= self.CLOSED
+            return False
+        except:
+            self.status |= self.CLOSED
+            raise
+
+    def _send_noop(self):
+        # send NOOP command to server.
+        # We need to be able to read response from socket after
+        # issuing command so we don't use imaplib's noop method
+        # returns True if succeed or False otherwise
+
+        tag = self._imap._new_tag().decode('utf-8')
+
+        try:
+            t0 = time.monotonic()
+            self._imap.send(bytes('{} NOOP\r\n'.format(tag), 'utf-8'))
+            self._read_response('noop', tag=tag)
+            self._timed('NOOP', t0)
+            return True
+        except TimeoutError:
+            self.status |= self.CLOSED
+            return False
+        except:
+            self.status |= self.CLOSED
+            raise
+
+    def _wlock_fifo(self, unlock=0):
+        # serialize writers on the socket in arrival order
+        # TimeoutError exception raised when lock cannot be acquired
+        if unlock == 1:
+            self._wlock.release()
+            return
+
+        if not self._wlock.acquire(timeout=self.lock_timeout):
+            raise TimeoutError('write lock timeout')
+
+    def _rlock_fifo(self, unlock=0):
+        # serialize readers on the socket in arrival order
+        # TimeoutError exception raised when lock cannot be acquired
+        if unlock == 1:
+            self._read_lock.release()
+            return
+
+        if not self._read_lock.acquire(timeout=self.lock_timeout):
+            raise TimeoutError('read lock timeout')
+
+    def _on_read_wait(self):
+        # an idle wait holding the socket gives it up when woken
+        if self._waking:
+            self._wakeup()
+
+    def _wakeup(self):
+        # interrupt a read started with wake=True
+        with self._wake_lock:
+            if self._wake_w is None:
+                return
+            try:
+                os.write(self._wake_w, b'\0')
+            except BlockingIOError: pass
+
+    def _wake_fd(self):
+        # read end of the wakeup pipe, created on first idle and closed
+        # by close() and park() so finished mailboxes don't keep two fds
+        with self._wake_lock:
+            if self._wake_r is None:
+                self._wake_r, self._wake_w = os.pipe()
+                os.set_blocking(self._wake_r, False)
+                os.set_blocking(self._wake_w, False)
+            return self._wake_r
+
+    def _close_wake(self):
+        # the read lock keeps readers off the pipe while it is closed
+        try:
+            self._rlock_fifo()
+        except TimeoutError:
+            return
+        try:
+            with self._wake_lock:
+                if self._wake_r is None:
+                    return
+                os.close(self._wake_r)
+                os.close(self._wake_w)
+                self._wake_r = self._wake_w = None
+        finally:
+            self._rlock_fifo(1)
+
+    def _timed(self, verb, start):
+        # round trip of a command sent outside imaplib
+        self._metrics.observe('command_seconds', time.monotonic() - start,
+            account=self._session.name, verb=verb)
+        self._imap.flush_bytes()
+
+    def _count(self, name):
+        self._metrics.inc(name, account=self._session.name,
+            folder=self.name or DEFAULT_FOLDER)
+
+    def _drain_wakeup(self):
+        try:
+            while len(os.read(self._wake_r, 512)) == 512:
+                pass
+        except BlockingIOError: pass
+
+    def mark_read(self, num):
+        """
+        Add flag \Seen to selected message
+
+        Calls made within store_window seconds are merged into a single
+        UID STORE which is sent without waiting for the reply, its
+        tagged response is checked whenever the connection is read next.
+        When the mailbox is disconnected the request is kept in the
+        journal and replayed on reconnect.
+
+        Params:
+            num (int): message UID
+
+        Returns:
+            bool: True if request queued or False if failed
+        """
+        with self._store_lock:
+            self._store_pending.add(int(num))
+            if self._store_timer is None:
+                self._store_timer = threading.Timer(self.store_window,
+                    self._flush_store)
+                self._store_timer.daemon = True
+                self._store_timer.start()
+        return True
+
+    def _flush_store(self):
+        # send merged mark_read calls, or journal them if disconnected
+        with self._store_lock:
+            uids = sorted(self._store_pending)
+            self._store_pending = set()
+            self._store_timer = None
+        if len(uids) == 0:
+            return
+
+        if self.status & self.PARKED > 0:
+            try:
+                with self.borrow():
+                    t, _ = self._imap.uid('STORE', seqset(uids),
+                        '+FLAGS.SILENT', '(\\Seen)')
+                self._ack_store(uids, t == 'OK')
+            except Exception:
+                self._journal.add(uids, self._state.uidvalidity)
+            return
+
+        if self.status & self.CLOSED > 0:
+            self._journal.add(uids, self._state.uidvalidity)
+            return
+
+        try:
+            self._wlock_fifo()
+        except TimeoutError:
+            self._journal.add(uids, self._state.uidvalidity)
+            return
+        try:
+            if not self._send_done():
+                self._journal.add(uids, self._state.uidvalidity)
+                return
+            tag = self._imap._new_tag().decode('utf-8')
+            self._inflight[tag.lower()] = (tag, uids, time.monotonic())
+            self._imap.send(bytes(
+                '{} UID STORE {} +FLAGS.SILENT (\\Seen)\r\n'.format(
+                    tag, seqset(uids)), 'utf-8'))
+        except Exception:
+            self.status |= self.CLOSED
+            self._requeue_inflight()
+        finally:
+            self._wlock_fifo(1)
+
+    def _on_tagged(self, tag, data):
+        # returns True if tagged response completes a pipelined STORE
+        entry = self._inflight.pop(tag, None)
+        if entry is None:
+            return False
+        try:
+            del self._imap.tagged_commands[entry[0].encode('utf-8')]
+        except (AttributeError, KeyError): pass
+        words = data.split(None, 2)
+        self._timed('STORE', entry[2])
+        self._ack_store(entry[1], len(words) > 1 and words[1] == 'ok')
+        return True
+
+    def _collect_stores(self):
+        # STORE replies read by imaplib on our behalf during its commands
+        for key, (tag, uids, sent) in list(self._inflight.items()):
+            resp = self._imap.tagged_commands.get(tag.encode('utf-8'))
+            if resp is None:
+                continue
+            self._inflight.pop(key, None)
+            del self._imap.tagged_commands[tag.encode('utf-8')]
+            self._timed('STORE', sent)
+            self._ack_store(uids, resp[0] == 'OK')
+
+    def _ack_store(self, uids, ok):
+        # NO means messages are gone, nothing to retry
+        if ok:
+            self.stores_acked += 1
+        else:
+            self.stores_failed += 1
+        self._journal.done(uids)
+
+    def _requeue_inflight(self):
+        # STOREs not acknowledged before the connection was lost
+        inflight, self._inflight = self._inflight, {}
+        uids = []
+        for tag, entry in inflight.items():
+            uids.extend(entry[1])
+        with self._store_lock:
+            uids.extend(self._store_pending)
+            self._store_pending = set()
+            if self._store_timer is not None:
+                self._store_timer.cancel()
+                self._store_timer = None
+        if len(uids) > 0:
+            self._journal.add(uids, self._state.uidvalidity)
+
+    def _replay_journal(self):
+        # one STORE for every mark_read made while disconnected
+        uids = self._journal.take(self._state.uidvalidity)
+        if len(uids) == 0:
+            return
+        try:
+            t, _ = self._imap.uid('STORE', seqset(uids),
+                '+FLAGS.SILENT', '(\\Seen)')
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error:
+            t = 'NO'
+        self._ack_store(uids, t == 'OK')
+
+    def close(self):
+        """
+        Attempt to gracefully closing selected mailbox and logout.
+        On exit, this method sets status with Mailbox.CLOSED so other
+        methods won't read from socket.
+        Mailbox.idle will exit if this flag set.
+        """
+
+        self._wlock_fifo()
+        sock_alive = False
+        try:
             if self.status & self.IDLE > 0:
-                if not self._send_done():
-                    self._wlock_fifo(1)
-                    return False
+                sock_alive = self._send_done()
+            else:
+                sock_alive = self._send_noop()
+        except: pass
+
+        self.status |= self.CLOSED
+        self._wakeup()
+        # keep unacknowledged mark_read for next start
+        self._requeue_inflight()
+
+        try:
+            if sock_alive:
+                self._imap.close()
+                self._imap.logout()
+            else:
+                self._imap.sock.shutdown(socket.SHUT_RDWR)
+        except: pass
+        self._session.release(self._imap, reuse=False)
+        self._imap = None
+        self._close_wake()
+        self._wlock_fifo(1)
+
+    def abort(self):
+        """
+        Shut connection down at once without taking any lock or talking
+        to the server, for a close() that is stuck on a dead socket.
+        Threads blocked on the socket get an error and the close in
+        progress, if any, completes.
+        """
+        self.status |= self.CLOSED
+        self._wakeup()
+        imap = self._imap
+        if imap is None:
+            return
+        try:
+            imap.sock.shutdown(socket.SHUT_RDWR)
+        except Exception: pass
+
+    def park(self):
+        """
+        Give connection back to the account session so another folder of
+        the same account can use it without logging in again. The mailbox
+        is reopened with open(), or temporarily with borrow().
+        """
+        with self._park_lock:
+            self._wlock_fifo()
+            try:
+                if self._imap is None:
+                    return
+                reuse = self.status & self.CLOSED == 0
+                if reuse and self.status & self.IDLE > 0:
+                    reuse = self._send_done()
+                self.status |= self.CLOSED | self.PARKED
+                self._session.release(self._imap, reuse=reuse)
+                self._imap = None
+                self._close_wake()
+            except:
+                self._session.release(self._imap, reuse=False)
+                self._imap = None
+                raise
+            finally:
+                self._wlock_fifo(1)
+
+    def borrow(self):
+        """
+        Context manager opening a parked mailbox and parking it again on
+        exit. Nested or concurrent users are serialized.
+
+        Raises:
+            IOError: folder cannot be selected
+        """
+        return _Borrow(self)
+
+class _Borrow:
+    def __init__(self, mbox):
+        self._mbox = mbox
+
+    def __enter__(self):
+        self._mbox._park_lock.acquire()
+        self._reopen = self._mbox.status & self._mbox.CLOSED > 0
+        try:
+            if self._reopen and not self._mbox.open():
+                raise IOError('cannot select folder')
+        except:
+            self._mbox._park_lock.release()
+            raise
+        return self._mbox
+
+    def __exit__(self, *exc):
+        try:
+            if self._reopen:
+                self._mbox.park()
+        finally:
+            self._mbox._park_lock.release()
+
+class StatusPoller:
+    """
+    Change detection of many folders over one connection
+
+    Instantiate with StatusPoller(Session(), folders, [known=dict],
+    [timeout=seconds])
+
+    check() asks for UIDNEXT and UNSEEN of every folder in one round
+    trip, with LIST-STATUS (RFC 5819) when the server has it or with
+    pipelined STATUS commands otherwise, on a connection of the session.
+    Folders whose UIDNEXT moved since the previous check are returned so
+    only those are selected and searched. known maps folders to the
+    UIDNEXT seen by their last poll, e.g. from MailboxState, so mail that
+    arrived while stopped is found on the first check; folders missing
+    from it are reported on their first check.
+    """
+    ITEMS = b'(UIDNEXT UNSEEN)'
+
+    def __init__(self, session, folders, **kwargs):
+        self._names   = OrderedDict((_folder_key(f), f) for f in folders)
+        self.known    = dict((_folder_key(f), v)
+            for f, v in (kwargs.get('known') or {}).items())
+        self.status   = {}    # folder -> values of the last STATUS
+        self.timeout  = kwargs.get('timeout', DEFAULT_CMD_TIMEOUT)
+        self._session = session
+        self._list_status = True    # until the server rejects it
+
+    def check(self):
+        """
+        Fetch the counters of every folder.
+
+        Returns:
+            list: folders whose UIDNEXT changed, named as given
+
+        Raises:
+            TimeoutError: no connection available
+            imaplib.IMAP4.error: login failed
+            OSError: network error
+        """
+        imap = self._session.connect(self.timeout)
+        try:
+            t0 = time.monotonic()
+            found, verb = None, 'STATUS'
+            if self._list_status and 'LIST-STATUS' in imap.capabilities:
+                found, verb = self._list(imap), 'LIST'
+            if found is None:
+                found, verb = self._status(imap), 'STATUS'
+            imap.metrics.observe('command_seconds', time.monotonic() - t0,
+                account=imap.account, verb=verb)
+            imap.flush_bytes()
+        except:
+            self._session.release(imap, reuse=False)
+            raise
+        self._session.release(imap)
+
+        changed = []
+        for key, name in self._names.items():
+            values = found.get(key)
+            if values is None or 'uidnext' not in values:
+                continue
+            self.status[name] = values
+            if self.known.get(key) != values['uidnext']:
+                self.known[key] = values['uidnext']
+                changed.append(name)
+        return changed
+
+    def forget(self, folder):
+        """
+        Report folder again on the next check, e.g. when its poll failed.
+        """
+        self.known.pop(_folder_key(folder), None)
+
+    def _status(self, imap):
+        # every STATUS is sent before reading the first reply
+        tags = []
+        commands = []
+        for key in self._names:
+            tag = imap._new_tag()
+            tags.append(tag)
+            commands.append(b'%s STATUS %s %s\r\n' % (tag,
+                _quote(key).encode('utf-8'), self.ITEMS))
+        imap.send(b''.join(commands))
+        return self._collect(imap, tags)[0]
+
+    def _list(self, imap):
+        # LIST "" (patterns) RETURN (STATUS ...), None if refused
+        tag = imap._new_tag()
+        patterns = ' '.join(_quote(key) for key in self._names)
+        imap.send(b'%s LIST "" (%s) RETURN (STATUS %s)\r\n' % (tag,
+            patterns.encode('utf-8'), self.ITEMS))
+        found, results = self._collect(imap, [tag])
+        if not results[tag].upper().startswith(b'OK'):
+            self._list_status = False
+            return None
+        return found
+
+    def _collect(self, imap, tags):
+        # read until every tag completed, returns (folder -> values,
+        # tag -> tagged response). Any other tagged or continuation line
+        # means the pipeline is out of step, the connection is dropped
+        found = {}
+        results = {}
+        pending = set(tags)
+        try:
+            while len(pending) > 0:
+                line = imap._get_line()
+                if line.startswith(b'* '):
+                    status = parse_status(line.decode('utf-8', 'replace'))
+                    if status is not None:
+                        found[_folder_key(status[0])] = status[1]
+                    continue
+                tag, _, rest = line.partition(b' ')
+                if tag not in pending:
+                    raise imaplib.IMAP4.abort('unexpected response to '
+                        'STATUS: %r' % line[:80])
+                pending.discard(tag)
+                results[tag] = rest
+        finally:
+            # _new_tag() registered them, imaplib never reads these
+            for tag in tags:
+                imap.tagged_commands.pop(tag, None)
+        return found, results
+
+def _folder_key(name):
+    # folder names as configured may be quoted, INBOX is case insensitive
+    name = name.strip()
+    if len(name) > 1 and name[0] == '"' and name[-1] == '"':
+        name = name[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return 'INBOX' if name.upper() == 'INBOX' else name
+
+class SequenceSet:
+    """
+    Set of message numbers or UIDs kept as ranges
+
+    Instantiate with SequenceSet([(first, last), ...]),
+    SequenceSet.parse('1:5,7') or SequenceSet.from_nums([1, 2, 3])
+
+    Search results of tens of thousands of messages stay a few ranges
+    instead of one object per message. Supports len(), iteration in
+    ascending order, `in`, chunks() for batched FETCH, difference() or
+    `-`, and str() as IMAP sequence set.
+    """
+    __slots__ = ('_ranges', '_starts')
+
+    def __init__(self, ranges=None):
+        merged = []
+        for lo, hi in sorted((min(r), max(r)) for r in ranges or ()):
+            if len(merged) > 0 and lo <= merged[-1][1] + 1:
+                if hi > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], hi)
+            else:
+                merged.append((lo, hi))
+        self._ranges = merged
+        self._starts = [lo for lo, _ in merged]
 
-            self._imap.sock.sendall(data)
-            self._wlock_fifo(1)
-            return True
-        except TimeoutError:
-            self.status |= self.CLOSED
-            self._wlock_fifo(1)
-            return False
+    @classmethod
+    def parse(cls, text):
+        """
+        Params:
+            text (str or bytes): sequence set such as '1:5,7', without '*'
+
+        Raises:
+            ValueError: text is not a sequence set
+        """
+        if isinstance(text, bytes):
+            text = text.decode('ascii')
+        ranges = []
+        for part in text.strip().split(','):
+            if len(part) == 0:
+                continue
+            lo, _, hi = part.partition(':')
+            ranges.append((int(lo), int(hi or lo)))
+        return cls(ranges)
+
+    @classmethod
+    def from_nums(cls, nums):
+        ranges = []
+        for n in sorted(set(int(n) for n in nums)):
+            if len(ranges) > 0 and n == ranges[-1][1] + 1:
+                ranges[-1][1] = n
+            else:
+                ranges.append([n, n])
+        return cls(ranges)
+
+    @property
+    def ranges(self):
+        return list(self._ranges)
+
+    def min(self):
+        return self._ranges[0][0] if len(self._ranges) > 0 else None
+
+    def max(self):
+        return self._ranges[-1][1] if len(self._ranges) > 0 else None
+
+    def chunks(self, size):
+        """
+        Split in sets of at most size numbers, in ascending order.
+
+        Returns:
+            generator of SequenceSet
+        """
+        chunk, count = [], 0
+        for lo, hi in self._ranges:
+            while lo <= hi:
+                take = min(hi - lo + 1, size - count)
+                chunk.append((lo, lo + take - 1))
+                count += take
+                lo += take
+                if count == size:
+                    yield SequenceSet(chunk)
+                    chunk, count = [], 0
+        if count > 0:
+            yield SequenceSet(chunk)
+
+    def difference(self, other):
+        """
+        Numbers of this set not in other, e.g. new UIDs since the last
+        search.
+
+        Returns:
+            SequenceSet
+        """
+        result = []
+        theirs = other._ranges
+        j = 0
+        for lo, hi in self._ranges:
+            while j < len(theirs) and theirs[j][1] < lo:
+                j += 1
+            k = j
+            while lo <= hi and k < len(theirs) and theirs[k][0] <= hi:
+                if theirs[k][0] > lo:
+                    result.append((lo, theirs[k][0] - 1))
+                lo = max(lo, theirs[k][1] + 1)
+                k += 1
+            if lo <= hi:
+                result.append((lo, hi))
+        return SequenceSet(result)
+
+    __sub__ = difference
+
+    def __len__(self):
+        return sum(hi - lo + 1 for lo, hi in self._ranges)
+
+    def __bool__(self):
+        return len(self._ranges) > 0
+
+    def __iter__(self):
+        for lo, hi in self._ranges:
+            yield from range(lo, hi + 1)
+
+    def __contains__(self, num):
+        num = int(num)
+        i = bisect.bisect_right(self._starts, num) - 1
+        return i >= 0 and num <= self._ranges[i][1]
+
+    def __eq__(self, other):
+        if not isinstance(other, SequenceSet):
+            return NotImplemented
+        return self._ranges == other._ranges
+
+    def __str__(self):
+        return ','.join(str(lo) if lo == hi else '{}:{}'.format(lo, hi)
+            for lo, hi in self._ranges)
+
+    def __repr__(self):
+        return 'SequenceSet({!r})'.format(str(self))
+
+def seqset(nums):
+    """
+    Compress message numbers into an IMAP sequence set
+
+    Params:
+        nums (list or SequenceSet): integers
+
+    Returns:
+        str: e.g. '1:5,7,9:10' for [1, 2, 3, 4, 5, 7, 9, 10]
+    """
+    if not isinstance(nums, SequenceSet):
+        nums = SequenceSet.from_nums(nums)
+    return str(nums)
+
+def parse_esearch(data):
+    """
+    Parse untagged ESEARCH response (RFC 4731)
+
+    Params:
+        data (bytes): response data such as
+        b'(TAG "A5") UID MIN 3 MAX 9 COUNT 4 ALL 3:5,9', with or without
+        the leading b'* ESEARCH '
+
+    Returns:
+        dict with lowercase keys 'min', 'max' and 'count' as int and 'all'
+        as SequenceSet, only those the server sent, plus 'uid' True for
+        UID SEARCH
+    """
+    if data[:10].upper() == b'* ESEARCH ':
+        data = data[10:]
+    data = data.strip()
+    if data.startswith(b'('):
+        # correlator, (TAG "tag")
+        end = data.find(b')')
+        data = data[end + 1:] if end != -1 else b''
+
+    words = data.split()
+    result = {}
+    i = 0
+    if len(words) > 0 and words[0].upper() == b'UID':
+        result['uid'] = True
+        i = 1
+    while i < len(words) - 1:
+        key, value = words[i].lower().decode('ascii', 'replace'), words[i + 1]
+        try:
+            if key == 'all':
+                result[key] = SequenceSet.parse(value)
+            else:
+                result[key] = int(value)
+        except ValueError: pass
+        i += 2
+    return result
+
+def parse_status(data):
+    """
+    Parse untagged STATUS response
+
+    Params:
+        data (str): response such as '* status "work" (messages 3 unseen 1)'
+
+    Returns:
+        tuple (folder, dict) with lowercase item names and int values, or
+        None if data is not a STATUS response
+    """
+    words = data.split(None, 2)
+    if len(words) < 3 or words[0] != '*' or words[1].lower() != 'status':
+        return None
+
+    rest = words[2].strip()
+    if rest.startswith('"'):
+        end = 1
+        while end < len(rest) and rest[end] != '"':
+            end += 2 if rest[end] == '\\' else 1
+        folder = rest[1:end].replace('\\"', '"').replace('\\\\', '\\')
+        rest = rest[end + 1:]
+    else:
+        folder, _, rest = rest.partition(' ')
+
+    items = rest.strip().strip('()').split()
+    values = {}
+    for i in range(0, len(items) - 1, 2):
+        try:
+            values[items[i].lower()] = int(items[i + 1])
+        except ValueError: pass
+    return folder, values
+
+class Headers:
+    """
+    FROM, DATE and SUBJECT of a message, see parse_headers()
+
+    Lookup is case insensitive and missing fields are None, like
+    email.message.Message, so both can be handed to notifications.
+    """
+    __slots__ = ('_fields',)
+
+    def __init__(self, fields=None):
+        self._fields = fields or {}
+
+    def __getitem__(self, name):
+        return self._fields.get(name.lower())
+
+    def __setitem__(self, name, value):
+        self._fields[name.lower()] = value
+
+    def __contains__(self, name):
+        return name.lower() in self._fields
+
+    def get(self, name, default=None):
+        return self._fields.get(name.lower(), default)
+
+    def items(self):
+        return self._fields.items()
+
+    @property
+    def sender(self):
+        return sender_name(self['from'] or '')
+
+def parse_headers(data):
+    """
+    Parse a BODY[HEADER.FIELDS (FROM DATE SUBJECT)] literal without
+    building an email.message.Message
+
+    Params:
+        data (bytes): header block as returned by FETCH
+
+    Returns:
+        Headers with unfolded values, RFC 2047 encoded words of the
+        subject decoded. From is kept raw, see sender_name()
+    """
+    data = bytes(data)
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        text = data.decode('latin-1')
+
+    fields = {}
+    name = None
+    for line in text.split('\n'):
+        line = line.rstrip('\r')
+        if line == '':
+            break
+        if line[0] in ' \t':
+            if name is not None:
+                fields[name] += ' ' + line.strip()
+            continue
+
+        name, sep, value = line.partition(':')
+        name = name.strip().lower()
+        # first occurrence wins, as with Message.get
+        if sep == '' or name not in HEADER_FIELDS or name in fields:
+            name = None
+            continue
+        fields[name] = value.strip()
+
+    # decoding From first would let a comma or quote in an encoded
+    # display name split the address, sender_name() decodes the name
+    if 'subject' in fields:
+        fields['subject'] = decode_words(fields['subject'])
+    return Headers(fields)
+
+def decode_words(value):
+    """
+    Decode RFC 2047 encoded words, e.g. '=?UTF-8?B?w6ljb2xl?=' to 'école'
+
+    Params:
+        value (str): unfolded header value
+
+    Returns:
+        str: value with encoded words decoded, unknown charsets are read
+        as latin-1
+    """
+    if '=?' not in value:
+        return value
+
+    parts = []
+    try:
+        chunks = email.header.decode_header(value)
+    except email.errors.HeaderParseError:
+        return value
+    for chunk, charset in chunks:
+        if isinstance(chunk, bytes):
+            try:
+                chunk = chunk.decode(charset or 'ascii', 'replace')
+            except LookupError:
+                chunk = chunk.decode('latin-1')
+        parts.append(chunk)
+    return ''.join(parts)
+
+@functools.lru_cache(maxsize=DEFAULT_NAME_CACHE)
+def sender_name(value):
+    """
+    Display name of a From header, or its address when there is none.
+    Results are cached as most mail comes from the same few senders.
+
+    Params:
+        value (str): raw From header, encoded words are decoded once the
+        address is split off
+
+    Returns:
+        str: decoded display name
+    """
+    name, addr = email.utils.parseaddr(value)
+    if name == '' and addr == '':
+        return decode_words(value.split('<')[0].replace('"', '').strip())
+    return decode_words(name) or addr
+
+class AsyncIMAPMailbox:
+    """
+    asyncio based mailbox
+
+    Instantiate with AsyncIMAPMailbox(Account(), [name=folder_name])
+
+    Same life cycle and status flags as IMAP_Mailbox, but every network
+    operation is a coroutine so any number of mailboxes can share one
+    event loop instead of using one thread each. Commands are serialized
+    with an asyncio.Lock and responses are read by a single reader task
+    per connection. Messages are tracked by UID with the same
+    MailboxState as IMAP_Mailbox, pass state_dir to keep it across
+    restarts.
+    """
+    E_NETWORK    = IMAP_Mailbox.E_NETWORK
+    E_LOGIN      = IMAP_Mailbox.E_LOGIN
+    E_SELECT     = IMAP_Mailbox.E_SELECT
+    CLOSED       = IMAP_Mailbox.CLOSED
+    FETCH_HEADER = IMAP_Mailbox.FETCH_HEADER
+    IDLE         = IMAP_Mailbox.IDLE
+    IDLE_FAILED  = IMAP_Mailbox.IDLE_FAILED
+    RESYNC       = IMAP_Mailbox.RESYNC
+
+    def __init__(self, acc, **kwargs):
+        self.status       = self.CLOSED
+        self.name         = kwargs.get('name')
+        self.capabilities = ()
+        self.timeout      = kwargs.get('timeout', DEFAULT_CMD_TIMEOUT)
+        self.response_cap = kwargs.get('response_cap', DEFAULT_RESPONSE_CAP)
+        self._account     = acc
+        self._reader      = None
+        self._writer      = None
+        self._task        = None
+        self._lock        = asyncio.Lock()
+        self._tagpre      = 'N%03X' % random.randint(0, 0xfff)
+        self._tagnum      = 0
+        self._pending     = {}
+        self._untagged    = []
+        self._greeting    = None
+        self._continue    = None
+        self._idle_tag    = None
+        self._events      = deque()
+        self._wakeup      = asyncio.Event()
+        self._skip_poll   = False
+        self._synced      = {}
+        self._state_dirty = False
+        self.fetch_chunk  = kwargs.get('fetch_chunk', DEFAULT_FETCH_CHUNK)
+
+        state_dir = kwargs.get('state_dir')
+        if state_dir is not None:
+            self._state = MailboxState(MailboxState.path_for(
+                state_dir, acc.name, self.name))
+        else:
+            self._state = MailboxState()
+
+    async def open(self):
+        """
+        Initiate connection to server, login, and select folder.
+
+        Returns:
+            bool: True if successful, False if cannot select folder
+        """
+        self.status = self.CLOSED
+
+        mbox = self.name
+        if self.name is None:
+            mbox = DEFAULT_FOLDER
+
+        try:
+            await self.connect()
         except:
-            self._wlock_fifo(1)
-            self.status |= self.CLOSED
+            self.status |= self.E_NETWORK
             raise
 
-    def close(self):
+        try:
+            await self.login()
+        except:
+            self.status |= self.E_LOGIN
+            raise
+
+        if not await self.select(mbox):
+            self.status |= self.E_SELECT
+            await self._shutdown()
+            return False
+
+        self.status &= ~self.CLOSED
+        return True
+
+    async def connect(self):
+        """
+        Open connection to server and read capabilities, upgrading to TLS
+        with STARTTLS when connecting without ssl and server supports it.
+
+        Raises:
+            IOError: Server greeting not received or rejected
+        """
+        acc = self._account
+        ctx = None
+        port = acc.port or imaplib.IMAP4_PORT
+        if acc.ssl:
+            ctx = ssl.create_default_context()
+            port = acc.port or imaplib.IMAP4_SSL_PORT
+
+        await self._shutdown()
+        self._parser = ResponseParser()
+        self._greeting = asyncio.get_running_loop().create_future()
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(acc.server, port, ssl=ctx),
+            acc.timeout or self.timeout)
+        self._task = asyncio.ensure_future(self._read_loop())
+
+        greeting = await asyncio.wait_for(self._greeting, self.timeout)
+        if not greeting.startswith(b'* OK') and \
+                not greeting.startswith(b'* PREAUTH'):
+            raise IOError('Server rejected connection')
+
+        await self._capability()
+        if ctx is None and 'STARTTLS' in self.capabilities:
+            t, _ = await self._command('STARTTLS')
+            if t == 'OK':
+                await self._writer.start_tls(ssl.create_default_context(),
+                    server_hostname=acc.server)
+                await self._capability()
+
+    async def login(self):
+        """
+        Raises:
+            IOError: Login rejected by server
+        """
+        t, _ = await self._command('LOGIN', self._account.username,
+            _quote(self._account.password))
+        if t != 'OK':
+            raise IOError('Login failed')
+        await self._capability()
+
+    async def select(self, mbox):
+        """
+        Returns:
+            bool: True if folder selected or False otherwise
+        """
+        t, data = await self._command('SELECT', mbox)
+        if t != 'OK':
+            return False
+        self._load_state(data)
+        return True
+
+    async def fetch(self, num, flag = 0):
+        """
+        Download message from server.
+
+        Params:
+            num (str): message UID to be downloaded
+            flag (int, optional): set with FETCH_HEADER to download header only
+
+        Returns:
+            Headers with FETCH_HEADER, email.message.Message otherwise, or
+            None if failed
+        """
+        msg_parts = '(BODY.PEEK[HEADER.FIELDS (FROM DATE SUBJECT)])'
+        if flag & self.FETCH_HEADER == 0:
+            msg_parts = '(RFC822)'
+
+        async with self._lock:
+            if not await self._send_done():
+                raise ValueError('Mailbox is idle, cannot fetch')
+
+            t, data = await self._command('UID', 'FETCH', num, msg_parts)
+            if not t == 'OK':
+                return None
+
+        for ln in data:
+            literal = _literal(ln)
+            if literal is not None:
+                return _parse_message(literal, flag)
+        return None
+
+    async def fetch_many(self, nums, flag = FETCH_HEADER, chunk = None):
+        """
+        Download several messages with one UID FETCH per chunk.
+
+        Params:
+            nums (SequenceSet or list): message UIDs as returned by poll()
+            flag (int, optional): FETCH_HEADER to download header only,
+            default, or 0 for the whole message
+            chunk (int, optional): messages per FETCH, default fetch_chunk
+
+        Returns:
+            async generator of (uid, Headers or email.message.Message) in
+            server order,
+            each chunk is fetched when the previous one is consumed
+        """
+        if chunk is None or chunk < 1:
+            chunk = self.fetch_chunk
+
+        msg_parts = '(UID BODY.PEEK[HEADER.FIELDS (FROM DATE SUBJECT)])'
+        if flag & self.FETCH_HEADER == 0:
+            msg_parts = '(UID RFC822)'
+
+        if not isinstance(nums, SequenceSet):
+            nums = SequenceSet.from_nums(nums)
+        for uids in nums.chunks(chunk):
+            async with self._lock:
+                if not await self._send_done():
+                    raise ValueError('Mailbox is idle, cannot fetch')
+                t, data = await self._command('UID', 'FETCH', str(uids),
+                    msg_parts)
+
+            if not t == 'OK':
+                return
+
+            for ln in data:
+                literal = _literal(ln)
+                if literal is None:
+                    continue
+                # UID may come before or after the literal
+                uid = re.search(rb'UID (\d+)', ln.replace(literal, b'', 1),
+                    re.I)
+                if uid is None:
+                    continue
+                yield uid.group(1).decode('utf-8'), \
+                    _parse_message(literal, flag)
+
+    async def poll(self):
+        """
+        Search unread emails that arrived since the last poll, same as
+        IMAP_Mailbox.poll(). Only UIDs above the last one returned are
+        searched and progress is saved to the state file.
+
+        Returns:
+            SequenceSet of message UIDs, empty if none, or None if error
+        """
+        esearch = 'ESEARCH' in self.capabilities
+        async with self._lock:
+            if not await self._send_done():
+                return None
+
+            if self._skip_poll:
+                # folder unchanged since last session, nothing new
+                self._skip_poll = False
+                self._commit_state()
+                return SequenceSet()
+
+            last = self._state.last_uid
+            first = '{}:*'.format(last + 1)
+            if esearch:
+                t, data = await self._command('UID', 'SEARCH', 'RETURN',
+                    '(ALL)', 'UID', first, 'UNSEEN')
+            else:
+                t, data = await self._command('UID', 'SEARCH', 'UID', first,
+                    'UNSEEN')
+            if not t == 'OK':
+                return None
+
+            uids = SequenceSet()
+            for ln in data:
+                if esearch and ln[:10].upper() == b'* ESEARCH ':
+                    uids = parse_esearch(ln).get('all', uids)
+                elif ln[:9].upper() == b'* SEARCH ':
+                    uids = SequenceSet.from_nums(ln[9:].split())
+
+            # n:* always matches the highest UID even when it is below n
+            if last > 0:
+                uids = uids - SequenceSet([(1, last)])
+
+            if uids:
+                self._state.last_uid = uids.max()
+                self._state_dirty = True
+            self._commit_state()
+            return uids
+
+    async def store(self, num, flags, mode='+FLAGS'):
+        """
+        Change message flags
+
+        Params:
+            num (str): message UID
+            flags (str): flags to set, e.g. '\\Seen'
+            mode (str, optional): '+FLAGS', '-FLAGS' or 'FLAGS'
+
+        Returns:
+            bool: True if successful or False if failed
+        """
+        async with self._lock:
+            if not await self._send_done():
+                return False
+
+            t, _ = await self._command('UID', 'STORE', num, mode,
+                '({})'.format(flags))
+            return t == 'OK'
+
+    async def mark_read(self, num):
+        """
+        Add flag \\Seen to selected message UID
+
+        Returns:
+            bool: True if successful or False if failed
+        """
+        return await self.store(num, '\\Seen')
+
+    async def idle(self, timeout=None):
+        """
+        Sending IDLE command to server and waiting for response.
+
+        Params:
+            timeout (float, optional): idle timeout in minutes, default is
+            DEFAULT_IDLE_TIMEOUT
+
+        Returns:
+            decoded bytes string read from socket or None if timeout reached.
+
+        Raises:
+            IOError: Connection closed
+        """
+        if self.status & self.IDLE == 0:
+            async with self._lock:
+                try:
+                    ok = await self._send_idle()
+                except Exception:
+                    ok = False
+                if not ok:
+                    self.status |= self.IDLE_FAILED
+                    return None
+
+        if timeout is None or timeout == 0:
+            timeout = DEFAULT_IDLE_TIMEOUT
+
+        if not isinstance(timeout, (int, float)):
+            raise ValueError('timeout value is not a number')
+
+        try:
+            await asyncio.wait_for(self._next_event(), 60 * timeout)
+        except asyncio.TimeoutError:
+            async with self._lock:
+                if not await self._send_done():
+                    self.status |= self.IDLE_FAILED
+            return None
+
+        if self.status & self.CLOSED > 0:
+            raise IOError('Socket error')
+        if len(self._events) == 0:
+            return None
+        # folder changed, first poll must search again
+        self._skip_poll = False
+        return self._events.popleft()
+
+    async def close(self):
         """
         Attempt to gracefully closing selected mailbox and logout.
-        On exit, this method sets status with Mailbox.CLOSED so other
-        methods won't read from socket.
-        Mailbox.idle will exit if this flag set.
         """
+        if self._writer is None:
+            self.status |= self.CLOSED
+            return
 
-        self._wlock_fifo()
-        sock_alive = False
-        if self.status & self.IDLE > 0:
-            sock_alive = self._send_done()
-        else:
-            sock_alive = self._send_noop()
+        async with self._lock:
+            try:
+                if await self._send_done():
+                    await self._command('CLOSE')
+                    await self._command('LOGOUT')
+            except Exception: pass
+            self.status |= self.CLOSED
+            await self._shutdown()
 
+    def abort(self):
+        """
+        Drop connection at once without logging out, for a close() that
+        is stuck. Must be called from the event loop thread.
+        """
         self.status |= self.CLOSED
+        self._wakeup.set()
+        if self._writer is not None:
+            self._writer.transport.abort()
+
+    def _load_state(self, data):
+        # check saved state against the SELECT responses in data, see
+        # IMAP_Mailbox._load_state(). No CONDSTORE here, an unchanged
+        # UIDNEXT is enough to skip the first poll
+        state = self._state.load()
+        codes = {}
+        for ln in data:
+            m = re.match(rb'\* OK \[(UIDVALIDITY|UIDNEXT) (\d+)\]', ln, re.I)
+            if m is not None:
+                codes[m.group(1).decode('utf-8').lower()] = int(m.group(2))
+        uidvalidity = codes.get('uidvalidity')
+        uidnext = codes.get('uidnext')
+
+        if uidvalidity is not None and uidvalidity != state.uidvalidity:
+            # UIDs were renumbered, everything unseen is new again
+            state.uidvalidity = uidvalidity
+            state.last_uid = 0
+            state.uidnext = 0
+            state.highestmodseq = 0
+
+        self._synced = {'uidnext': uidnext}
+        self._skip_poll = state.last_uid > 0 and uidnext is not None and \
+            uidnext == state.uidnext
+
+    def _commit_state(self):
+        # first poll after open covered everything up to the select
+        state = self._state
+        before = [getattr(state, f) for f in state.FIELDS]
+        for k, v in self._synced.items():
+            if v is not None:
+                setattr(state, k, v)
+        self._synced = {}
+        if before != [getattr(state, f) for f in state.FIELDS] or \
+                self._state_dirty:
+            self._state_dirty = not state.save()
+
+    async def _next_event(self):
+        while len(self._events) == 0 and self.status & self.CLOSED == 0 \
+                and self.status & self.IDLE > 0:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    async def _capability(self):
+        t, data = await self._command('CAPABILITY')
+        for ln in data:
+            if ln[:13].upper() == b'* CAPABILITY ':
+                self.capabilities = tuple(
+                    ln[13:].decode('utf-8', 'replace').upper().split())
+
+    async def _command(self, *args):
+        # send a command and wait for its tagged response
+        # returns (status, [untagged responses]) where status is the
+        # uppercase result e.g. 'OK', 'NO', 'BAD'
+        # Caller is responsible for holding self._lock except on connect
+        tag = self._new_tag()
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[tag] = fut
+        self._untagged = []
+
+        line = ' '.join([tag] + [str(a) for a in args]) + '\r\n'
+        self._writer.write(line.encode('utf-8'))
+        await self._writer.drain()
 
         try:
-            if sock_alive:
-                self._imap.close()
-                self._imap.logout()
+            t = await asyncio.wait_for(fut, self.timeout)
+        finally:
+            self._pending.pop(tag, None)
+        return t, self._untagged
+
+    async def _send_idle(self):
+        if self.status & self.IDLE > 0:
+            return True
+
+        tag = self._new_tag()
+        self._continue = asyncio.get_running_loop().create_future()
+        self._pending[tag] = asyncio.get_running_loop().create_future()
+        self._idle_tag = tag
+
+        self._writer.write('{} IDLE\r\n'.format(tag).encode('utf-8'))
+        await self._writer.drain()
+        try:
+            await asyncio.wait_for(self._continue, self.timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.status |= self.IDLE
+        return True
+
+    async def _send_done(self):
+        # returns True if not idling anymore or False otherwise
+        if self.status & self.IDLE == 0:
+            return True
+
+        fut = self._pending.get(self._idle_tag)
+        self._writer.write(b'DONE\r\n')
+        await self._writer.drain()
+        try:
+            if fut is not None:
+                await asyncio.wait_for(fut, self.timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._pending.pop(self._idle_tag, None)
+        self.status &= ~self.IDLE
+        # let idle() return so the caller can decide to idle again
+        self._wakeup.set()
+        return True
+
+    async def _read_loop(self):
+        # single reader for the connection, dispatches responses to the
+        # command waiting for them or to the idle event queue
+        error = EOFError('Connection closed by remote host')
+        try:
+            while True:
+                data = await self._reader.read(4096)
+                if len(data) == 0:
+                    break
+                for ln in self._parser.feed(data):
+                    self._dispatch(ln)
+        except asyncio.CancelledError:
+            error = IOError('Connection closed')
+        except Exception as e:
+            error = e
+
+        self.status |= self.CLOSED
+        self.status &= ~self.IDLE
+        for fut in list(self._pending.values()) + \
+                [self._greeting, self._continue]:
+            if fut is not None and not fut.done():
+                fut.set_exception(error)
+        self._wakeup.set()
+
+    def _dispatch(self, ln):
+        if self._greeting is not None and not self._greeting.done():
+            self._greeting.set_result(ln)
+            return
+
+        if ln.startswith(b'+'):
+            if self._continue is not None and not self._continue.done():
+                self._continue.set_result(ln)
+            return
+
+        if ln.startswith(b'* '):
+            if self.status & self.IDLE > 0:
+                if len(self._events) >= self.response_cap:
+                    self._events.popleft()
+                    self.status |= self.RESYNC
+                self._events.append(ln.decode('utf-8', 'replace').lower())
+                self._wakeup.set()
             else:
-                self._imap.sock.shutdown(socket.SHUT_RDWR)
-        except: pass
-        self._wlock_fifo(1)
+                self._untagged.append(ln)
+            return
+
+        tag, _, rest = ln.partition(b' ')
+        fut = self._pending.get(tag.decode('utf-8', 'replace'))
+        if fut is not None and not fut.done():
+            fut.set_result(rest.split(b' ', 1)[0].decode('utf-8').upper())
+
+    async def _shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except BaseException: pass
+            self._task = None
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception: pass
+            self._writer = None
+            self._reader = None
+
+    def _new_tag(self):
+        self._tagnum += 1
+        return '{}{}'.format(self._tagpre, self._tagnum)
+
+def _parse_message(data, flag):
+    # header fetches skip the email package
+    if flag & IMAP_Mailbox.FETCH_HEADER > 0:
+        return parse_headers(data)
+    return email.message_from_bytes(data)
+
+def _quote(arg):
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _literal(data):
+    # returns bytes of the first {n} literal in response or None
+    end = data.find(b'}\r\n')
+    if end < 0:
+        return None
+    start = data.rfind(b'{', 0, end)
+    if start < 0 or not data[start + 1:end].isdigit():
+        return None
+    n = int(data[start + 1:end])
+    return data[end + 3:end + 3 + n]
 
 class Account:
     def __init__(self, **kwargs):
@@ -445,4 +3384,8 @@ class Account:
         self.username = kwargs.get('user')
         self.password = kwargs.get('password')
         self.ssl      = kwargs.get('ssl')
+        self.port     = kwargs.get('port')
         self.name     = kwargs.get('name')
+        self.timeout  = kwargs.get('timeout', DEFAULT_CONNECT_TIMEOUT)
+        self.compress = kwargs.get('compress', False)
+        self.capture  = kwargs.get('capture')